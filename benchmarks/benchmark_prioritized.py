@@ -0,0 +1,38 @@
+'''
+times DensitySampleScheme.sample and update_weights with batches of 512
+on a 2^20 entry scheme, alternating them like a learner does.
+
+run from the repository root with
+    python -m benchmarks.benchmark_prioritized
+'''
+import time
+import numpy as np
+from rlflow.selectors import DensitySampleScheme
+
+SCHEME_SIZE = 2**20
+BATCH_SIZE = 512
+NUM_ITERS = 500
+
+def benchmark():
+    np_random = np.random.RandomState(0)
+    scheme = DensitySampleScheme(SCHEME_SIZE, alpha=0.6, beta_fn=lambda learn_step: 0.4, seed=0)
+    scheme.add_many(np.arange(SCHEME_SIZE))
+    scheme.update_weights(np.arange(SCHEME_SIZE), np_random.random(SCHEME_SIZE) + 0.01)
+
+    sample_times = []
+    update_times = []
+    for _ in range(NUM_ITERS):
+        start = time.perf_counter()
+        ids, weights = scheme.sample(BATCH_SIZE)
+        sample_times.append(time.perf_counter() - start)
+
+        td_errs = np_random.random(BATCH_SIZE) + 0.01
+        start = time.perf_counter()
+        scheme.update_weights(ids, td_errs)
+        update_times.append(time.perf_counter() - start)
+
+    print("sample: {:.0f}us, update_weights: {:.0f}us (medians over {} batches)".format(
+        np.median(sample_times)*1e6, np.median(update_times)*1e6, NUM_ITERS))
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,2 +1,5 @@
-from .transition_adder import TransitionAdder
-from .logger_adder import LoggerAdder
+from .transition_adder import TransitionAdder, VectorTransitionAdder
+from .logger_adder import LoggerAdder, VectorLoggerAdder
+from .gym_adder import PerEnvVectorAdder, per_env_vector_adder_fn, vector_adder_fn
+from .n_step_adder import NStepTransitionAdder, VectorNStepTransitionAdder
+from .on_policy_critic_adder import OnPolicyAdder
@@ -1,3 +1,5 @@
+import numpy as np
+
 
 class GymBaseAdder:
     def get_example_output(self):
@@ -5,10 +7,12 @@ class GymBaseAdder:
         returns: list of numpy arrays with the correct shape and dtype of the result
         '''
 
-    def set_generate_callback(self, on_generate):
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
         '''
         args:
         on_generate: The callback that is called when a new transition is generated
+        with_env_idxs: if set, on_generate is called as on_generate(transition, 0),
+            0 being the index of the only environment of the adder
         '''
 
     def add(self, obs, action, rew, done, info, actor_info):
@@ -16,3 +20,102 @@ class GymBaseAdder:
         the observation, reward, done, and info
         generated by the environment
         '''
+
+    def vectorized(self, num_envs, terminal_obs=None):
+        '''
+        optional, returns the GymVectorBaseAdder doing the work of num_envs
+        copies of this adder, see vector_adder_fn
+        '''
+
+class GymVectorBaseAdder:
+    '''
+    Adder for all environments of a vector environment at once
+    '''
+    def get_example_output(self):
+        '''
+        returns: list of numpy arrays with the correct shape and dtype of a single transition
+        '''
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        '''
+        args:
+        on_generate: The callback that is called with each batch of new transitions,
+            a list of arrays, one per field, stacked along a leading batch dimension
+        with_env_idxs: if set, on_generate is called as on_generate(batch, env_idxs),
+            where env_idxs is the index of the environment of each transition
+        '''
+
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
+        '''
+        the stacked observations, rewards, dones, and the infos
+        generated by the vector environment
+        '''
+
+def add_with_terminal_obs(adder, terminal_obs, obs, action, rew, done, info, actor_info):
+    '''
+    adds a step to a regular adder, when the episode ended, obs already
+    belongs to the next episode, so the adder gets the terminal
+    observation instead, and obs as the start of the next episode
+    '''
+    if done and terminal_obs is not None:
+        adder.add(terminal_obs, action, rew, done, info, actor_info)
+        adder.add(obs, action, 0., False, {}, actor_info)
+    else:
+        adder.add(obs, action, rew, done, info, actor_info)
+
+class PerEnvVectorAdder:
+    '''
+    Vector adder made of one regular adder per environment,
+    for adders which do not have a vectorized version
+
+    If the terminal_obs buffer of the vector environment is given, the
+    adders see the observations that ended the episodes, see add_with_terminal_obs
+    '''
+    def __init__(self, adders, terminal_obs=None):
+        self.adders = adders
+        self.terminal_obs = terminal_obs
+        self.on_generate = None
+        self.with_env_idxs = False
+
+    def get_example_output(self):
+        return self.adders[0].get_example_output()
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        assert self.on_generate is None, "set_generate_callback should only be called once"
+        self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+        for env_idx, adder in enumerate(self.adders):
+            adder.set_generate_callback(lambda transition, env_idx=env_idx: self._generate_single(transition, env_idx))
+
+    def _generate_single(self, transition, env_idx):
+        batch = [np.expand_dims(field, 0) for field in transition]
+        if self.with_env_idxs:
+            self.on_generate(batch, np.array([env_idx], dtype=np.int64))
+        else:
+            self.on_generate(batch)
+
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
+        assert self.on_generate is not None, "need to call set_generate_callback before add"
+        for i, adder in enumerate(self.adders):
+            terminal_obs = None if self.terminal_obs is None else self.terminal_obs[i]
+            add_with_terminal_obs(adder, terminal_obs, obss[i], actions[i], rews[i], dones[i], infos[i], actor_infos[i])
+
+def per_env_vector_adder_fn(adder_fn):
+    '''
+    returns a function vec_adder_fn(num_envs, terminal_obs=None) which makes
+    a PerEnvVectorAdder for num_envs environments out of adder_fn
+    '''
+    return lambda num_envs, terminal_obs=None: PerEnvVectorAdder([adder_fn() for _ in range(num_envs)], terminal_obs)
+
+def vector_adder_fn(adder_fn):
+    '''
+    returns a function vec_adder_fn(num_envs, terminal_obs=None) which makes
+    the vectorized version of the adder of adder_fn if it has one, and
+    falls back to a PerEnvVectorAdder otherwise
+    '''
+    def make_vector_adder(num_envs, terminal_obs=None):
+        adder = adder_fn()
+        if hasattr(adder, "vectorized"):
+            return adder.vectorized(num_envs, terminal_obs)
+        return PerEnvVectorAdder([adder]+[adder_fn() for _ in range(num_envs-1)], terminal_obs)
+    return make_vector_adder
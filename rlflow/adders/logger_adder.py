@@ -4,15 +4,26 @@ import numpy as np
 class LoggerAdder:
     def __init__(self):
         self.on_generate = None
+        self.with_env_idxs = False
         self.reward_total = 0
         self.env_len = 0
 
     def get_example_output(self):
         return ("", 0.0)
 
-    def set_generate_callback(self, on_generate):
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
         assert self.on_generate is None, "set_generate_callback should only be called once"
         self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+
+    def vectorized(self, num_envs, terminal_obs=None):
+        return VectorLoggerAdder(num_envs)
+
+    def _generate(self, record):
+        if self.with_env_idxs:
+            self.on_generate(record, 0)
+        else:
+            self.on_generate(record)
 
     def add(self, obs, action, rew, done, info, actor_info):
         assert self.on_generate is not None, "need to call set_generate_callback before add"
@@ -20,8 +31,45 @@ class LoggerAdder:
         self.env_len += 1
         logger_update = 50
         if done or self.env_len%logger_update == logger_update-1:
-            self.on_generate(("mean", "reward_total", self.reward_total))
-            self.on_generate(("mean", "env_len", self.env_len))
-            self.on_generate(("sum", "env_steps", self.env_len))
+            self._generate(("mean", "reward_total", self.reward_total))
+            self._generate(("mean", "env_len", self.env_len))
+            self._generate(("sum", "env_steps", self.env_len))
             self.reward_total = 0
             self.env_len = 0
+
+class VectorLoggerAdder:
+    '''
+    LoggerAdder for num_envs environments at once, see GymVectorBaseAdder
+    '''
+    def __init__(self, num_envs):
+        self.on_generate = None
+        self.with_env_idxs = False
+        self.reward_total = np.zeros(num_envs, dtype=np.float64)
+        self.env_len = np.zeros(num_envs, dtype=np.int64)
+
+    def get_example_output(self):
+        return ("", 0.0)
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        assert self.on_generate is None, "set_generate_callback should only be called once"
+        self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+
+    def _generate(self, record, env_idx):
+        if self.with_env_idxs:
+            self.on_generate(record, env_idx)
+        else:
+            self.on_generate(record)
+
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
+        assert self.on_generate is not None, "need to call set_generate_callback before add"
+        self.reward_total += rews
+        self.env_len += 1
+        logger_update = 50
+        report = np.flatnonzero(np.asarray(dones, dtype=bool) | (self.env_len%logger_update == logger_update-1))
+        for env_idx, reward_total, env_len in zip(report.tolist(), self.reward_total[report].tolist(), self.env_len[report].tolist()):
+            self._generate(("mean", "reward_total", reward_total), env_idx)
+            self._generate(("mean", "env_len", env_len), env_idx)
+            self._generate(("sum", "env_steps", env_len), env_idx)
+        self.reward_total[report] = 0
+        self.env_len[report] = 0
@@ -0,0 +1,151 @@
+import numpy as np
+from rlflow.utils.space_wrapper import SpaceWrapper
+
+class VectorNStepTransitionAdder:
+    '''
+    N-step version of TransitionAdder for num_envs environments stepped
+    together. Generates
+        (obs_n, action, n_step_rew, discount, last_observation)
+    where n_step_rew is the discounted reward of the n steps after
+    last_observation, obs_n the observation n steps later and discount
+    the factor to bootstrap the value of obs_n with: gamma**n, or 0 if the
+    episode ended within the n steps (then obs_n should be ignored).
+
+    Pending steps are kept in a (num_envs, n_step) ring of arrays, and the
+    completed transitions of all envs are generated together as one batch,
+    see GymVectorBaseAdder.
+
+    If the terminal_obs buffer of the vector environment is given, it is
+    used like in VectorTransitionAdder.
+    '''
+    def __init__(self, num_envs, observation_space, action_space, n_step=3, gamma=0.99, terminal_obs=None):
+        assert n_step > 0, "n_step must be at least 1"
+        self.on_generate = None
+        self.with_env_idxs = False
+        self.terminal_obs = terminal_obs
+        self.num_envs = num_envs
+        self.n_step = n_step
+        self.gamma = gamma
+        self.observation_space = SpaceWrapper(observation_space)
+        self.action_space = SpaceWrapper(action_space)
+
+        obs_space = self.observation_space
+        act_space = self.action_space
+        self.obs_ring = np.zeros((num_envs, n_step)+tuple(obs_space.shape), dtype=obs_space.dtype)
+        self.act_ring = np.zeros((num_envs, n_step)+tuple(act_space.shape), dtype=act_space.dtype)
+        self.rew_ring = np.zeros((num_envs, n_step), dtype=np.float32)
+        self.last_observation = np.zeros((num_envs,)+tuple(obs_space.shape), dtype=obs_space.dtype)
+        self.has_last = np.zeros(num_envs, dtype=bool)
+        self.num_pending = np.zeros(num_envs, dtype=np.int64)
+        self.step_count = 0
+
+        steps = np.arange(n_step)
+        # row j discounts the rewards of pending steps j, j+1, ... onto step j
+        self.discount_matrix = np.triu(gamma ** np.maximum(steps[None] - steps[:, None], 0)).astype(np.float32)
+        self.offsets = steps
+
+    def get_example_output(self):
+        return (
+            self.observation_space,
+            self.action_space,
+            np.array(0,dtype=np.float32),
+            np.array(0,dtype=np.float32),
+            self.observation_space
+        )
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        assert self.on_generate is None, "set_generate_callback should only be called once"
+        self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
+        assert self.on_generate is not None, "need to call set_generate_callback before add"
+        dones = np.asarray(dones, dtype=bool)
+        slot = self.step_count % self.n_step
+        self.step_count += 1
+
+        stepped = self.has_last
+        self.obs_ring[stepped, slot] = self.last_observation[stepped]
+        self.act_ring[stepped, slot] = np.asarray(actions)[stepped]
+        self.rew_ring[stepped, slot] = np.asarray(rews)[stepped]
+        self.num_pending += stepped
+
+        full = self.num_pending == self.n_step
+        ended = dones & (self.num_pending > 0)
+        emit_envs = np.flatnonzero(full | ended)
+        if len(emit_envs):
+            self._generate(emit_envs, obss, ended[emit_envs])
+
+        self.num_pending[full] -= 1
+        self.num_pending[dones] = 0
+        np.copyto(self.last_observation, obss)
+        if self.terminal_obs is not None:
+            # obss already starts the next episode for done envs
+            self.has_last[:] = True
+        else:
+            self.has_last = ~dones
+
+    def _generate(self, env_idxs, obss, ended):
+        num_pending = self.num_pending[env_idxs]
+        # ring slots of the pending steps of each env, oldest first
+        oldest = self.step_count - num_pending
+        ring_idxs = (oldest[:, None] + self.offsets) % self.n_step
+        valid = self.offsets < num_pending[:, None]
+        rews = np.where(valid, self.rew_ring[env_idxs[:, None], ring_idxs], 0)
+        n_step_rews = rews @ self.discount_matrix.T
+
+        # an ended episode flushes all of its pending steps, otherwise only the oldest one is complete
+        emit = valid & (ended[:, None] | (self.offsets == 0))
+        rows, steps = np.nonzero(emit)
+        emit_envs = env_idxs[rows]
+        emit_slots = ring_idxs[rows, steps]
+        discount = np.where(ended[rows], 0, self.gamma ** self.n_step).astype(np.float32)
+        obs_n = np.asarray(obss)[emit_envs]
+        if self.terminal_obs is not None:
+            obs_n[ended[rows]] = self.terminal_obs[emit_envs[ended[rows]]]
+        batch = [
+            obs_n,
+            self.act_ring[emit_envs, emit_slots],
+            n_step_rews[rows, steps].astype(np.float32),
+            discount,
+            self.obs_ring[emit_envs, emit_slots],
+        ]
+        if self.with_env_idxs:
+            self.on_generate(batch, emit_envs)
+        else:
+            self.on_generate(batch)
+
+class NStepTransitionAdder:
+    '''
+    Single environment version of VectorNStepTransitionAdder, generates
+    one transition at a time like TransitionAdder
+    '''
+    def __init__(self, observation_space, action_space, n_step=3, gamma=0.99):
+        self.on_generate = None
+        self.with_env_idxs = False
+        self.spaces = (observation_space, action_space)
+        self.vector_adder = VectorNStepTransitionAdder(1, observation_space, action_space, n_step, gamma)
+
+    def get_example_output(self):
+        return self.vector_adder.get_example_output()
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        assert self.on_generate is None, "set_generate_callback should only be called once"
+        self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+        self.vector_adder.set_generate_callback(self._generate_batch)
+
+    def vectorized(self, num_envs, terminal_obs=None):
+        return VectorNStepTransitionAdder(num_envs, *self.spaces, self.vector_adder.n_step, self.vector_adder.gamma, terminal_obs)
+
+    def _generate_batch(self, batch):
+        for i in range(len(batch[0])):
+            transition = tuple(field[i] for field in batch)
+            if self.with_env_idxs:
+                self.on_generate(transition, 0)
+            else:
+                self.on_generate(transition)
+
+    def add(self, obs, action, rew, done, info, actor_info):
+        assert self.on_generate is not None, "need to call set_generate_callback before add"
+        self.vector_adder.add(np.expand_dims(obs, 0), np.expand_dims(action, 0), [rew], [done], [info], [actor_info])
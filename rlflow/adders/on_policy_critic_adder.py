@@ -1,14 +1,62 @@
 import numpy as np
-import gym
 from rlflow.utils.space_wrapper import SpaceWrapper
 
+def compute_gae(rews, dones, values, last_values, gamma, gae_lambda, advantages):
+    '''
+    generalized advantage estimation over (num_steps, num_envs) arrays,
+    scanning backwards over the steps for all envs at once.
+
+    dones[t] means the observation after step t started a new episode,
+    so the value after it is not bootstrapped. last_values are the
+    values of the observations after the last step.
+    '''
+    num_steps = len(rews)
+    next_values = last_values
+    next_advantage = np.zeros_like(last_values)
+    for t in reversed(range(num_steps)):
+        not_done = 1.0 - dones[t]
+        delta = rews[t] + gamma * next_values * not_done - values[t]
+        next_advantage = delta + gamma * gae_lambda * not_done * next_advantage
+        advantages[t] = next_advantage
+        next_values = values[t]
+    return advantages
+
 class OnPolicyAdder:
-    def __init__(self, num_steps, observation_space, action_space):
+    '''
+    Collects fixed length segments of num_steps steps of num_envs
+    environments for on-policy learning, see GymVectorBaseAdder.
+
+    The actor has to return actor_infos with "values" and "log_probs"
+    arrays for the observations it acted on. A segment is generated
+    once the values of the observations after its last step are known,
+    i.e. on the step after it, as a list of (num_steps, num_envs) arrays:
+        (obs, action, values, advantages, returns, log_probs)
+    The arrays are reused for the next segment, so they have to be
+    copied by the callback. With with_env_idxs, the env_idxs are the
+    index of the environment of each column of the segment.
+    '''
+    def __init__(self, num_envs, num_steps, observation_space, action_space, gamma=0.99, gae_lambda=0.95):
         self.on_generate = None
+        self.with_env_idxs = False
         self.observation_space = SpaceWrapper(observation_space)
         self.action_space = SpaceWrapper(action_space)
-        self.data_list = []
+        self.num_envs = num_envs
         self.num_steps = num_steps
+        self.gamma = gamma
+        self.gae_lambda = gae_lambda
+
+        seg_shape = (num_steps, num_envs)
+        self.obs = np.zeros(seg_shape+tuple(self.observation_space.shape), dtype=self.observation_space.dtype)
+        self.actions = np.zeros(seg_shape+tuple(self.action_space.shape), dtype=self.action_space.dtype)
+        self.rews = np.zeros(seg_shape, dtype=np.float32)
+        self.dones = np.zeros(seg_shape, dtype=np.float32)
+        self.values = np.zeros(seg_shape, dtype=np.float32)
+        self.log_probs = np.zeros(seg_shape, dtype=np.float32)
+        self.advantages = np.zeros(seg_shape, dtype=np.float32)
+        self.returns = np.zeros(seg_shape, dtype=np.float32)
+        self.last_observation = np.zeros((num_envs,)+tuple(self.observation_space.shape), dtype=self.observation_space.dtype)
+        self.has_last = False
+        self.step_idx = 0
 
     def get_example_output(self):
         return (
@@ -17,21 +65,37 @@ class OnPolicyAdder:
             np.array(0,dtype=np.float32), # values
             np.array(0,dtype=np.float32), # advantages
             np.array(0,dtype=np.float32), # returns
-            self.action_space,   # log_probs
+            np.array(0,dtype=np.float32), # log_probs
         )
 
-    def set_generate_callback(self, on_generate):
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
         assert self.on_generate is None, "set_generate_callback should only be called once"
         self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
 
-    def add(self, obs, action, rew, done, info):
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
         assert self.on_generate is not None, "need to call set_generate_callback before add"
-        if isinstance(self.action_space, gym.spaces.Box):
-            action = np.clip(action, self.action_space.low, self.action_space.high)
-
-        self.data_list.append(np.array(obs), action, rew, done, info)
+        if self.has_last:
+            if self.step_idx == self.num_steps:
+                self._generate(actor_infos["values"])
+            t = self.step_idx
+            self.obs[t] = self.last_observation
+            self.actions[t] = actions
+            self.rews[t] = rews
+            self.dones[t] = dones
+            self.values[t] = actor_infos["values"]
+            self.log_probs[t] = actor_infos["log_probs"]
+            self.step_idx += 1
 
-        if len(self.data_list) > self.num_steps:
+        np.copyto(self.last_observation, obss)
+        self.has_last = True
 
-            self.on_generate(transition)
-            self.data_list = []
+    def _generate(self, last_values):
+        compute_gae(self.rews, self.dones, self.values, np.asarray(last_values, dtype=np.float32), self.gamma, self.gae_lambda, self.advantages)
+        np.add(self.advantages, self.values, out=self.returns)
+        segment = [self.obs, self.actions, self.values, self.advantages, self.returns, self.log_probs]
+        if self.with_env_idxs:
+            self.on_generate(segment, np.arange(self.num_envs))
+        else:
+            self.on_generate(segment)
+        self.step_idx = 0
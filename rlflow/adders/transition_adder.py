@@ -5,6 +5,8 @@ class TransitionAdder:
     def __init__(self, observation_space, action_space):
         self.last_observation = None
         self.on_generate = None
+        self.with_env_idxs = False
+        self.spaces = (observation_space, action_space)
         self.observation_space = SpaceWrapper(observation_space)
         self.action_space = SpaceWrapper(action_space)
 
@@ -17,9 +19,13 @@ class TransitionAdder:
             self.observation_space
         )
 
-    def set_generate_callback(self, on_generate):
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
         assert self.on_generate is None, "set_generate_callback should only be called once"
         self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+
+    def vectorized(self, num_envs, terminal_obs=None):
+        return VectorTransitionAdder(num_envs, *self.spaces, terminal_obs=terminal_obs)
 
     def add(self, obs, action, rew, done, info, actor_info):
         assert self.on_generate is not None, "need to call set_generate_callback before add"
@@ -28,5 +34,67 @@ class TransitionAdder:
             self.last_observation = obs
         else:
             transition = (obs, action, rew, done, self.last_observation)
-            self.on_generate(transition)
+            if self.with_env_idxs:
+                self.on_generate(transition, 0)
+            else:
+                self.on_generate(transition)
             self.last_observation = None if done else obs
+
+class VectorTransitionAdder:
+    '''
+    TransitionAdder for num_envs environments at once, see GymVectorBaseAdder
+
+    If the terminal_obs buffer of the vector environment is given, the
+    transitions that end an episode get their terminal observation, and
+    the first step of the next episode is not dropped.
+    '''
+    def __init__(self, num_envs, observation_space, action_space, terminal_obs=None):
+        self.on_generate = None
+        self.with_env_idxs = False
+        self.terminal_obs = terminal_obs
+        self.observation_space = SpaceWrapper(observation_space)
+        self.action_space = SpaceWrapper(action_space)
+        self.last_observation = np.zeros((num_envs,)+tuple(self.observation_space.shape), dtype=self.observation_space.dtype)
+        self.has_last = np.zeros(num_envs, dtype=bool)
+
+    def get_example_output(self):
+        return (
+            self.observation_space,
+            self.action_space,
+            np.array(0,dtype=np.float32),
+            np.array(0,dtype=np.uint8),
+            self.observation_space
+        )
+
+    def set_generate_callback(self, on_generate, with_env_idxs=False):
+        assert self.on_generate is None, "set_generate_callback should only be called once"
+        self.on_generate = on_generate
+        self.with_env_idxs = with_env_idxs
+
+    def add(self, obss, actions, rews, dones, infos, actor_infos):
+        assert self.on_generate is not None, "need to call set_generate_callback before add"
+        stepped = np.flatnonzero(self.has_last)
+        dones = np.asarray(dones, dtype=bool)
+        if len(stepped):
+            new_obss = np.asarray(obss)[stepped]
+            if self.terminal_obs is not None:
+                ended = dones[stepped]
+                new_obss[ended] = self.terminal_obs[stepped[ended]]
+            batch = [
+                new_obss,
+                np.asarray(actions)[stepped],
+                np.asarray(rews, dtype=np.float32)[stepped],
+                np.asarray(dones, dtype=np.uint8)[stepped],
+                self.last_observation[stepped],
+            ]
+            if self.with_env_idxs:
+                self.on_generate(batch, stepped)
+            else:
+                self.on_generate(batch)
+        np.copyto(self.last_observation, obss)
+        if self.terminal_obs is not None:
+            # obss already starts the next episode for done envs
+            self.has_last[:] = True
+        else:
+            # like TransitionAdder, the first observation of an env is kept even if it comes with a done
+            self.has_last = ~(self.has_last & dones)
@@ -1,29 +1,125 @@
 import multiprocessing as mp
 import queue
 from rlflow.utils.shared_mem_pipe import SharedMemPipe, expand_example
+from rlflow.utils.shared_array import SharedArray
+from rlflow.data_store import mmap_storage
 import numpy as np
 
+GENERATION_SHIFT = 32
+SLOT_MASK = (1 << GENERATION_SHIFT) - 1
+
+def tag_ids(ids, generations):
+    '''
+    packs the generation of each slot into the high bits of its id,
+    so sampled ids can be checked for staleness when they come back
+    '''
+    return (np.asarray(generations, dtype=np.int64) << GENERATION_SHIFT) | ids
+
+def untag_ids(tagged_ids):
+    tagged_ids = np.asarray(tagged_ids, dtype=np.int64)
+    return tagged_ids & SLOT_MASK, tagged_ids >> GENERATION_SHIFT
+
+def env_idx_example(transition_example):
+    '''
+    example of entries of a new entries pipe shared by several envs:
+    the transition followed by the index of its env
+    '''
+    return list(transition_example) + [np.array(0, dtype=np.int64)]
+
+def split_entries(transition_example, entries, pipe_idx):
+    '''
+    splits entries drained from a new entries pipe into (transitions, env_idxs).
+    Entries without an env index (see env_idx_example) come from a pipe of a
+    single env, and get the index of their pipe.
+    '''
+    if len(entries) > len(transition_example):
+        return entries[:-1], entries[-1]
+    return entries, np.full(len(entries[0]), pipe_idx, dtype=np.int64)
+
+class SharedDataGatherer:
+    '''
+    Gathers batches out of the shared memory transition data of a
+    DataManager. Can be handed to other processes when they are started,
+    so that they can build batches in parallel to the DataManager.
+
+    The DataManager keeps refilling slots while they are gathered. It bumps
+    the generation of a slot before writing to it, so a gather that
+    overlapped a refill finds a different generation afterwards.
+    '''
+    def __init__(self, shared_data, shared_generations):
+        self.shared_data = shared_data
+        self.shared_generations = shared_generations
+
+    def gather(self, tagged_ids, outs):
+        '''
+        gathers the rows of ids tagged by sample_idxs into outs, returns
+        False if any of the slots was refilled since it was sampled, in which
+        case outs may hold torn or replaced rows and have to be dropped
+        '''
+        idxs, generations = untag_ids(tagged_ids)
+        for source, out in zip(self.shared_data, outs):
+            np.take(source.np_arr, idxs, axis=0, out=out)
+        return np.array_equal(self.shared_generations.np_arr[idxs], generations)
+
 class DataManager:
-    def __init__(self, new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries):
+    def __init__(self, new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries, storage_folder=None, shared_memory=False):
+        '''
+        args:
+          storage_folder: if set, transition data is kept in memory mapped
+            files in this folder instead of in RAM, and the buffer
+            (along with the scheme state saved by checkpoint) is reloaded
+            from it if it already exists
+          shared_memory: if set, transition data is kept in shared memory,
+            and gatherer() can be used to build batches in other processes
+        '''
         self.removal_scheme = removal_scheme
         self.sample_scheme = sample_scheme
         self.max_entries = max_entries
         self.transition_example = transition_example
         self.new_entries_pipes = new_entries_pipes
         self.init_add_idx = 0
+        self.storage_folder = storage_folder
+        self.shared_data = None
+        self.shared_generations = None
 
-        self.data = []
         for arr in transition_example:
             assert np.issubdtype(arr.dtype, np.number) or np.issubdtype(arr.dtype, np.uint8), "dtype of transition must be a number or bool, something wrong in adder or environment"
-            data_entry = np.empty((self.max_entries,)+arr.shape,dtype=arr.dtype)
-            self.data.append(data_entry)
+
+        assert storage_folder is None or not shared_memory, "storage_folder and shared_memory cannot be used together"
+        # bumped every time before a slot is filled, sampled ids are tagged with it
+        if shared_memory:
+            self.shared_generations = SharedArray((max_entries,), dtype=np.int64)
+            self.generations = self.shared_generations.np_arr
+            self.generations[:] = 0
+        else:
+            self.generations = np.zeros(max_entries, dtype=np.int64)
+
+        if shared_memory:
+            self.shared_data = [SharedArray((self.max_entries,)+tuple(arr.shape),dtype=arr.dtype) for arr in transition_example]
+            self.data = [shared.np_arr for shared in self.shared_data]
+        elif storage_folder is None:
+            self.data = [np.empty((self.max_entries,)+arr.shape,dtype=arr.dtype) for arr in transition_example]
+        else:
+            self.data = mmap_storage.open_field_arrays(storage_folder, transition_example, max_entries)
+            state = mmap_storage.load_state(storage_folder)
+            if state is not None:
+                self.set_state(state)
 
     def receive_new_entries(self):
-        for new_entry_pipes in self.new_entries_pipes:
-            add_data = new_entry_pipes.get()
+        new_entries = []
+        new_env_idxs = []
+        for pipe_idx, new_entry_pipes in enumerate(self.new_entries_pipes):
+            add_data = new_entry_pipes.drain()
 
             if add_data is not None:
-                self.add_data(add_data)
+                transitions, env_idxs = split_entries(self.transition_example, add_data, pipe_idx)
+                new_entries.append(transitions)
+                new_env_idxs.append(env_idxs)
+
+        if len(new_entries) == 1:
+            self.add_batch(new_entries[0], new_env_idxs[0])
+        elif new_entries:
+            self.add_batch([np.concatenate(field) for field in zip(*new_entries)], np.concatenate(new_env_idxs))
 
     def add_data(self, add_data):
         if self.init_add_idx < self.max_entries:
@@ -38,19 +134,112 @@ class DataManager:
 
         self.sample_scheme.add(new_id)
         self.removal_scheme.add(new_id)
+        self.generations[new_id] += 1
         self._add_item(new_id, add_data)
 
-    def sample_data(self, batch_size):
+    def add_batch(self, transitions, env_idxs=None):
+        '''
+        args:
+          transitions: list of arrays, one per transition field, each stacked
+            along a leading batch dimension
+          env_idxs: index of the env of each transition, only needed by
+            FrameDedupDataManager, which chains the transitions of each env
+        '''
+        batch_size = len(transitions[0])
+        assert all(len(field) == batch_size for field in transitions), "all transition fields must have the same batch size"
+        if batch_size > self.max_entries:
+            # only the newest entries would survive the insert anyway
+            transitions = [field[-self.max_entries:] for field in transitions]
+            batch_size = self.max_entries
+        if batch_size == 0:
+            return
+
+        num_init = min(batch_size, self.max_entries - self.init_add_idx)
+        init_ids = np.arange(self.init_add_idx, self.init_add_idx+num_init, dtype=np.int64)
+        self.init_add_idx += num_init
+
+        num_evict = batch_size - num_init
+        if num_evict > 0:
+            remove_vals,rm_weights = self.removal_scheme.sample(num_evict)
+            assert remove_vals is not None, "tried to remove item and could not, something is wrong with removal scheme or replay buffer size is too small"
+            remove_vals = np.asarray(remove_vals, dtype=np.int64)
+            self.removal_scheme.remove_many(remove_vals)
+            self.sample_scheme.remove_many(remove_vals)
+            new_ids = np.concatenate([init_ids, remove_vals])
+        else:
+            new_ids = init_ids
+
+        self.sample_scheme.add_many(new_ids)
+        self.removal_scheme.add_many(new_ids)
+        self.generations[new_ids] += 1
+        self._add_items(new_ids, transitions)
+
+    def get_state(self):
+        state = {"init_add_idx": np.array(self.init_add_idx), "generations": self.generations}
+        state.update(mmap_storage.prefix_state("removal_", self.removal_scheme.get_state()))
+        state.update(mmap_storage.prefix_state("sample_", self.sample_scheme.get_state()))
+        return state
+
+    def set_state(self, state):
+        self.init_add_idx = int(state["init_add_idx"])
+        np.copyto(self.generations, state["generations"])
+        self.removal_scheme.set_state(mmap_storage.unprefix_state("removal_", state))
+        self.sample_scheme.set_state(mmap_storage.unprefix_state("sample_", state))
+
+    def checkpoint(self):
+        '''
+        flushes the memory mapped data and saves the scheme state
+        so that the buffer can be reopened after a restart
+        '''
+        assert self.storage_folder is not None, "checkpoint needs DataManager to be created with a storage_folder"
+        for data in self.data:
+            data.flush()
+        mmap_storage.save_state(self.storage_folder, self.get_state())
+
+    def gatherer(self):
+        assert self.shared_data is not None, "gatherer needs DataManager to be created with shared_memory=True"
+        return SharedDataGatherer(self.shared_data, self.shared_generations)
+
+    def sample_idxs(self, batch_size):
+        '''
+        returns ids tagged with the generation of their slot, see tag_ids
+        '''
         sample_idxs, sample_weights = self.sample_scheme.sample(batch_size)
+        if sample_idxs is None:
+            return None, None
+        sample_idxs = np.asarray(sample_idxs, dtype=np.int64)
+        return tag_ids(sample_idxs, self.generations[sample_idxs]), sample_weights
+
+    def update_priorities(self, tagged_ids, priorities):
+        '''
+        passes priorities of sampled ids on to the schemes, dropping
+        ids whose slot was refilled after they were sampled
+        '''
+        ids, generations = untag_ids(tagged_ids)
+        fresh = self.generations[ids] == generations
+        if not np.all(fresh):
+            ids = ids[fresh]
+            priorities = np.asarray(priorities)[fresh]
+        if len(ids) == 0:
+            return
+        self.sample_scheme.update_priorities(ids, priorities)
+        self.removal_scheme.update_priorities(ids, priorities)
+
+    def sample_data(self, batch_size):
+        sample_idxs, sample_weights = self.sample_idxs(batch_size)
         if sample_idxs is None:
             return None, None, None
         else:
-            return sample_idxs, sample_weights, self._get_data(sample_idxs)
+            return sample_idxs, sample_weights, self._get_data(untag_ids(sample_idxs)[0])
 
     def _add_item(self, id, transition):
         for data,trans in zip(self.data,transition):
             data[id] = trans
 
+    def _add_items(self, ids, transitions):
+        for data,trans in zip(self.data,transitions):
+            data[ids] = trans
+
     def _get_data(self, idxs):
         idxs = np.asarray(idxs,dtype=np.int64)
         result = []
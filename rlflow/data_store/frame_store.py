@@ -0,0 +1,233 @@
+import numpy as np
+from rlflow.data_store.data_store import DataManager
+
+class FrameDedupDataManager(DataManager):
+    '''
+    DataManager for TransitionAdder style transitions,
+    (obs, action, rew, done, last_observation), which keeps every
+    observation frame only once.
+
+    Frames live in a reference counted frame pool. A transition stores a
+    row of frame slots for each of its two observations, and the
+    last_observation of a transition shares its slots with the obs of the
+    previous transition from the same env. With frame_stack > 1, the
+    observation is assumed to be stacked along its first axis, and
+    neighbouring observations share all but their newest frame. The
+    stacked (obs, last_observation) pairs are rebuilt at sample time.
+
+    If the frame pool fills up (many short episodes), the oldest
+    transitions are evicted early through the removal scheme. A pool that
+    is sized automatically also grows when more envs show up than there
+    are new entries pipes (e.g. a pipe with the transitions of many envs,
+    see env_idx_example).
+    '''
+    def __init__(self, new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries, storage_folder=None, shared_memory=False, frame_stack=1, frame_capacity=None, obs_idx=0, last_obs_idx=4):
+        assert storage_folder is None, "FrameDedupDataManager does not support a storage_folder"
+        assert not shared_memory, "FrameDedupDataManager does not support shared_memory"
+        super().__init__(new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries)
+        # the observations live in the frame pool instead (the pages of
+        # their np.empty arrays were never touched, so they cost nothing)
+        self.data[obs_idx] = None
+        self.data[last_obs_idx] = None
+        self.free_ids = []
+
+        obs_example = transition_example[obs_idx]
+        assert tuple(obs_example.shape) == tuple(transition_example[last_obs_idx].shape), "obs and last observation must have the same shape"
+        assert frame_stack == 1 or obs_example.shape[0] == frame_stack, "stacked observations need the frames along their first axis"
+        self.obs_idx = obs_idx
+        self.last_obs_idx = last_obs_idx
+        self.obs_shape = tuple(obs_example.shape)
+        self.frame_stack = frame_stack
+        frame_shape = self.obs_shape[1:] if frame_stack > 1 else self.obs_shape
+
+        num_envs = max(1, len(new_entries_pipes))
+        # number of envs the pool has room for, None if its size is fixed
+        self.num_reserved_envs = None
+        if frame_capacity is None:
+            frame_capacity = max_entries + max_entries // 4 + 2 * frame_stack * num_envs
+            self.num_reserved_envs = num_envs
+        assert frame_capacity >= 4 * frame_stack, "frame_capacity too small to hold a single transition"
+        self.frames = np.empty((frame_capacity,)+frame_shape, dtype=obs_example.dtype)
+        self.frame_refs = np.zeros(frame_capacity, dtype=np.int32)
+        self.free_frames = np.arange(frame_capacity, dtype=np.int64)[::-1].copy()
+        self.num_free_frames = frame_capacity
+        # frame slots of the (obs, last_observation) of every stored transition
+        self.obs_slots = np.zeros((max_entries, 2, frame_stack), dtype=np.int64)
+        # frame slots of the latest observation of each env, by env index
+        self.env_rows = np.zeros((num_envs, frame_stack), dtype=np.int64)
+        self.env_has_row = np.zeros(num_envs, dtype=bool)
+
+    def add_batch(self, transitions, env_idxs=None):
+        '''
+        frames have to be chained per env, so the transitions are added in
+        steps of at most one transition per env, each step for all of its
+        envs at once
+        '''
+        batch_size = len(transitions[0])
+        assert all(len(field) == batch_size for field in transitions), "all transition fields must have the same batch size"
+        if env_idxs is None:
+            env_idxs = np.zeros(batch_size, dtype=np.int64)
+        env_idxs = np.asarray(env_idxs, dtype=np.int64)
+        if batch_size > self.max_entries:
+            # only the newest entries would survive the insert anyway
+            transitions = [field[-self.max_entries:] for field in transitions]
+            env_idxs = env_idxs[-self.max_entries:]
+            batch_size = self.max_entries
+        if batch_size == 0:
+            return
+        self._ensure_env_rows(int(env_idxs.max())+1)
+
+        new_ids = self._new_ids(batch_size)
+        # the step of each transition is its position among the transitions of its env
+        order = np.argsort(env_idxs, kind='stable')
+        sorted_envs = env_idxs[order]
+        env_starts = np.flatnonzero(np.concatenate([[True], sorted_envs[1:] != sorted_envs[:-1]]))
+        env_counts = np.diff(np.append(env_starts, batch_size))
+        steps = np.empty(batch_size, dtype=np.int64)
+        steps[order] = np.arange(batch_size) - np.repeat(env_starts, env_counts)
+
+        obss = np.asarray(transitions[self.obs_idx])
+        last_obss = np.asarray(transitions[self.last_obs_idx])
+        for step in range(int(env_counts.max())):
+            batch_idxs = np.flatnonzero(steps == step)
+            obs_rows, last_rows = self._add_frames(env_idxs[batch_idxs], obss[batch_idxs], last_obss[batch_idxs])
+            self.obs_slots[new_ids[batch_idxs],0] = obs_rows
+            self.obs_slots[new_ids[batch_idxs],1] = last_rows
+
+        self.sample_scheme.add_many(new_ids)
+        self.removal_scheme.add_many(new_ids)
+        self.generations[new_ids] += 1
+        self._add_items(new_ids, transitions)
+
+    def add_data(self, add_data, env_idx=0):
+        self.add_batch([np.asarray(field)[None] for field in add_data], np.array([env_idx], dtype=np.int64))
+
+    def _add_frames(self, env_idxs, obss, last_obss):
+        '''
+        stores the frames of one transition of each of the (distinct) envs,
+        returns the frame slots of their (obs, last_observation), with one
+        reference taken on each
+        '''
+        num_envs = len(env_idxs)
+        frame_shape = self.frames.shape[1:]
+        batch_axes = tuple(range(1, obss.ndim))
+        env_rows = self.env_rows[env_idxs]
+        has_row = self.env_has_row[env_idxs]
+        # the env's reference to the frames of its latest observation is
+        # handed over to the transition that continues from it
+        linked = has_row & np.all(self._gather(env_rows) == last_obss, axis=batch_axes)
+        if np.any(has_row & ~linked):
+            self._release(env_rows[has_row & ~linked].ravel())
+        if self.frame_stack > 1:
+            # obs only adds a frame to its last observation
+            shifted = np.all(obss[:,:-1] == last_obss[:,1:], axis=batch_axes)
+        else:
+            shifted = np.zeros(num_envs, dtype=bool)
+
+        num_unlinked = np.count_nonzero(~linked)
+        num_shifted = np.count_nonzero(shifted)
+        num_last_frames = num_unlinked * self.frame_stack
+        slots = self._alloc_frames(num_last_frames + num_shifted + (num_envs - num_shifted) * self.frame_stack)
+
+        last_rows = env_rows
+        new_last_rows = slots[:num_last_frames].reshape(num_unlinked, self.frame_stack)
+        last_rows[~linked] = new_last_rows
+        self.frames[new_last_rows.ravel()] = np.reshape(last_obss[~linked], (-1,)+frame_shape)
+
+        obs_rows = np.empty_like(last_rows)
+        if num_shifted:
+            new_frames = slots[num_last_frames:num_last_frames+num_shifted]
+            kept_slots = last_rows[shifted,1:]
+            self.frame_refs[kept_slots] += 1
+            obs_rows[shifted] = np.concatenate([kept_slots, new_frames[:,None]], axis=1)
+            self.frames[new_frames] = obss[shifted,-1]
+        new_obs_rows = slots[num_last_frames+num_shifted:].reshape(-1, self.frame_stack)
+        obs_rows[~shifted] = new_obs_rows
+        self.frames[new_obs_rows.ravel()] = np.reshape(obss[~shifted], (-1,)+frame_shape)
+
+        self.frame_refs[obs_rows] += 1
+        self.env_rows[env_idxs] = obs_rows
+        self.env_has_row[env_idxs] = True
+        return obs_rows, last_rows
+
+    def _ensure_env_rows(self, num_envs):
+        if num_envs > len(self.env_rows):
+            extra = num_envs - len(self.env_rows)
+            self.env_rows = np.concatenate([self.env_rows, np.zeros((extra, self.frame_stack), dtype=np.int64)])
+            self.env_has_row = np.concatenate([self.env_has_row, np.zeros(extra, dtype=bool)])
+
+    def num_stored_frames(self):
+        return len(self.frames) - self.num_free_frames
+
+    def _new_ids(self, num_ids):
+        num_reused = min(num_ids, len(self.free_ids))
+        reused_ids = self.free_ids[len(self.free_ids)-num_reused:]
+        del self.free_ids[len(self.free_ids)-num_reused:]
+        num_init = min(num_ids - num_reused, self.max_entries - self.init_add_idx)
+        init_ids = np.arange(self.init_add_idx, self.init_add_idx+num_init, dtype=np.int64)
+        self.init_add_idx += num_init
+        num_evict = num_ids - num_reused - num_init
+        evicted_ids = self._evict(num_evict, reuse_ids=False) if num_evict else np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.array(reused_ids, dtype=np.int64), init_ids, evicted_ids])
+
+    def _evict(self, num_evict, reuse_ids=True):
+        remove_vals,rm_weights = self.removal_scheme.sample(num_evict)
+        assert remove_vals is not None, "tried to remove item and could not, something is wrong with removal scheme or frame_capacity is too small"
+        remove_vals = np.asarray(remove_vals, dtype=np.int64)
+        self.removal_scheme.remove_many(remove_vals)
+        self.sample_scheme.remove_many(remove_vals)
+        self._release(self.obs_slots[remove_vals].ravel())
+        if reuse_ids:
+            self.free_ids.extend(remove_vals.tolist())
+        return remove_vals
+
+    def _release(self, slots):
+        np.subtract.at(self.frame_refs, slots, 1)
+        slots = np.unique(slots)
+        freed = slots[self.frame_refs[slots] == 0]
+        self.free_frames[self.num_free_frames:self.num_free_frames+len(freed)] = freed
+        self.num_free_frames += len(freed)
+
+    def _alloc_frames(self, num_frames):
+        num_active_envs = np.count_nonzero(self.env_has_row)
+        if self.num_free_frames < num_frames and self.num_reserved_envs is not None and num_active_envs > self.num_reserved_envs:
+            # room for the latest observation of each env, rather than evicting for it
+            self._grow_frames(2 * num_active_envs)
+        while self.num_free_frames < num_frames:
+            self._evict(1)
+        self.num_free_frames -= num_frames
+        slots = self.free_frames[self.num_free_frames:self.num_free_frames+num_frames].copy()
+        self.frame_refs[slots] = 1
+        return slots
+
+    def _grow_frames(self, num_envs):
+        extra = 2 * self.frame_stack * (num_envs - self.num_reserved_envs)
+        old_capacity = len(self.frames)
+        self.frames = np.concatenate([self.frames, np.empty((extra,)+self.frames.shape[1:], dtype=self.frames.dtype)])
+        self.frame_refs = np.concatenate([self.frame_refs, np.zeros(extra, dtype=np.int32)])
+        free_frames = np.empty(old_capacity + extra, dtype=np.int64)
+        free_frames[:self.num_free_frames] = self.free_frames[:self.num_free_frames]
+        free_frames[self.num_free_frames:self.num_free_frames+extra] = np.arange(old_capacity, old_capacity+extra)[::-1]
+        self.free_frames = free_frames
+        self.num_free_frames += extra
+        self.num_reserved_envs = num_envs
+
+    def _gather(self, rows):
+        return self.frames[rows].reshape((len(rows),)+self.obs_shape)
+
+    def _add_items(self, ids, transitions):
+        for data,trans in zip(self.data,transitions):
+            if data is not None:
+                data[ids] = trans
+
+    def _get_data(self, idxs):
+        idxs = np.asarray(idxs,dtype=np.int64)
+        result = []
+        for i, source in enumerate(self.data):
+            if i == self.obs_idx:
+                result.append(self._gather(self.obs_slots[idxs,0]))
+            elif i == self.last_obs_idx:
+                result.append(self._gather(self.obs_slots[idxs,1]))
+            else:
+                result.append(source[idxs])
+        return result
@@ -0,0 +1,46 @@
+import numpy as np
+import os
+
+STATE_FNAME = "state.npz"
+
+def field_fname(folder, idx):
+    return os.path.join(folder, f"{idx:06}.npy")
+
+def open_field_arrays(folder, transition_example, max_entries):
+    '''
+    Opens one memory mapped .npy file per transition field in folder,
+    creating them if they do not exist yet. The .npy header records the
+    shape and dtype, so reopening with a different layout is caught here.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    arrays = []
+    for i, arr in enumerate(transition_example):
+        shape = (max_entries,)+tuple(arr.shape)
+        dtype = np.dtype(arr.dtype)
+        fname = field_fname(folder, i)
+        if os.path.exists(fname):
+            data_entry = np.load(fname, mmap_mode='r+', allow_pickle=False)
+            assert data_entry.shape == shape and data_entry.dtype == dtype, f"replay buffer file '{fname}' stores {data_entry.dtype}{data_entry.shape}, expected {dtype}{shape}"
+        else:
+            data_entry = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape)
+        arrays.append(data_entry)
+    return arrays
+
+def save_state(folder, state):
+    # write to a temporary file first so a crash never leaves a half written state
+    tmp_fname = os.path.join(folder, "state_tmp.npz")
+    np.savez(tmp_fname, **state)
+    os.replace(tmp_fname, os.path.join(folder, STATE_FNAME))
+
+def load_state(folder):
+    fname = os.path.join(folder, STATE_FNAME)
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname, allow_pickle=False) as state:
+        return {key: state[key] for key in state.files}
+
+def prefix_state(prefix, state):
+    return {prefix+key: val for key, val in state.items()}
+
+def unprefix_state(prefix, state):
+    return {key[len(prefix):]: val for key, val in state.items() if key.startswith(prefix)}
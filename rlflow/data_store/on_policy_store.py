@@ -0,0 +1,45 @@
+import numpy as np
+
+class OnPolicyDataStore:
+    '''
+    Holds a single segment of on-policy data, as generated by
+    OnPolicyAdder, until it has been learned on. There is no replay:
+    a segment is consumed by iterating over minibatches() once, after
+    which the next segment can be added.
+    '''
+    def __init__(self, transition_example, segment_size, seed=None):
+        for arr in transition_example:
+            assert np.issubdtype(arr.dtype, np.number) or np.issubdtype(arr.dtype, np.uint8), "dtype of transition must be a number or bool, something wrong in adder or environment"
+        self.segment_size = segment_size
+        self.data = [np.empty((segment_size,)+tuple(arr.shape),dtype=arr.dtype) for arr in transition_example]
+        self.np_random = np.random.RandomState(seed)
+        self.full = False
+
+    def can_add(self):
+        return not self.full
+
+    def add_segment(self, segment):
+        '''
+        args:
+          segment: list of arrays, one per transition field, with
+            segment_size entries in their leading dimensions,
+            (num_steps, num_envs) arrays are flattened
+        '''
+        assert not self.full, "previous segment has not been consumed yet"
+        for data, field in zip(self.data, segment):
+            np.copyto(data, np.reshape(field, data.shape))
+        self.full = True
+
+    def minibatches(self, batch_size, num_epochs=1):
+        '''
+        yields random minibatches covering the whole segment once per epoch,
+        then frees the store for the next segment.
+        '''
+        assert self.full, "no segment to learn on"
+        assert self.segment_size % batch_size == 0, "batch_size has to divide the segment size"
+        for epoch in range(num_epochs):
+            order = self.np_random.permutation(self.segment_size)
+            for start in range(0, self.segment_size, batch_size):
+                idxs = order[start:start+batch_size]
+                yield [data[idxs] for data in self.data]
+        self.full = False
@@ -1,13 +1,15 @@
 import numpy as np
 from rlflow.data_store.data_store import DataManager
-from rlflow.selectors.fifo import FifoScheme
+from rlflow.selectors.fifo import RingFifoScheme
 import multiprocessing as mp
 import queue
 from rlflow.adders.logger_adder import LoggerAdder
+from rlflow.adders.gym_adder import add_with_terminal_obs
 from rlflow.utils.shared_mem_pipe import SharedMemPipe, expand_example
 from rlflow.selectors.priority_updater import priority_pipe_example, PriorityUpdater, NoUpdater
 import time
 from ..utils.shared_array import SharedArray
+from ..utils.control_block import ControlBlock
 from ..utils.space_wrapper import SpaceWrapper
 import multiprocessing as mp
 import numpy as np
@@ -60,10 +62,18 @@ class BatchActor:
 
             return self.step_wait(idx)
 
-def async_env_loop(env_constr, env_ids, instr_pipe, shared_readys, shared_obs, shared_rews, shared_dones):
+def async_env_loop(env_constr, env_ids, instr_pipe, control, shared_obs, shared_rews, shared_dones, shared_terminal_obs, proc_idx, placement):
     try:
+        if placement is not None:
+            placement.pin_worker(proc_idx)
         envs = {id: env_constr() for id in env_ids}
         envs_per_id = list(envs.values())[0].num_envs
+        if placement is not None:
+            env_slice = slice(env_ids[0]*envs_per_id, (env_ids[-1]+1)*envs_per_id)
+            placement.first_touch((shared_obs, shared_rews, shared_dones, shared_terminal_obs), env_slice)
+        for id, env in envs.items():
+            # the envs write the observations that end their episodes straight into shared memory
+            env.terminal_obs = shared_terminal_obs.np_arr[id*envs_per_id:(id+1)*envs_per_id]
 
         while True:
             instr,id,actions = instr_pipe.recv()
@@ -74,7 +84,7 @@ def async_env_loop(env_constr, env_ids, instr_pipe, shared_readys, shared_obs, s
                 shared_obs.np_arr[env_start_idx:env_end_idx] = obs
                 shared_dones.np_arr[env_start_idx:env_end_idx] = False
                 shared_rews.np_arr[env_start_idx:env_end_idx] = 0.
-                shared_readys.np_arr[id] = True
+                control.finish(id)
             elif instr == "step":
                 env_start_idx = id*envs_per_id
                 env_end_idx = (id+1)*envs_per_id
@@ -82,13 +92,16 @@ def async_env_loop(env_constr, env_ids, instr_pipe, shared_readys, shared_obs, s
                 shared_obs.np_arr[env_start_idx:env_end_idx] = observations
                 shared_dones.np_arr[env_start_idx:env_end_idx] = dones
                 shared_rews.np_arr[env_start_idx:env_end_idx] = rewards
-                shared_readys.np_arr[id] = True
+                control.finish(id)
             elif instr == "terminate":
                 return
             #pipe.send(comp_infos)
     except BaseException as e:
         tb = traceback.format_exc()
         instr_pipe.send((e,tb))
+        # the error is picked up by whichever of the ids is waited on
+        for id in env_ids:
+            control.finish(id, has_info=True)
 
 def alloc_envs_to_cpus(num_fns, max_num_cpus):
     envs_per_cpu = (num_fns+max_num_cpus-1)// max_num_cpus
@@ -106,7 +119,7 @@ def alloc_envs_to_cpus(num_fns, max_num_cpus):
 
 
 class AsyncMultiEnv:
-    def __init__(self, env_fn, num_ids, num_procs=None):
+    def __init__(self, env_fn, num_ids, num_procs=None, placement=None):
         env = env_fn()
         envs_per_id = env.num_envs
         # if getattr(env, "num_envs", None) is None:
@@ -121,11 +134,18 @@ class AsyncMultiEnv:
         num_procs = min(num_ids, num_procs)
 
         self.num_envs = num_envs = envs_per_id * num_ids
-        self.shared_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
-        self.shared_rews = SharedArray((num_envs,), dtype=np.float32)
-        self.shared_dones = SharedArray((num_envs,), dtype=np.uint8)
-        self.shared_readys = SharedArray((num_ids,), dtype=np.uint8)
+        # with a placement, each process pins itself and allocates its part of these
+        first_touch = placement is not None
+        self.shared_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype, first_touch=first_touch)
+        self.shared_rews = SharedArray((num_envs,), dtype=np.float32, first_touch=first_touch)
+        self.shared_dones = SharedArray((num_envs,), dtype=np.uint8, first_touch=first_touch)
+        self.shared_terminal_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype, first_touch=first_touch)
+        self.terminal_obs = self.shared_terminal_obs.np_arr
+        # one row per id, the commands themselves go over the pipes with their actions
+        self.control = ControlBlock(num_ids)
         self.collected = [False]*num_ids
+        # ids with a reset or step whose ready semaphore has not been acquired yet
+        self.waiting = [False]*num_ids
 
         self.env_cpu_div = env_cpu_div = alloc_envs_to_cpus(num_ids, num_procs)
 
@@ -133,18 +153,19 @@ class AsyncMultiEnv:
         procs = []
         for i in range(num_procs):
             inpt,outpt = mp.Pipe()
-            proc = mp.Process(target=async_env_loop, args=(env_fn, env_cpu_div[i], outpt, self.shared_readys, self.shared_obs, self.shared_rews, self.shared_dones))
+            proc = mp.Process(target=async_env_loop, args=(env_fn, env_cpu_div[i], outpt, self.control, self.shared_obs, self.shared_rews, self.shared_dones, self.shared_terminal_obs, i, placement))
             proc.start()
             pipes.append(inpt)
             procs.append(proc)
         idx_cpu = {id:cpu for cpu in range(num_procs) for id in env_cpu_div[cpu]}
         self.pipe_map = {id:pipes[idx_cpu[id]] for id in range(num_ids)}
+        self.proc_map = {id:procs[idx_cpu[id]] for id in range(num_ids)}
         self.pipes = pipes
         self.procs = procs
 
     def reset_all_async(self):
         for id in range(self.num_ids):
-            self.reset_async(id)
+            self.reset_async_id(id)
 
     def check_error(self, id):
         pipe = self.pipe_map[id]
@@ -154,21 +175,30 @@ class AsyncMultiEnv:
             raise e
 
     def reset_async_id(self, id):
-        self.check_error(id)
-        pipe = self.pipe_map[id]
-        self.collected[id] = False
-        self.shared_readys.np_arr[id] = False
-        pipe.send(("reset",id,None))
+        self._send(id, ("reset",id,None))
 
     def ready(self, id):
-        return bool(self.shared_readys.np_arr[id])
+        return self.control.is_done(id)
+
+    def _wait_done(self, id):
+        if self.control.wait_done(id, self.proc_map[id]):
+            self.check_error(id)
+        self.waiting[id] = False
+
+    def wait_any(self, ids, timeout=None):
+        '''
+        blocks until at least one of the ids is done stepping or resetting,
+        and returns all of them that are, or an empty list if the timeout
+        runs out first. Ids that are not stepping are ignored.
+        '''
+        ids = [id for id in ids if self.waiting[id]]
+        assert ids, "none of the ids are stepping, waiting on them would never return"
+        return self.control.wait_any(ids, timeout)
 
     def collect_wait_id(self, id):
         assert not self.collected[id]
         self.collected[id] = True
-        while not self.shared_readys.np_arr[id]:
-            pass
-        #self.check_error(id)
+        self._wait_done(id)
         env_start_idx = id*self.envs_per_id
         env_end_idx = (id+1)*self.envs_per_id
         observations = self.shared_obs.np_arr[env_start_idx:env_end_idx]
@@ -177,11 +207,17 @@ class AsyncMultiEnv:
         return observations, rewards, dones
 
     def step_async_id(self, id, actions):
+        self._send(id, ("step",id,actions))
+
+    def _send(self, id, instr):
         self.check_error(id)
+        if self.waiting[id]:
+            # result was never collected, it still has to be waited on
+            self._wait_done(id)
         self.collected[id] = False
-        pipe = self.pipe_map[id]
-        self.shared_readys.np_arr[id] = False
-        pipe.send(("step",id,actions))
+        self.waiting[id] = True
+        self.control.mark_sent(id)
+        self.pipe_map[id].send(instr)
 
     def __del__(self):
         for pipe in self.pipes:
@@ -199,10 +235,33 @@ class AsyncEnv:
         self.envs_per_id = async_multi_env.envs_per_id
         self.id_states = {id:("init",None) for id in range(self.num_ids)}
         self.num_envs = async_multi_env.num_envs
+        # envs are laid out the same way, so an env's terminal observation is at its idx
+        self.terminal_obs = async_multi_env.terminal_obs
 
     def ready(self, idx):
         id = idx // self.envs_per_id
-        return self.async_multi_env(id)
+        return self.async_multi_env.ready(id)
+
+    def wait_any(self, idxs, timeout=None):
+        '''
+        returns the env idxs which can be collected without waiting, blocking
+        until there is at least one, see AsyncMultiEnv.wait_any
+        '''
+        ready_idxs = []
+        id_idxs = {}
+        for idx in idxs:
+            id = idx // self.envs_per_id
+            offset = idx - id * self.envs_per_id
+            state, wait_data = self.id_states[id]
+            if state == "waiting" and wait_data is not None and wait_data[offset] is not None:
+                # the id was already collected for another of its envs
+                ready_idxs.append(idx)
+            else:
+                id_idxs.setdefault(id, []).append(idx)
+        if ready_idxs:
+            return ready_idxs
+        ready_ids = self.async_multi_env.wait_any(list(id_idxs), timeout)
+        return [idx for id in ready_ids for idx in id_idxs[id]]
 
     def reset_all_async(self):
         for idx in range(self.num_envs):
@@ -237,11 +296,12 @@ class AsyncEnv:
         wait_data = self.id_states[id][1]
         if wait_data is None:
             obss, rews, dones = self.async_multi_env.collect_wait_id(id)
-            new_wait_data = [[obss[i], rews[i], dones[i]] for i in range(self.envs_per_id)]
-            self.id_states[id] = ("waiting", new_wait_data)
-            return new_wait_data[offset]
-        else:
-            return wait_data[offset]
+            wait_data = [[obss[i], rews[i], dones[i]] for i in range(self.envs_per_id)]
+            self.id_states[id] = ("waiting", wait_data)
+        result = wait_data[offset]
+        assert result is not None, "env was already collected"
+        wait_data[offset] = None
+        return result
 
 
 
@@ -263,10 +323,16 @@ def run_loop(
         num_env_ids=1,
         num_cpus=1,
         log_callback=noop,
+        data_store_folder=None,
+        data_manager_fn=DataManager,
+        placement=None,
         ):
 
     example_env = environment_fn()
-    multi_env = AsyncEnv(AsyncMultiEnv(environment_fn, num_env_ids, num_cpus))
+    multi_env = AsyncEnv(AsyncMultiEnv(environment_fn, num_env_ids, num_cpus, placement))
+    if placement is not None:
+        # the env processes are already started, so they keep their own cores
+        placement.pin_reserved()
     #vec_env = vec_environment_fn([environment_fn]*n_envs, example_env.observation_space, example_env.action_space)
     num_envs = multi_env.num_envs
     ids_per_env = num_envs // num_env_ids
@@ -277,13 +343,13 @@ def run_loop(
     infos = [{} for _ in range(num_envs)]
 
     transition_example = example_adder.get_example_output()
-    removal_scheme = FifoScheme()
+    removal_scheme = RingFifoScheme(data_store_size)
     sample_scheme = replay_sampler
     new_entry_pipes = [SharedMemPipe(transition_example) for _ in range(num_envs)]
 
     priority_updater.set_data_pipe(SharedMemPipe(priority_pipe_example(batch_size)))
 
-    data_manager = DataManager(new_entry_pipes, transition_example, removal_scheme, sample_scheme, data_store_size)
+    data_manager = data_manager_fn(new_entry_pipes, transition_example, removal_scheme, sample_scheme, data_store_size, data_store_folder)
 
     adders = [adder_fn() for _ in range(num_envs)]
     log_adders = [LoggerAdder() for _ in range(num_envs)]
@@ -307,8 +373,11 @@ def run_loop(
     total_act_steps = 0
 
     env_actor_delay = (num_env_ids//2) * ids_per_env
+    # the action of an env is taken once act_lag more envs have been collected
+    act_lag = (num_envs - env_actor_delay) % num_envs
     actions_taken = [None]*num_envs
-    action_initiated = [False]*num_envs
+    # envs whose observation went to the actor, oldest first
+    action_initiated = []
     # for env_idx in range(env_actor_delay):
     #     obs, rew, done = multi_env.collect_wait_id(env_idx)
     #     actor.step_async(obs, env_idx)
@@ -324,28 +393,32 @@ def run_loop(
 
         cur_act_steps = max(1,batch_size//num_envs)
         for i in range(cur_act_steps):
-            for env_idx in range(num_envs):
-                obs, rew, done = multi_env.collect_wait_id(env_idx)
-
-                start = time.time()
-                actor.step_async(obs, env_idx)
-                end = time.time()
-                action_initiated[env_idx] = True
-                act = actions_taken[env_idx]
-                info = {}
-                adders[env_idx].add(obs,act,rew,done,info)
-                log_adders[env_idx].add(obs,act,rew,done,info)
-
-                act_idx = (env_idx + env_actor_delay) % num_envs
-                if action_initiated[act_idx]:
-                    action = actor.step_wait(act_idx)
-                    actions_taken[act_idx] = action
-                    multi_env.step_async(act_idx, action)
-                    tot_time += end - start
-                    if random.random() < 0.001:
-                        print(tot_time / (time.time() - start_time))
-                        tot_time = 0
-                        start_time = time.time()
+            # envs are collected in the order they finish stepping
+            uncollected = set(range(num_envs))
+            while uncollected:
+                for env_idx in multi_env.wait_any(sorted(uncollected)):
+                    uncollected.remove(env_idx)
+                    obs, rew, done = multi_env.collect_wait_id(env_idx)
+
+                    start = time.time()
+                    actor.step_async(obs, env_idx)
+                    end = time.time()
+                    action_initiated.append(env_idx)
+                    act = actions_taken[env_idx]
+                    info = {}
+                    add_with_terminal_obs(adders[env_idx], multi_env.terminal_obs[env_idx], obs, act, rew, done, info, None)
+                    log_adders[env_idx].add(obs,act,rew,done,info,None)
+
+                    if len(action_initiated) > act_lag:
+                        act_idx = action_initiated.pop(0)
+                        action = actor.step_wait(act_idx)
+                        actions_taken[act_idx] = action
+                        multi_env.step_async(act_idx, action)
+                        tot_time += end - start
+                        if random.random() < 0.001:
+                            print(tot_time / (time.time() - start_time))
+                            tot_time = 0
+                            start_time = time.time()
 
             data_manager.receive_new_entries()
 
@@ -361,8 +434,7 @@ def run_loop(
                 density_result = priority_updater.fetch_densities()
                 if density_result is not None:
                     ids, priorities = density_result
-                    data_manager.sample_scheme.update_priorities(ids, priorities)
-                    data_manager.removal_scheme.update_priorities(ids, priorities)
+                    data_manager.update_priorities(ids, priorities)
 
             if learn_steps >= max_learn_steps:
                 break
@@ -371,5 +443,7 @@ def run_loop(
             logger.dump()
             logger.record("total_act_steps",total_act_steps)
             saver.checkpoint(learner.policy)
+            if data_store_folder is not None:
+                data_manager.checkpoint()
             log_callback(learner)
             prev_time += 1
@@ -1,20 +1,37 @@
 from gym.vector import SyncVectorEnv
 import numpy as np
-from rlflow.data_store.data_store import DataManager
-from rlflow.selectors.fifo import FifoScheme
+from rlflow.data_store.data_store import DataManager, env_idx_example
+from rlflow.selectors.fifo import RingFifoScheme
 import multiprocessing as mp
 import queue
 import traceback
 import time
-from rlflow.utils.shared_mem_pipe import SharedMemPipe, expand_example
-from rlflow.adders.logger_adder import LoggerAdder
+from rlflow.utils.shared_mem_pipe import expand_example
+from rlflow.utils.shared_ring_buffer import SharedRingBuffer
+from rlflow.utils.shared_batch_queue import SharedBatchQueue, lease_any
+from rlflow.adders.logger_adder import VectorLoggerAdder
+from rlflow.adders.gym_adder import vector_adder_fn
 from rlflow.selectors.priority_updater import priority_pipe_example, PriorityUpdater, NoUpdater
 from rlflow.vector import MakeCPUAsyncConstructor
 
-def run_batch_generator(term_event, transition_example, removal_scheme, sample_scheme, max_entries, batch_store, new_entries_pipes, priority_updater, batch_size, logger):
-    data_manager = DataManager(new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries)
+def run_batch_generator(term_event, transition_example, removal_scheme, sample_scheme, max_entries, batch_stores, new_entries_pipes, priority_updater, batch_size, logger, storage_folder, checkpoint_frequency, data_manager_fn, num_sampler_procs, placement):
+    if placement is not None:
+        placement.pin_reserved()
+    data_manager = data_manager_fn(new_entries_pipes, transition_example, removal_scheme, sample_scheme, max_entries, storage_folder, shared_memory=num_sampler_procs > 0)
+    prev_time = time.time()/checkpoint_frequency
+
+    # sampler processes gather the batches out of shared memory, only the sampled ids are built here
+    sample_pipes = [SharedRingBuffer([np.empty(batch_size,dtype=np.int64), np.empty(batch_size,dtype=np.float32)], batch_stores[0].num_slots) for _ in range(num_sampler_procs)]
+    sampler_procs = [mp.Process(target=run_sampler_except,args=(term_event, data_manager.gatherer(), sample_pipe, batch_store)) for sample_pipe, batch_store in zip(sample_pipes, batch_stores)]
+    for proc in sampler_procs:
+        proc.start()
+    sample_count = 0
 
     while not term_event.is_set():
+        if storage_folder is not None and time.time()/checkpoint_frequency > prev_time:
+            data_manager.checkpoint()
+            prev_time += 1
+
         # load data from actors
         data_manager.receive_new_entries()
 
@@ -22,15 +39,48 @@ def run_batch_generator(term_event, transition_example, removal_scheme, sample_s
         density_result = priority_updater.fetch_densities()
         if density_result is not None:
             ids, priorities = density_result
-            data_manager.sample_scheme.update_priorities(ids, priorities)
-            data_manager.removal_scheme.update_priorities(ids, priorities)
-
+            data_manager.update_priorities(ids, priorities)
+
+        if sampler_procs:
+            # hand sampled ids to the sampler processes in turn
+            sample_pipe = sample_pipes[sample_count % num_sampler_procs]
+            if sample_pipe.can_store():
+                batch_idxs, batch_weights = data_manager.sample_idxs(batch_size)
+                if batch_idxs is not None:
+                    sample_pipe.store((batch_idxs, batch_weights))
+                    sample_count += 1
         # store batched samples for learner
-        if batch_store.can_store():
+        elif batch_stores[0].can_store():
             batch_idxs, batch_weights, batch_data = data_manager.sample_data(batch_size)
             if batch_data is not None:
                 store_data = [batch_idxs, batch_weights]+list(batch_data)
-                batch_store.store(store_data)
+                batch_stores[0].store(store_data)
+
+    for proc in sampler_procs:
+        proc.join()
+
+def run_sampler(term_event, gatherer, sample_pipe, batch_store):
+    while not term_event.is_set():
+        sample = sample_pipe.get() if batch_store.can_store() else None
+        if sample is None:
+            time.sleep(0.0001)
+            continue
+
+        batch_idxs, batch_weights = sample
+        store_data = batch_store.next_slot()
+        np.copyto(store_data[0], batch_idxs)
+        np.copyto(store_data[1], batch_weights)
+        # batches with slots refilled while they were gathered are dropped,
+        # the slot is filled again by the next batch
+        if gatherer.gather(batch_idxs, store_data[2:]):
+            batch_store.publish()
+
+def run_sampler_except(term_event, *args):
+    try:
+        run_sampler(term_event, *args)
+    except Exception as e:
+        term_event.set()
+        traceback.print_exc()
 
 def run_actor_except(term_event, *args):
     try:
@@ -48,10 +98,10 @@ def run_worker_except(term_event, *args):
         term_event.set()
         traceback.print_exc()
 
-def run_actor_loop(terminate_event, start_learn_event, actor_fn, adder_fn, log_adder_fn, new_entry_pipes, num_cpus, num_env_ids, policy_delayer, env_fn, logger_pipe, data_store_size, act_steps_until_learn):
+def run_actor_loop(terminate_event, start_learn_event, actor_fn, vec_adder_fn, new_entry_pipe, actor_idx, num_cpus, num_env_ids, policy_delayer, env_fn, logger_pipe, data_store_size, act_steps_until_learn, placement):
     example_env = env_fn()
 
-    vec_env = MakeCPUAsyncConstructor(num_cpus)([env_fn]*num_env_ids, example_env.observation_space, example_env.action_space)
+    vec_env = MakeCPUAsyncConstructor(num_cpus, placement=placement)([env_fn]*num_env_ids, example_env.observation_space, example_env.action_space)
     del example_env
     num_envs = vec_env.num_envs
 
@@ -62,15 +112,14 @@ def run_actor_loop(terminate_event, start_learn_event, actor_fn, adder_fn, log_a
 
     tot_time = 0
     start_time = time.time()
-    adders = [adder_fn() for _ in range(num_envs)]
-    log_adders = [log_adder_fn() for _ in range(num_envs)]
-
-    assert len(adders) == len(new_entry_pipes)
-    for adder,entry_pipe in zip(adders, new_entry_pipes):
-        adder.set_generate_callback(entry_pipe.store)
+    adder = vec_adder_fn(num_envs, vec_env.terminal_obs)
+    first_env_idx = actor_idx * num_envs
+    def put_entries(transitions, env_idxs):
+        new_entry_pipe.put_many(list(transitions) + [env_idxs + first_env_idx])
+    adder.set_generate_callback(put_entries, with_env_idxs=True)
 
-    for log_adder in log_adders:
-        log_adder.set_generate_callback(logger_pipe.put)
+    log_adder = VectorLoggerAdder(num_envs)
+    log_adder.set_generate_callback(logger_pipe.put)
 
     dones = np.zeros(num_envs,dtype=np.uint8)
     infos = [{} for _ in range(num_envs)]
@@ -92,10 +141,8 @@ def run_actor_loop(terminate_event, start_learn_event, actor_fn, adder_fn, log_a
 
         obss, rews, dones, infos = vec_env.step(actions)
 
-        for i in range(len(obss)):
-            obs,act,rew,done,info,act_info = obss[i], actions[i], rews[i], dones[i], infos[i], actor_info[i]
-            adders[i].add(obs,act,rew,done,info,act_info)
-            log_adders[i].add(obs,act,rew,done,info,act_info)
+        adder.add(obss, actions, rews, dones, infos, actor_info)
+        log_adder.add(obss, actions, rews, dones, infos, actor_info)
 
 
 def noop(x):
@@ -120,12 +167,31 @@ def run_loop(
         log_callback=noop,
         num_cpus=0,
         num_actors=1,
+        data_store_folder=None,
+        data_manager_fn=DataManager,
+        entry_queue_size=256,
+        batch_queue_size=4,
+        num_sampler_procs=0,
+        priority_queue_size=16,
+        vec_adder_fn=None,
+        placement=None,
         ):
+    '''
+    vec_adder_fn(num_envs, terminal_obs) makes the vector adder of an actor,
+    terminal_obs is the buffer of observations that ended episodes of its
+    vector environment (see VectorTransitionAdder). By default, it is the
+    vectorized version of adder_fn(), see vector_adder_fn.
+
+    placement (see CPUPlacement) pins the env worker processes of the actors
+    to their own cores, and the learner and batch generator to the reserved ones
+    '''
 
     terminate_event = mp.Event()
     start_learn_event = mp.Event()
 
-    example_adder = adder_fn()
+    if vec_adder_fn is None:
+        vec_adder_fn = vector_adder_fn(adder_fn)
+    example_adder = vec_adder_fn(1, None)
 
     example_env = environment_fn()
     envs_per_env = getattr(example_env, "num_envs", 1)
@@ -133,30 +199,38 @@ def run_loop(
     num_envs = num_env_ids*envs_per_env
 
     transition_example = example_adder.get_example_output()
-    removal_scheme = FifoScheme()
+    removal_scheme = RingFifoScheme(data_store_size)
     sample_scheme = replay_sampler
 
     env_log_queue = mp.Queue()
 
-    priority_updater.set_data_pipe(SharedMemPipe(priority_pipe_example(batch_size)))
+    # learner updates are queued up and coalesced by the batch generator, so none get overwritten
+    priority_updater.set_data_pipe(SharedRingBuffer(priority_pipe_example(batch_size), priority_queue_size))
 
-    batch_store = SharedMemPipe([np.empty(batch_size,dtype=np.int64), np.empty(batch_size,dtype=np.float32)]+expand_example(transition_example, batch_size))
+    # lets the batch generator stay batch_queue_size batches ahead of the learner
+    batch_example = [np.empty(batch_size,dtype=np.int64), np.empty(batch_size,dtype=np.float32)]+expand_example(transition_example, batch_size)
+    # with sampler processes, each of them fills its own queue, and the learner takes from whichever is ready
+    any_batch = mp.Semaphore(0)
+    batch_stores = [SharedBatchQueue(batch_example, batch_queue_size, any_batch) for _ in range(max(1, num_sampler_procs))]
 
-    new_entry_pipes = [SharedMemPipe(transition_example) for _ in range(num_envs)]
-    logger_adder_fn = LoggerAdder
+    # actors block instead of dropping transitions when the batch generator falls behind
+    envs_per_act = num_envs // num_actors
+    # one queue per actor, its vector adder writes the transitions of all its envs in one go,
+    # each along with the index of its env
+    new_entry_pipes = [SharedRingBuffer(env_idx_example(transition_example), entry_queue_size*envs_per_act) for _ in range(num_actors)]
 
-    batch_proc = mp.Process(target=run_worker_except,args=(terminate_event, transition_example, removal_scheme, sample_scheme, data_store_size, batch_store, new_entry_pipes, priority_updater, batch_size, env_log_queue))
+    batch_proc = mp.Process(target=run_worker_except,args=(terminate_event, transition_example, removal_scheme, sample_scheme, data_store_size, batch_stores, new_entry_pipes, priority_updater, batch_size, env_log_queue, data_store_folder, log_frequency, data_manager_fn, num_sampler_procs, placement))
     procs = [batch_proc]
     assert num_envs % num_env_ids == 0
-    envs_per_act = num_envs // num_actors
-    for aidx in range(num_actors):
-        sidx = aidx * envs_per_act
-        eidx = (aidx+1) * envs_per_act
-        actor_proc = mp.Process(target=run_actor_except,args=(terminate_event, start_learn_event, actor_fn, adder_fn, logger_adder_fn, new_entry_pipes[sidx:eidx], num_cpus//num_actors, envs_per_act, policy_delayer, environment_fn, env_log_queue, data_store_size, act_steps_until_learn//num_actors))
+    actor_placements = [None]*num_actors if placement is None else placement.split(num_actors, num_cpus//num_actors)
+    for aidx, actor_placement in enumerate(actor_placements):
+        actor_proc = mp.Process(target=run_actor_except,args=(terminate_event, start_learn_event, actor_fn, vec_adder_fn, new_entry_pipes[aidx], aidx, num_cpus//num_actors, envs_per_act, policy_delayer, environment_fn, env_log_queue, data_store_size, act_steps_until_learn//num_actors, actor_placement))
         procs.append(actor_proc)
 
     for proc in procs:
         proc.start()
+    if placement is not None:
+        placement.pin_reserved()
 
     try:
         learner = learner_fn()
@@ -167,17 +241,20 @@ def run_loop(
         for train_step in range(2**100):
             if terminate_event.is_set():
                 break
-            if start_learn_event.is_set():
+            if start_learn_event.wait(0.1):
                 policy_delayer.learn_step(learner.policy)
 
-                learn_batch = batch_store.get()
-                if learn_batch is None:
+                # wakes up every so often to check for termination and to log
+                learn_lease = lease_any(batch_stores, any_batch, timeout=0.1, start=learn_steps)
+                if learn_lease is None:
                     continue
 
-                ids = learn_batch[0]
-                weights = learn_batch[1]
-                transition_data = learn_batch[2:]
-                learner.learn_step(ids, transition_data, weights)
+                # the batch is read in place from shared memory, its slot is handed back after the step
+                with learn_lease as learn_batch:
+                    ids = learn_batch[0]
+                    weights = learn_batch[1]
+                    transition_data = learn_batch[2:]
+                    learner.learn_step(ids, transition_data, weights)
 
 
                 if learn_steps >= max_learn_steps:
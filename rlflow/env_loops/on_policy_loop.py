@@ -0,0 +1,148 @@
+import numpy as np
+import multiprocessing as mp
+import traceback
+import time
+from rlflow.utils.shared_mem_pipe import expand_example
+from rlflow.utils.shared_batch_queue import SharedBatchQueue
+from rlflow.adders.on_policy_critic_adder import OnPolicyAdder
+from rlflow.adders.logger_adder import VectorLoggerAdder
+from rlflow.data_store.on_policy_store import OnPolicyDataStore
+from rlflow.vector import MakeCPUAsyncConstructor
+from rlflow.vector.gym_rollout import RolloutBuilder
+
+def flatten_segment(segment):
+    return [field.reshape((-1,)+field.shape[2:]) for field in segment]
+
+def run_rollout_actor(terminate_event, actor_policy_fn, policy_delayer, env_fn, num_cpus, num_env_ids, n_steps, gamma, gae_lambda, segment_queue, logger_pipe):
+    example_env = env_fn()
+    vec_env = MakeCPUAsyncConstructor(num_cpus)([env_fn]*num_env_ids, example_env.observation_space, example_env.action_space)
+    del example_env
+    num_envs = vec_env.num_envs
+
+    # the actor keeps its own copy of the policy, so it can collect the next
+    # rollout while the learner is still learning on the previous one
+    policy = actor_policy_fn()
+    policy_delayer.actor_step(policy)
+
+    def store_segment(segment):
+        # waits for the learner to take the previous segment
+        while not segment_queue.can_store():
+            if terminate_event.is_set():
+                return
+            time.sleep(0.0001)
+        segment_queue.store(flatten_segment(segment))
+
+    adder = OnPolicyAdder(num_envs, n_steps, vec_env.observation_space, vec_env.action_space, gamma, gae_lambda)
+    adder.set_generate_callback(store_segment)
+
+    log_adder = VectorLoggerAdder(num_envs)
+    log_adder.set_generate_callback(logger_pipe.put)
+
+    builder = RolloutBuilder(vec_env)
+    builder.restart(policy)
+    while not terminate_event.is_set():
+        policy_delayer.actor_step(policy)
+        builder.rollout(policy, n_steps, adders=(adder, log_adder))
+
+def run_rollout_actor_except(terminate_event, *args):
+    try:
+        run_rollout_actor(terminate_event, *args)
+    except Exception as e:
+        terminate_event.set()
+        traceback.print_exc()
+
+def noop(x):
+    return x
+
+def run_loop(
+        logger,
+        learner_fn,
+        policy_delayer,
+        actor_policy_fn,
+        environment_fn,
+        saver,
+        n_steps,
+        batch_size,
+        num_epochs=4,
+        gamma=0.99,
+        gae_lambda=0.95,
+        num_env_ids=4,
+        log_frequency=100,
+        max_learn_steps=2**100,
+        log_callback=noop,
+        num_cpus=0,
+        seed=None,
+        ):
+    '''
+    On-policy (PPO style) loop. An actor process steps the vector environment
+    with RolloutBuilder, collecting segments of n_steps steps of all envs along
+    with their advantages (see OnPolicyAdder). The learner learns on each
+    segment for num_epochs epochs of random minibatches, calling
+    learner.learn_step(minibatch) with the fields
+        (obs, action, values, advantages, returns, log_probs)
+
+    Learning overlaps with collecting the next segment, which is acted on by
+    the actor's copy of the policy, kept up to date by policy_delayer
+    (an OccasionalUpdate, updated after every segment with steps_to_update=1).
+    So every segment after the first is collected by the policy from
+    one learning phase before.
+
+    actor_policy_fn has to return a policy whose rollout_step returns
+    (actions, states, actor_infos), with "values" and "log_probs" in actor_infos.
+    '''
+    terminate_event = mp.Event()
+
+    example_env = environment_fn()
+    envs_per_env = getattr(example_env, "num_envs", 1)
+    observation_space = example_env.observation_space
+    action_space = example_env.action_space
+    del example_env
+    num_envs = num_env_ids*envs_per_env
+    segment_size = n_steps*num_envs
+
+    transition_example = OnPolicyAdder(1, 1, observation_space, action_space).get_example_output()
+    # a single slot: the actor fills it while the learner works on its own copy of the last segment
+    segment_queue = SharedBatchQueue(expand_example(transition_example, segment_size), 1)
+    env_log_queue = mp.Queue()
+
+    actor_proc = mp.Process(target=run_rollout_actor_except,args=(terminate_event, actor_policy_fn, policy_delayer, environment_fn, num_cpus, num_env_ids, n_steps, gamma, gae_lambda, segment_queue, env_log_queue))
+    actor_proc.start()
+
+    try:
+        learner = learner_fn()
+        policy_delayer.learn_step(learner.policy)
+        data_store = OnPolicyDataStore(transition_example, segment_size, seed)
+        prev_time = time.time()/log_frequency
+
+        learn_steps = 0
+        cur_learn_steps = 0
+        while not terminate_event.is_set() and learn_steps < max_learn_steps:
+            # wakes up every so often to check for termination and to log
+            segment_lease = segment_queue.lease(timeout=0.1)
+            if segment_lease is not None:
+                # copied out, so the actor can store the next segment as soon as it is done
+                with segment_lease as segment:
+                    data_store.add_segment(segment)
+
+                for minibatch in data_store.minibatches(batch_size, num_epochs):
+                    learner.learn_step(minibatch)
+                    cur_learn_steps += 1
+                    learn_steps += 1
+
+                policy_delayer.learn_step(learner.policy)
+
+            while not env_log_queue.empty():
+                logger.record_type(*env_log_queue.get_nowait())
+
+            if time.time()/log_frequency > prev_time:
+                logger.record_sum("learn_steps", cur_learn_steps*batch_size)
+                cur_learn_steps = 0
+                logger.dump()
+                saver.checkpoint(learner.policy)
+                prev_time += 1
+                log_callback(learner)
+
+    finally:
+        terminate_event.set()
+        actor_proc.join(0.2)
+        actor_proc.terminate()
@@ -1,9 +1,10 @@
 import numpy as np
 from rlflow.data_store.data_store import DataManager
-from rlflow.selectors.fifo import FifoScheme
+from rlflow.selectors.fifo import RingFifoScheme
 import multiprocessing as mp
 import queue
-from rlflow.adders.logger_adder import LoggerAdder
+from rlflow.adders.logger_adder import VectorLoggerAdder
+from rlflow.adders.gym_adder import vector_adder_fn
 from rlflow.utils.shared_mem_pipe import SharedMemPipe, expand_example
 from rlflow.selectors.priority_updater import priority_pipe_example, PriorityUpdater, NoUpdater
 from rlflow.actors.single_agent_actor import StatelessActor
@@ -31,6 +32,9 @@ def run_loop(
         log_frequency=100,
         max_learn_steps=2**100,
         log_callback=noop,
+        data_store_folder=None,
+        data_manager_fn=DataManager,
+        vec_adder_fn=None,
         ):
 
 
@@ -39,26 +43,25 @@ def run_loop(
     vec_env = MakeCPUAsyncConstructor(num_cpus)([environment_fn]*num_env_ids, example_env.observation_space, example_env.action_space)
     num_envs = vec_env.num_envs
 
-    example_adder = adder_fn()
+    if vec_adder_fn is None:
+        vec_adder_fn = vector_adder_fn(adder_fn)
+    # the adder reads the observations that ended episodes out of the vec env's buffer
+    adder = vec_adder_fn(num_envs, vec_env.terminal_obs)
     dones = np.zeros(num_envs,dtype=np.uint8)
     infos = [{} for _ in range(num_envs)]
 
-    transition_example = example_adder.get_example_output()
-    removal_scheme = FifoScheme()
+    transition_example = adder.get_example_output()
+    removal_scheme = RingFifoScheme(data_store_size)
     sample_scheme = replay_sampler
-    new_entry_pipes = [SharedMemPipe(transition_example) for _ in range(num_envs)]
 
     priority_updater.set_data_pipe(SharedMemPipe(priority_pipe_example(batch_size)))
 
-    data_manager = DataManager(new_entry_pipes, transition_example, removal_scheme, sample_scheme, data_store_size)
+    # the data manager lives in this process, so transitions can be added to it directly
+    data_manager = data_manager_fn([], transition_example, removal_scheme, sample_scheme, data_store_size, data_store_folder)
+    adder.set_generate_callback(data_manager.add_batch, with_env_idxs=True)
 
-    adders = [adder_fn() for _ in range(num_envs)]
-    log_adders = [LoggerAdder() for _ in range(num_envs)]
-    for adder,entry_pipe in zip(adders, new_entry_pipes):
-        adder.set_generate_callback(entry_pipe.store)
-
-    for log_adder in log_adders:
-        log_adder.set_generate_callback(lambda args: logger.record_type(*args))
+    log_adder = VectorLoggerAdder(num_envs)
+    log_adder.set_generate_callback(lambda args: logger.record_type(*args))
 
     if act_steps_until_learn is None:
         act_steps_until_learn = data_store_size//2
@@ -79,12 +82,8 @@ def run_loop(
         for i in range(cur_act_steps):
             actions, actor_info = actor.step(obss, dones, infos)
             obss, rews, dones, infos = vec_env.step(actions)
-            for i in range(len(obss)):
-                obs,act,rew,done,info,act_info = obss[i], actions[i], rews[i], dones[i], infos[i], actor_info[i]
-                adders[i].add(obs,act,rew,done,info,act_info)
-                log_adders[i].add(obs,act,rew,done,info,act_info)
-
-            data_manager.receive_new_entries()
+            adder.add(obss, actions, rews, dones, infos, actor_info)
+            log_adder.add(obss, actions, rews, dones, infos, actor_info)
 
         total_act_steps += cur_act_steps * num_envs
 
@@ -97,8 +96,7 @@ def run_loop(
                 density_result = priority_updater.fetch_densities()
                 if density_result is not None:
                     ids, priorities = density_result
-                    data_manager.sample_scheme.update_priorities(ids, priorities)
-                    data_manager.removal_scheme.update_priorities(ids, priorities)
+                    data_manager.update_priorities(ids, priorities)
 
             if learn_steps >= max_learn_steps:
                 break
@@ -107,5 +105,7 @@ def run_loop(
             logger.dump()
             logger.record("total_act_steps",total_act_steps)
             saver.checkpoint(learner.policy)
+            if data_store_folder is not None:
+                data_manager.checkpoint()
             log_callback(learner)
             prev_time += 1
@@ -1,3 +1,3 @@
-from .fifo import FifoScheme
+from .fifo import FifoScheme, RingFifoScheme
 from .uniform import UniformSampleScheme
 from .prioritized import DensitySampleScheme
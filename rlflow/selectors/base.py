@@ -1,3 +1,5 @@
+import numpy as np
+
 class BaseScheme:
     def add(self, id):
         '''
@@ -9,9 +11,50 @@ class BaseScheme:
         returns:
         - id of sampled data
         '''
+    def add_many(self, ids):
+        '''
+        args:
+          ids: array of unique ids, same as calling add on each of them in order
+        '''
     def remove(self, id):
         '''
         removes the id from the data
         '''
+    def remove_many(self, ids):
+        '''
+        removes all of the ids from the data
+        '''
     def update_priorities(self, ids, priorities):
         '''priority: priority of data (only needed for selectors which use it, can be ignored)'''
+    def get_state(self):
+        '''
+        returns: dict of numpy arrays which fully describe the scheme,
+        used to save it along with a persistent replay buffer
+        '''
+        return {}
+    def set_state(self, state):
+        '''
+        restores the scheme from a dict returned by get_state
+        '''
+
+def swap_remove_many(sample_idxs, data_idxs, num_idxs, ids):
+    '''
+    vectorized version of the swap with last element removal used by
+    the dense index schemes. Moves the surviving entries in the tail
+    of data_idxs into the holes left by the removed ids.
+
+    returns:
+    - holes: positions that were filled
+    - movers: positions that the filling entries were moved from
+    - new_num_idxs: number of entries left after the removal
+    '''
+    idxs = sample_idxs[ids]
+    new_num_idxs = num_idxs - len(idxs)
+    tail_removed = np.zeros(num_idxs - new_num_idxs, dtype=bool)
+    tail_removed[idxs[idxs >= new_num_idxs] - new_num_idxs] = True
+    movers = np.arange(new_num_idxs, num_idxs)[~tail_removed]
+    holes = idxs[idxs < new_num_idxs]
+    moved_ids = data_idxs[movers]
+    data_idxs[holes] = moved_ids
+    sample_idxs[moved_ids] = holes
+    return holes, movers, new_num_idxs
@@ -1,77 +1,133 @@
-import collections
 import numpy as np
 from .base import BaseScheme
 
-class LLNode:
-    def __init__(self, prev, next, val):
-        self.prev = prev
-        self.next = next
-        self.value = val
+class RingFifoScheme(BaseScheme):
+    '''
+    FIFO removal scheme stored in a fixed size circular array of ids.
 
-class LList:
-    def __init__(self):
-        self.head = None
-        self.tail = None
+    Removing an id from the middle of the queue leaves a tombstone (-1)
+    that is skipped when the oldest entries are popped. Ids must be in
+    the range [0, max_size).
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.queue = np.full(max_size, -1, dtype=np.int32)
+        self.positions = np.full(max_size, -1, dtype=np.int32)
+        self.head = 0
+        self.tail = 0
         self.size = 0
 
-    def add(self,val):
-        old_head = self.head
-        new_node = LLNode(None,old_head,val)
-        self.head = new_node
-        if old_head is not None:
-            old_head.prev = new_node
-        else:
-            self.tail = new_node
-        self.size += 1
-        return new_node
-
-    def empty(self):
-        return self.head is None
-
-    def pop(self):
-        val = self.tail.value
-        self.remove(self.tail)
-        return val
-
-    def remove(self,node):
-        if self.head is not None:
-            self.size -= 1
-
-        if self.tail is self.head:
-            self.tail = None
-            self.head = None
-        else:
-            if node is self.head:
-                self.head = node.next
-                self.head.prev = None
-            else:
-                node.prev.next = node.next
-
-            if node is self.tail:
-                self.tail = node.prev
-                self.tail.next = None
-            else:
-                node.next.prev = node.prev
-
     def __len__(self):
         return self.size
 
-class FifoScheme(BaseScheme):
-    def __init__(self):
-        self.queue = LList()
-        self.nodes = {}
+    def _slots(self, start, end):
+        return np.arange(start, end) % self.max_size
+
+    def _compact(self):
+        live = self.queue[self._slots(self.head, self.tail)]
+        live = live[live >= 0]
+        self.queue[:] = -1
+        self.queue[:len(live)] = live
+        self.positions[live] = np.arange(len(live))
+        self.head = 0
+        self.tail = len(live)
+
     def add(self, id):
-        node = self.queue.add(id)
-        self.nodes[id] = node
+        self.add_many(np.array([id]))
+
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        assert self.size + len(ids) <= self.max_size, "added elements make fifo greater than max size, make sure to remove elements first"
+        if self.tail - self.head + len(ids) > self.max_size:
+            self._compact()
+        slots = self._slots(self.tail, self.tail + len(ids))
+        self.queue[slots] = ids
+        self.positions[ids] = slots
+        self.tail += len(ids)
+        self.size += len(ids)
+
     def sample(self, batch_size):
-        if len(self.queue) >= batch_size:
-            vals = [self.queue.pop() for i in range(batch_size)]
-            for val in vals:
-                del self.nodes[val]
-            return vals, None
-        else:
+        if self.size < batch_size:
             return None, None
+        popped = []
+        num_needed = batch_size
+        while num_needed > 0:
+            slots = self._slots(self.head, self.head + num_needed)
+            vals = self.queue[slots]
+            self.queue[slots] = -1
+            self.head += num_needed
+            vals = vals[vals >= 0]
+            popped.append(vals)
+            num_needed -= len(vals)
+        vals = np.concatenate(popped) if len(popped) > 1 else popped[0]
+        self.positions[vals] = -1
+        self.size -= batch_size
+        return vals.astype(np.int64), None
+
     def remove(self, id):
-        if id in self.nodes:
-            self.queue.remove(self.nodes[id])
-            del self.nodes[id]
+        self.remove_many(np.array([id]))
+
+    def remove_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        slots = self.positions[ids]
+        present = slots >= 0
+        self.queue[slots[present]] = -1
+        self.positions[ids[present]] = -1
+        self.size -= int(np.count_nonzero(present))
+
+    def get_state(self):
+        return {
+            "queue": self.queue,
+            "positions": self.positions,
+            "counters": np.array([self.head, self.tail, self.size], dtype=np.int64),
+        }
+
+    def set_state(self, state):
+        assert len(state["queue"]) == self.max_size, "saved fifo state has a different size"
+        np.copyto(self.queue, state["queue"])
+        np.copyto(self.positions, state["positions"])
+        self.head, self.tail, self.size = (int(v) for v in state["counters"])
+
+class FifoScheme(RingFifoScheme):
+    '''
+    RingFifoScheme without a fixed size, its arrays are doubled
+    whenever the entries or the ids do not fit in them anymore.
+    '''
+    def __init__(self, initial_size=64):
+        super().__init__(initial_size)
+
+    def _grow(self, min_size):
+        live = self._live_ids()
+        self.max_size = max(min_size, 2*self.max_size)
+        self.queue = np.full(self.max_size, -1, dtype=np.int32)
+        self.positions = np.full(self.max_size, -1, dtype=np.int32)
+        self.queue[:len(live)] = live
+        self.positions[live] = np.arange(len(live))
+        self.head = 0
+        self.tail = len(live)
+
+    def _live_ids(self):
+        live = self.queue[self._slots(self.head, self.tail)]
+        return live[live >= 0]
+
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids):
+            min_size = max(self.size + len(ids), int(ids.max()) + 1)
+            if min_size > self.max_size:
+                self._grow(min_size)
+        super().add_many(ids)
+
+    def remove_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        # ids that never fit in the arrays were never added
+        super().remove_many(ids[ids < self.max_size])
+
+    def get_state(self):
+        return {"ids": self._live_ids().astype(np.int64)}
+
+    def set_state(self, state):
+        self.queue[:] = -1
+        self.positions[:] = -1
+        self.head = self.tail = self.size = 0
+        self.add_many(state["ids"])
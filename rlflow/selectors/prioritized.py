@@ -1,16 +1,19 @@
 import collections
 import numpy as np
-from .segment_tree import SumSegmentTree, MinSegmentTree
-from .base import BaseScheme
+from .segment_tree import SumSegmentTree, MinSegmentTree, unique
+from .base import BaseScheme, swap_remove_many
 
 class DensitySampleScheme(BaseScheme):
-    def __init__(self, max_size, alpha, beta_fn, epsilon=1e-7, seed=None):
+    def __init__(self, max_size, alpha, beta_fn, epsilon=1e-7, seed=None, stratified=False):
         """
         Samples based off density of their weight
 
         :param max_size: (int) Max number of transitions to store in the buffer. When the buffer overflows the old memories
             are dropped.
         :param max_priority: (float) how much prioritization is used (0 - no prioritization, 1 - full prioritization)
+        :param stratified: (bool) draw one sample from each of batch_size equal mass segments.
+            Entries heavier than a segment are found in several of them, those segments are
+            resampled like the duplicates of proportional sampling
         """
         #assert max_priority > 0
 
@@ -31,6 +34,7 @@ class DensitySampleScheme(BaseScheme):
         self.max_size = max_size
         self.np_random = np.random.RandomState(seed)
         self._max_priority = epsilon
+        self.stratified = stratified
 
     def add(self, id):
         assert self.num_idxs < self.max_size, "added element makes buffer greater than max size, make sure to remove element first"
@@ -42,34 +46,62 @@ class DensitySampleScheme(BaseScheme):
         self._it_sum[idx] = self._max_priority
         self._it_min[idx] = self._max_priority
 
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        new_num_idxs = self.num_idxs + len(ids)
+        assert new_num_idxs <= self.max_size, "added elements make buffer greater than max size, make sure to remove elements first"
+        idxs = np.arange(self.num_idxs, new_num_idxs)
+        self.data_idxs[idxs] = ids
+        self.sample_idxs[ids] = idxs
+        self.num_idxs = new_num_idxs
+
+        self._it_sum[idxs] = self._max_priority
+        self._it_min[idxs] = self._max_priority
+
     def sample(self, batch_size):
         if self.num_idxs < batch_size:
             return None, None
         else:
-            idxs = self._sample_proportional(batch_size)
-            idxs = np.unique(idxs)
+            total = self._it_sum.sum(0, self.num_idxs)
+            if self.stratified:
+                idxs = unique(self._sample_stratified(batch_size, total))
+            else:
+                idxs = unique(self._sample_proportional(batch_size, total))
+            priorities = self._it_sum[idxs]
             self._it_sum[idxs] = self.epsilon
             while len(idxs) != batch_size:
-                add_idxs = self._sample_proportional(batch_size-len(idxs))
-                self._it_sum[add_idxs] = self.epsilon
-                idxs = np.concatenate([idxs,add_idxs],axis=0)
-                idxs = np.unique(idxs)
+                add_idxs = unique(self._sample_proportional(batch_size-len(idxs), self._it_sum.sum(0, self.num_idxs)))
+                add_idxs = add_idxs[~np.isin(add_idxs, idxs)]
+                if len(add_idxs):
+                    priorities = np.concatenate([priorities,self._it_sum[add_idxs]],axis=0)
+                    self._it_sum[add_idxs] = self.epsilon
+                    idxs = np.concatenate([idxs,add_idxs],axis=0)
 
             beta = self.beta_fn(self.learn_step)
-            p_min = self._it_min.min() / self._it_sum.sum()
+            p_min = self._it_min.min() / total
             max_weight = (p_min * self.num_idxs) ** (-beta)
-            p_sample = self._it_sum[idxs] / self._it_sum.sum()
+            p_sample = priorities / total
             weights = (p_sample * self.num_idxs) ** (-beta) / max_weight
 
             ids = self.data_idxs[idxs]
             self.learn_step += 1
             return ids, weights
 
-    def _sample_proportional(self, batch_size):
-        total = self._it_sum.sum(0, self.num_idxs)
-        mass = self.np_random.random(size=batch_size) * total
+    def _sample_proportional(self, batch_size, total):
+        # sorted masses make the tree search walk memory in order and give back sorted indexes
+        mass = np.sort(self.np_random.random(size=batch_size)) * total
+        idx = self._it_sum.find_prefixsum_idx(mass)
+        # float32 rounding can push the search just past the last stored entry
+        return np.minimum(idx, self.num_idxs-1)
+
+    def _sample_stratified(self, batch_size, total):
+        steps = np.arange(batch_size)
+        mass = (steps + self.np_random.random(size=batch_size)) * (total / batch_size)
         idx = self._it_sum.find_prefixsum_idx(mass)
-        return idx
+        # the masses are increasing, so the indexes come back sorted
+        return np.minimum(idx, self.num_idxs-1)
 
     def remove(self, id):
         idx = int(self.sample_idxs[id])
@@ -82,6 +114,39 @@ class DensitySampleScheme(BaseScheme):
             self.sample_idxs[new_id] = idx
         self.num_idxs = new_idx
 
+    def remove_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        holes, movers, self.num_idxs = swap_remove_many(self.sample_idxs, self.data_idxs, self.num_idxs, ids)
+        if len(holes):
+            self._it_sum[holes] = self._it_sum[movers]
+            self._it_min[holes] = self._it_min[movers]
+
+    def get_state(self):
+        return {
+            "sample_idxs": self.sample_idxs,
+            "data_idxs": self.data_idxs,
+            "num_idxs": np.array(self.num_idxs),
+            "learn_step": np.array(self.learn_step),
+            "max_priority": np.array(self._max_priority),
+            "sum_tree": self._it_sum._value,
+            "min_tree": self._it_min._value,
+        }
+
+    def set_state(self, state):
+        assert len(state["data_idxs"]) == self.max_size, "saved scheme state has a different size"
+        np.copyto(self.sample_idxs, state["sample_idxs"])
+        np.copyto(self.data_idxs, state["data_idxs"])
+        self.num_idxs = int(state["num_idxs"])
+        self.learn_step = int(state["learn_step"])
+        self._max_priority = float(state["max_priority"])
+        np.copyto(self._it_sum._value, state["sum_tree"])
+        np.copyto(self._it_min._value, state["min_tree"])
+
+    def update_priorities(self, ids, priorities):
+        self.update_weights(ids, priorities)
+
     def update_weights(self, ids, td_errs):
         """
         sets priority of transition at index idxes[i] in buffer
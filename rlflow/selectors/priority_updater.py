@@ -6,6 +6,16 @@ def priority_pipe_example(batch_size):
         np.empty(batch_size,dtype=np.float32)
     )
 
+def coalesce_updates(ids, td_errors):
+    '''
+    flattens a stack of updates and keeps only the newest
+    td error of every id
+    '''
+    ids = ids.ravel()[::-1]
+    td_errors = td_errors.ravel()[::-1]
+    unique_ids, newest = np.unique(ids, return_index=True)
+    return unique_ids, td_errors[newest]
+
 class PriorityUpdater:
     def __init__(self):
         self.data_pipe = None
@@ -19,8 +29,15 @@ class PriorityUpdater:
         self.data_pipe.store((idxs, new_td_error))
 
     def fetch_densities(self):
+        '''
+        returns all updates stored since the last fetch, coalesced by id,
+        or None if there are none
+        '''
         assert self.data_pipe is not None, "need to set data pipe before using priority updater"
-        return self.data_pipe.get()
+        updates = self.data_pipe.drain()
+        if updates is None:
+            return None
+        return coalesce_updates(*updates)
 
 
 class NoUpdater:
@@ -16,7 +16,7 @@ def unique(sorted_array):
 
 
 class SegmentTree(object):
-    def __init__(self, capacity, operation, neutral_element):
+    def __init__(self, capacity, operation, neutral_element, branch_factor=32):
         """
         Build a Segment Tree data structure.
 
@@ -31,31 +31,65 @@ class SegmentTree(object):
                `reduce` operation which reduces `operation` over
                a contiguous subsequence of items in the array.
 
+        Each node has `branch_factor` children, so a 2^20 capacity tree is only 4 levels deep
+        and batched updates and searches need a handful of numpy calls per level instead
+        of per binary level. All levels are float32 views into the flat `_value` array,
+        leaves first, and the batched paths work on preallocated scratch buffers.
+
         :param capacity: (int) Total size of the array - must be a power of two.
-        :param operation: (lambda (Any, Any): Any) operation for combining elements (eg. sum, max) must form a
+        :param operation: (np.ufunc) operation for combining elements (eg. np.add, np.minimum) must form a
             mathematical group together with the set of possible values for array elements (i.e. be associative)
         :param neutral_element: (Any) neutral element for the operation above. eg. float('-inf') for max and 0 for sum.
+        :param branch_factor: (int) number of children of each node - must be a power of two.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+        assert branch_factor > 1 and branch_factor & (branch_factor - 1) == 0, "branch_factor must be a power of 2."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
         self._operation = operation
         self.neutral_element = neutral_element
+        self._branch = branch_factor
+        self._branch_bits = branch_factor.bit_length() - 1
 
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
+        level_sizes = []
+        size = capacity
+        while size > 1:
+            size = -(-size // branch_factor) * branch_factor
+            level_sizes.append(size)
+            size //= branch_factor
+        level_sizes.append(1)
+
+        self._value = np.full(sum(level_sizes), neutral_element, dtype=np.float32)
+        self._levels = []
+        offset = 0
+        for size in level_sizes:
+            self._levels.append(self._value[offset:offset+size])
+            offset += size
+        # children of node i at level k+1 are the row i of _blocks[k]
+        self._blocks = [level.reshape(-1, branch_factor) for level in self._levels[:-1]]
+
+        self._scratch_size = 0
+        self._ensure_scratch(64)
+
+    def _ensure_scratch(self, size):
+        if size > self._scratch_size:
+            self._scratch_size = size
+            self._node_buf = np.empty(size, dtype=np.int64)
+            self._child_buf = np.empty(size, dtype=np.int64)
+            self._reduce_buf = np.empty(size, dtype=np.float32)
+            self._mass_buf = np.empty(size, dtype=np.float32)
+            self._flat_idx_buf = np.empty(size, dtype=np.int64)
+            self._block_buf = np.empty((size, self._branch), dtype=np.float32)
+            self._transpose_buf = np.empty(size * self._branch, dtype=np.float32)
+            self._mask_buf = np.empty(size * self._branch, dtype=bool)
+
+    def _transposed(self, buf, num_rows):
+        return buf[:num_rows * self._branch].reshape(self._branch, num_rows)
+
+    def _reduce_rows(self, rows, out):
+        # numpy reduces short rows slowly, so reduce over the long axis of a transposed copy instead
+        rows_t = self._transposed(self._transpose_buf, len(rows))
+        np.copyto(rows_t, rows.T)
+        self._operation.reduce(rows_t, axis=0, out=out)
 
     def reduce(self, start=0, end=None):
         """
@@ -72,40 +106,81 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
-        end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+
+        result = self.neutral_element
+        for level in self._levels:
+            if start >= end:
+                break
+            if start // self._branch == (end - 1) // self._branch:
+                # range is inside a single block, no need to go further up
+                return self._operation(result, self._operation.reduce(level[start:end]))
+            start_block_end = -(-start // self._branch) * self._branch
+            end_block_start = (end // self._branch) * self._branch
+            if start < start_block_end:
+                result = self._operation(result, self._operation.reduce(level[start:start_block_end]))
+            if end_block_start < end:
+                result = self._operation(result, self._operation.reduce(level[end_block_start:end]))
+            start = start_block_end // self._branch
+            end = end_block_start // self._branch
+        return result
 
     def __setitem__(self, idx, val):
-        # indexes of the leaf
-        idxs = idx + self._capacity
-        self._value[idxs] = val
-        if isinstance(idxs, int):
-            idxs = np.array([idxs])
-        # go up one level in the tree and remove duplicate indexes
-        idxs = unique(idxs // 2)
-        while len(idxs) > 1 or idxs[0] > 0:
-            # as long as there are non-zero indexes, update the corresponding values
-            self._value[idxs] = self._operation(
-                self._value[2 * idxs],
-                self._value[2 * idxs + 1]
-            )
-            # go up one level in the tree and remove duplicate indexes
-            idxs = unique(idxs // 2)
+        if np.ndim(idx) == 0:
+            self._set_single(int(idx), val)
+            return
+
+        num_idxs = len(idx)
+        if num_idxs == 0:
+            return
+        self._ensure_scratch(num_idxs)
+        nodes = self._node_buf[:num_idxs]
+        block_vals = self._block_buf[:num_idxs]
+        reduced = self._reduce_buf[:num_idxs]
+
+        np.copyto(nodes, idx, casting='unsafe')
+        np.put(self._levels[0], nodes, val)
+        for level, children in zip(self._levels[1:], self._blocks):
+            if len(level) <= num_idxs:
+                # level is small enough that recomputing all of it is cheaper than gathering
+                self._reduce_rows(children, out=level[:len(children)])
+            else:
+                # go up one level in the tree, duplicate parents just get the same value written twice
+                np.right_shift(nodes, self._branch_bits, out=nodes)
+                np.take(children, nodes, axis=0, out=block_vals)
+                self._reduce_rows(block_vals, out=reduced)
+                np.put(level, nodes, reduced)
+
+    def _set_single(self, idx, val):
+        self._levels[0][idx] = val
+        for level, children in zip(self._levels[1:], self._blocks):
+            idx >>= self._branch_bits
+            level[idx] = self._operation.reduce(children[idx])
 
     def __getitem__(self, idx):
         assert np.max(idx) < self._capacity
         assert 0 <= np.min(idx)
-        return self._value[self._capacity + idx]
+        return self._levels[0][idx]
 
 
 class SumSegmentTree(SegmentTree):
+    SEARCH_LEVEL_SIZE = 4096
+
     def __init__(self, capacity):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
             operation=np.add,
             neutral_element=0.0
         )
-        self._value = np.array(self._value)
+        # row sums and exclusive prefix sums of children are computed as matrix products,
+        # column j of _prefix_matrix sums up the first j children
+        self._ones = np.ones(self._branch, dtype=np.float32)
+        self._prefix_matrix = np.triu(np.ones((self._branch, self._branch + 1), dtype=np.float32), k=1)
+        self._search_level = min(k for k, level in enumerate(self._levels) if len(level) <= self.SEARCH_LEVEL_SIZE)
+        self._level_prefix = np.zeros(len(self._levels[self._search_level]) + 1, dtype=np.float64)
+        self._prefix_buf = np.empty(0, dtype=np.float32)
+
+    def _reduce_rows(self, rows, out):
+        np.matmul(rows, self._ones, out=out)
 
     def sum(self, start=0, end=None):
         """
@@ -129,26 +204,51 @@ class SumSegmentTree(SegmentTree):
         :param prefixsum: (np.ndarray) float upper bounds on the sum of array prefix
         :return: (np.ndarray) highest indexes satisfying the prefixsum constraint
         """
-        if isinstance(prefixsum, float):
+        if np.ndim(prefixsum) == 0:
             prefixsum = np.array([prefixsum])
+        num_sums = len(prefixsum)
         assert 0 <= np.min(prefixsum)
-        assert np.max(prefixsum) <= self.sum() + 1e-5
-        assert isinstance(prefixsum[0], float)
+        assert np.max(prefixsum) <= self._levels[-1][0] * (1 + 1e-5) + 1e-5
+
+        self._ensure_scratch(num_sums)
+        if len(self._prefix_buf) < num_sums * (self._branch + 1):
+            self._prefix_buf = np.empty(self._scratch_size * (self._branch + 1), dtype=np.float32)
+            self._row_offsets = np.arange(self._scratch_size, dtype=np.int64) * (self._branch + 1)
+        nodes = self._node_buf[:num_sums]
+        child = self._child_buf[:num_sums]
+        mass = self._mass_buf[:num_sums]
+        left_mass = self._reduce_buf[:num_sums]
+        flat_idx = self._flat_idx_buf[:num_sums]
+        block_vals = self._block_buf[:num_sums]
+        prefix = self._prefix_buf[:num_sums * (self._branch + 1)].reshape(num_sums, self._branch + 1)
+        is_left = self._mask_buf[:num_sums * self._branch].reshape(num_sums, self._branch)
+        row_offsets = self._row_offsets[:num_sums]
 
-        idx = np.ones(len(prefixsum), dtype=int)
-        cont = np.ones(len(prefixsum), dtype=bool)
+        # the top of the tree is small, so search the whole level at once
+        search_level = self._levels[self._search_level]
+        level_prefix = self._level_prefix
+        np.cumsum(search_level, out=level_prefix[1:])
+        found = np.searchsorted(level_prefix[1:], prefixsum, side='right')
+        np.minimum(found, len(search_level) - 1, out=nodes)
+        # the remaining mass is small relative to the total, so float32 is precise enough below the search level
+        np.subtract(prefixsum, level_prefix[nodes], out=mass, casting='unsafe')
+        mass_col = mass[:, None]
 
-        while np.any(cont):  # while not all nodes are leafs
-            idx[cont] = 2 * idx[cont]
-            prefixsum_new = np.where(self._value[idx] <= prefixsum, prefixsum - self._value[idx], prefixsum)
-            # prepare update of prefixsum for all right children
-            idx = np.where(np.logical_or(self._value[idx] > prefixsum, np.logical_not(cont)), idx, idx + 1)
-            # Select child node for non-leaf nodes
-            prefixsum = prefixsum_new
-            # update prefixsum
-            cont = idx < self._capacity
-            # collect leafs
-        return idx - self._capacity
+        for children in reversed(self._blocks[:self._search_level]):
+            np.take(children, nodes, axis=0, out=block_vals)
+            np.matmul(block_vals, self._prefix_matrix, out=prefix)
+            # children whose inclusive prefix sum is <= mass are skipped over, the
+            # first one that is not is found with argmin. The last child is never
+            # skipped, which also catches masses pushed past the block by rounding
+            np.less_equal(prefix[:, 1:], mass_col, out=is_left)
+            is_left[:, -1] = False
+            np.argmin(is_left, axis=1, out=child)
+            np.add(row_offsets, child, out=flat_idx)
+            np.take(prefix, flat_idx, out=left_mass)
+            np.subtract(mass, left_mass, out=mass)
+            np.left_shift(nodes, self._branch_bits, out=nodes)
+            np.add(nodes, child, out=nodes)
+        return np.minimum(nodes, self._capacity - 1)
 
 
 class MinSegmentTree(SegmentTree):
@@ -158,7 +258,6 @@ class MinSegmentTree(SegmentTree):
             operation=np.minimum,
             neutral_element=float('inf')
         )
-        self._value = np.array(self._value)
 
     def min(self, start=0, end=None):
         """
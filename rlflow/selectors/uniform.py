@@ -1,6 +1,6 @@
 import numpy as np
 import warnings
-from .base import BaseScheme
+from .base import BaseScheme, swap_remove_many
 
 class UniformSampleScheme(BaseScheme):
     def __init__(self, max_size, seed=None):
@@ -14,6 +14,13 @@ class UniformSampleScheme(BaseScheme):
         self.data_idxs[self.num_idxs] = id
         self.sample_idxs[id] = self.num_idxs
         self.num_idxs += 1
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        new_num_idxs = self.num_idxs + len(ids)
+        assert new_num_idxs <= self.max_size, "added elements make buffer greater than max size, make sure to remove elements first"
+        self.data_idxs[self.num_idxs:new_num_idxs] = ids
+        self.sample_idxs[ids] = np.arange(self.num_idxs, new_num_idxs)
+        self.num_idxs = new_num_idxs
     def sample(self, batch_size):
         if self.num_idxs < batch_size:
             return None, None
@@ -28,6 +35,20 @@ class UniformSampleScheme(BaseScheme):
             self.data_idxs[idx] = new_id
             self.sample_idxs[new_id] = idx
         self.num_idxs = new_idx
+    def remove_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        holes, movers, self.num_idxs = swap_remove_many(self.sample_idxs, self.data_idxs, self.num_idxs, ids)
+    def get_state(self):
+        return {
+            "sample_idxs": self.sample_idxs,
+            "data_idxs": self.data_idxs,
+            "num_idxs": np.array(self.num_idxs),
+        }
+    def set_state(self, state):
+        assert len(state["data_idxs"]) == self.max_size, "saved scheme state has a different size"
+        np.copyto(self.sample_idxs, state["sample_idxs"])
+        np.copyto(self.data_idxs, state["data_idxs"])
+        self.num_idxs = int(state["num_idxs"])
 
 def test():
     scheme = UniformSampleScheme(4)
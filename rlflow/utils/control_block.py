@@ -0,0 +1,111 @@
+import multiprocessing as mp
+import time
+from .shared_array import SharedArray
+import numpy as np
+
+# columns of the control block
+CMD_SEQ = 0
+CMD = 1
+CMD_ARG = 2
+DONE_SEQ = 3
+HAS_INFO = 4
+
+# how many times wait_done polls before blocking
+SPIN_ITERS = 100
+
+class ControlBlock:
+    '''
+    Shared memory command/status block between a process and its
+    worker processes, so commands and their completion are signalled
+    without pickling anything or going through a pipe.
+
+    Each worker has a row of int64s: the command, its argument and the
+    sequence number of the last command sent and finished. Semaphores
+    signal new commands and finished ones, and make the rows (and any
+    other shared memory the worker wrote) visible to the other side.
+    Workers set HAS_INFO when they have sent extra data over a pipe, so
+    the pipe is only read when there is something on it.
+
+    A worker process can own several rows, e.g. one per env it steps,
+    and get its commands some other way (see mark_sent).
+    '''
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.block = SharedArray((num_workers, 5), dtype=np.int64)
+        self.block.np_arr[:] = 0
+        self.cmd_sems = [mp.Semaphore(0) for _ in range(num_workers)]
+        self.done_sems = [mp.Semaphore(0) for _ in range(num_workers)]
+        # released on every finished command, only used to sleep in wait_any.
+        # Every finish is collected by a wait_done, which takes one release
+        # back if wait_any has not drained it, so the count stays bounded.
+        self.any_done = mp.Semaphore(0)
+
+    def send(self, worker, cmd, arg=0):
+        row = self.block.np_arr[worker]
+        row[CMD] = cmd
+        row[CMD_ARG] = arg
+        self.mark_sent(worker)
+        self.cmd_sems[worker].release()
+
+    def mark_sent(self, worker):
+        '''
+        counts a command as sent without waking the worker, for commands
+        that reach it some other way, e.g. over a pipe along with their data.
+        Their completion is still signalled with finish.
+        '''
+        self.block.np_arr[worker, CMD_SEQ] += 1
+
+    def is_done(self, worker):
+        row = self.block.np_arr[worker]
+        return row[DONE_SEQ] == row[CMD_SEQ]
+
+    def wait_done(self, worker, proc=None):
+        '''
+        blocks until the last command sent to the worker is finished,
+        returns whether the worker sent infos over its pipe
+        '''
+        sem = self.done_sems[worker]
+        for _ in range(SPIN_ITERS):
+            if sem.acquire(False):
+                break
+        else:
+            while not sem.acquire(timeout=1.0):
+                assert proc is None or proc.is_alive(), "worker process died"
+        self.any_done.acquire(False)
+        return bool(self.block.np_arr[worker, HAS_INFO])
+
+    def wait_any(self, workers, timeout=None):
+        '''
+        blocks until at least one of the workers is done, or the timeout runs
+        out, and returns all of them that are. Their results still have to
+        be collected with wait_done.
+        '''
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            # wakeups that were already accounted for by the scan below are dropped
+            while self.any_done.acquire(False):
+                pass
+            done_workers = [worker for worker in workers if self.is_done(worker)]
+            if done_workers:
+                return done_workers
+            remaining = None if end_time is None else max(0., end_time - time.time())
+            if not self.any_done.acquire(timeout=remaining):
+                return []
+
+    def recv_command(self, worker):
+        '''
+        worker side, blocks until a command is sent, returns (cmd, arg)
+        '''
+        self.cmd_sems[worker].acquire()
+        row = self.block.np_arr[worker]
+        return int(row[CMD]), int(row[CMD_ARG])
+
+    def finish(self, worker, has_info=False):
+        '''
+        worker side, marks the last command as finished
+        '''
+        row = self.block.np_arr[worker]
+        row[HAS_INFO] = has_info
+        row[DONE_SEQ] = row[CMD_SEQ]
+        self.done_sems[worker].release()
+        self.any_done.release()
@@ -0,0 +1,61 @@
+import os
+
+def can_set_affinity():
+    return hasattr(os, "sched_setaffinity")
+
+class CPUPlacement:
+    '''
+    Pins processes to cores, so vector env workers stay off the cores
+    reserved for the learner and the batch generator, and don't migrate
+    away from the memory they touched first (see SharedArray first_touch).
+
+    The first num_reserved of the cpus (by default the ones this process
+    may run on) are reserved, workers are spread round robin over the rest.
+    Does nothing where the OS does not support setting the affinity.
+    '''
+    def __init__(self, num_reserved=2, cpus=None, worker_offset=0):
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0)) if can_set_affinity() else list(range(os.cpu_count()))
+        cpus = list(cpus)
+        assert len(cpus) > num_reserved, "no cores left for the workers after reserving {}".format(num_reserved)
+        self.cpus = cpus
+        self.num_reserved = num_reserved
+        self.reserved_cpus = cpus[:num_reserved]
+        self.worker_cpus = cpus[num_reserved:]
+        self.worker_offset = worker_offset
+
+    def shifted(self, worker_offset):
+        '''
+        placement for another set of workers, which start worker_offset
+        cores further, e.g. the vector env of the next actor
+        '''
+        return CPUPlacement(self.num_reserved, self.cpus, self.worker_offset + worker_offset)
+
+    def split(self, num_parts, workers_per_part):
+        '''
+        placements for num_parts sets of workers_per_part workers each,
+        e.g. the vector envs of several actors, on consecutive cores
+        '''
+        return [self.shifted(part*workers_per_part) for part in range(num_parts)]
+
+    def worker_cpu(self, worker_idx):
+        return self.worker_cpus[(self.worker_offset + worker_idx) % len(self.worker_cpus)]
+
+    def pin_worker(self, worker_idx):
+        if can_set_affinity():
+            os.sched_setaffinity(0, {self.worker_cpu(worker_idx)})
+
+    def first_touch(self, shared_arrays, rows):
+        '''
+        writes the rows of the SharedArrays (made with first_touch) that the
+        calling worker uses, so they are allocated on the NUMA node of its core
+        '''
+        for shared in shared_arrays:
+            shared.np_arr[rows] = 0
+
+    def pin_reserved(self):
+        '''
+        pins the calling process (learner, batch generator) to the reserved cores
+        '''
+        if can_set_affinity():
+            os.sched_setaffinity(0, self.reserved_cpus)
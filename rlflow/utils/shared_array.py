@@ -1,15 +1,25 @@
 import multiprocessing as mp
 import numpy as np
+import mmap
 
 class SharedArray:
-    def __init__(self, shape, dtype):
-        self.shared_arr = mp.Array(np.ctypeslib.as_ctypes_type(dtype),int(np.prod(shape)),lock=False)
+    def __init__(self, shape, dtype, first_touch=False):
+        '''
+        with first_touch, the memory is mapped without being written to, so each
+        page ends up on the NUMA node of the process that writes it first.
+        Such arrays are only shared with processes forked after creating them.
+        '''
+        if first_touch:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self.shared_arr = mmap.mmap(-1, max(nbytes, 1))
+        else:
+            self.shared_arr = mp.Array(np.ctypeslib.as_ctypes_type(dtype),int(np.prod(shape)),lock=False)
         self.dtype = dtype
         self.shape = shape
         self._set_np_arr()
 
     def _set_np_arr(self):
-        self.np_arr = np.frombuffer(self.shared_arr, dtype=self.dtype).reshape(self.shape)
+        self.np_arr = np.frombuffer(self.shared_arr, dtype=self.dtype, count=int(np.prod(self.shape))).reshape(self.shape)
 
     def __getstate__(self):
         return (self.shared_arr,self.dtype,self.shape)
@@ -0,0 +1,141 @@
+import multiprocessing as mp
+from .shared_array import SharedArray
+import numpy as np
+
+class BatchLease:
+    '''
+    Read-only views of one batch queue slot. The slot stays reserved
+    until release() is called or the `with` block exits, so the views
+    must not be used after that.
+    '''
+    def __init__(self, batch_queue, data):
+        self.batch_queue = batch_queue
+        self.data = data
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.batch_queue._release(self)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class SharedBatchQueue:
+    '''
+    Queue of num_slots batches in shared memory, between one producer
+    (the batch generator) and one consumer (the learner).
+
+    The producer checks for a free slot without blocking, so it can keep
+    receiving transitions while the queue is full. The consumer blocks on
+    a semaphore counting the filled slots instead of polling.
+
+    Several queues can share an any_filled semaphore, which counts the
+    filled slots of all of them, so that their consumer can take batches
+    from whichever queue has one, see lease_any.
+    '''
+    def __init__(self, data_example, num_slots, any_filled=None):
+        assert num_slots > 0, "batch queue needs at least one slot"
+        self.num_slots = num_slots
+        self.any_filled = any_filled
+        self.shared_data = []
+        self.copied_data = []
+        for arr in data_example:
+            assert np.issubdtype(arr.dtype, np.number) or np.issubdtype(arr.dtype, np.uint8), "dtype of transition must be a number or bool, something wrong in adder or environment"
+            self.shared_data.append(SharedArray((num_slots,)+tuple(arr.shape),dtype=arr.dtype))
+            self.copied_data.append(np.empty(arr.shape,dtype=arr.dtype))
+        # [write count, read count]
+        self.counters = SharedArray((2,),dtype=np.int64)
+        self.counters.np_arr[:] = 0
+        self.filled = mp.Semaphore(0)
+        # leases still held by the consumer, oldest first
+        self.leases = []
+
+    def __len__(self):
+        counters = self.counters.np_arr
+        return int(counters[0] - counters[1])
+
+    def can_store(self):
+        return len(self) < self.num_slots
+
+    def store(self, data_store):
+        assert len(data_store) == len(self.shared_data)
+        for source, dest in zip(data_store, self.next_slot()):
+            np.copyto(dest, source)
+        self.publish()
+
+    def next_slot(self):
+        '''
+        returns writable views of the next free slot, so that a batch can be
+        built in place. The batch is handed to the consumer by publish()
+        '''
+        assert self.can_store(), "batch queue is full, check can_store before storing"
+        slot = int(self.counters.np_arr[0]) % self.num_slots
+        return [dest.np_arr[slot, ...] for dest in self.shared_data]
+
+    def publish(self):
+        self.counters.np_arr[0] += 1
+        self.filled.release()
+        if self.any_filled is not None:
+            self.any_filled.release()
+
+    def get_wait(self, timeout=None):
+        '''
+        blocks until a batch is available and returns a copy of it,
+        returns None if the timeout runs out first
+        '''
+        if not self.filled.acquire(timeout=timeout):
+            return None
+
+        assert not self.leases, "cannot copy out batches while batches are leased"
+        read_count = int(self.counters.np_arr[1])
+        slot = read_count % self.num_slots
+        for dest, src in zip(self.copied_data, self.shared_data):
+            np.copyto(dest, src.np_arr[slot])
+        self.counters.np_arr[1] = read_count + 1
+        return self.copied_data
+
+    def get(self):
+        return self.get_wait(timeout=0)
+
+    def lease(self, timeout=None):
+        '''
+        blocks until a batch is available and returns a BatchLease on
+        its slot without copying, returns None if the timeout runs out first
+        '''
+        if not self.filled.acquire(timeout=timeout):
+            return None
+
+        slot = (int(self.counters.np_arr[1]) + len(self.leases)) % self.num_slots
+        data = []
+        for src in self.shared_data:
+            view = src.np_arr[slot, ...]
+            view.flags.writeable = False
+            data.append(view)
+        lease = BatchLease(self, data)
+        self.leases.append(lease)
+        return lease
+
+    def _release(self, lease):
+        assert self.leases and self.leases[0] is lease, "leases have to be released in the order they were taken"
+        self.leases.pop(0)
+        self.counters.np_arr[1] += 1
+
+def lease_any(batch_queues, any_filled, timeout=None, start=0):
+    '''
+    blocks until one of the batch_queues, which share the any_filled
+    semaphore, has a batch and returns a BatchLease on it, returns None
+    if the timeout runs out first. The queues are tried from start on,
+    so that a rotating start spreads the leases over them.
+    '''
+    if not any_filled.acquire(timeout=timeout):
+        return None
+    for i in range(len(batch_queues)):
+        # a batch is published before any_filled is released, so one of these succeeds
+        lease = batch_queues[(start + i) % len(batch_queues)].lease(timeout=0)
+        if lease is not None:
+            return lease
+    assert False, "any_filled was released without a batch being published"
@@ -0,0 +1,62 @@
+from .shared_array import SharedArray
+import numpy as np
+
+class SharedInfoSchema:
+    '''
+    Moves declared numeric info keys of vector environment workers through
+    shared memory instead of pickling them.
+
+    info_example maps each declared key to an example value, e.g.
+        {"lives": np.int32(0), "TimeLimit.truncated": False, "legal_moves": np.zeros(9, dtype=np.uint8)}
+    Every key gets a (num_envs,)+shape array and a flag per env telling
+    whether the env's info had the key. Keys that are not declared are
+    left in the info dicts, to be sent as before.
+    '''
+    def __init__(self, info_example, num_envs):
+        self.keys = list(info_example)
+        self.key_idxs = {key: i for i, key in enumerate(self.keys)}
+        self.arrays = []
+        for key in self.keys:
+            example = np.asarray(info_example[key])
+            assert np.issubdtype(example.dtype, np.number) or np.issubdtype(example.dtype, np.bool_), "declared info keys must be numeric, {} is not".format(key)
+            self.arrays.append(SharedArray((num_envs,)+example.shape, dtype=example.dtype))
+        self.present = SharedArray((len(self.keys), num_envs), dtype=np.uint8)
+        self.present.np_arr[:] = 0
+
+    def write(self, infos, start_idx):
+        '''
+        worker side, stores the declared keys of the infos of envs
+        start_idx, start_idx+1, ... and returns the infos without them
+        '''
+        present = self.present.np_arr
+        present[:, start_idx:start_idx+len(infos)] = 0
+        rest = []
+        for i, info in enumerate(infos):
+            if info:
+                left = {}
+                for key, value in info.items():
+                    key_idx = self.key_idxs.get(key)
+                    if key_idx is None:
+                        left[key] = value
+                    else:
+                        self.arrays[key_idx].np_arr[start_idx+i] = value
+                        present[key_idx, start_idx+i] = 1
+                info = left
+            rest.append(info)
+        return rest
+
+    def read(self, infos, start_idx):
+        '''
+        puts the stored keys back into the infos of envs start_idx,
+        start_idx+1, ... The info dicts are replaced rather than changed,
+        as they may be shared between envs.
+        '''
+        end_idx = start_idx + len(infos)
+        present = self.present.np_arr[:, start_idx:end_idx]
+        for env_idx in np.flatnonzero(present.any(axis=0)).tolist():
+            info = dict(infos[env_idx])
+            for key_idx in np.flatnonzero(present[:, env_idx]).tolist():
+                value = self.arrays[key_idx].np_arr[start_idx+env_idx]
+                info[self.keys[key_idx]] = value.copy() if value.ndim else value.item()
+            infos[env_idx] = info
+        return infos
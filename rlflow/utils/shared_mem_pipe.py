@@ -47,3 +47,10 @@ class SharedMemPipe:
                 return None
 
         return self.get_wait()
+
+    def drain(self):
+        data = self.get()
+        if data is None:
+            return None
+
+        return [np.expand_dims(arr, 0) for arr in data]
@@ -0,0 +1,90 @@
+import time
+from .shared_array import SharedArray
+import numpy as np
+
+class SharedRingBuffer:
+    '''
+    Single producer, single consumer queue of transitions in shared memory.
+
+    Each field is stored in a (num_slots,)+shape SharedArray. The producer
+    only ever writes the write counter and the consumer only ever writes
+    the read counter, so no lock is needed: the data is always copied in
+    before the counter that publishes it is bumped. Counters only grow,
+    the slot of an entry is its count modulo num_slots.
+
+    Unlike SharedMemPipe, nothing is overwritten: if the consumer falls
+    behind, the producer waits for free slots.
+    '''
+    def __init__(self, data_example, num_slots):
+        assert num_slots > 0, "ring buffer needs at least one slot"
+        self.num_slots = num_slots
+        self.shared_data = []
+        for arr in data_example:
+            assert np.issubdtype(arr.dtype, np.number) or np.issubdtype(arr.dtype, np.uint8), "dtype of transition must be a number or bool, something wrong in adder or environment"
+            self.shared_data.append(SharedArray((num_slots,)+tuple(arr.shape),dtype=arr.dtype))
+        # [write count, read count]
+        self.counters = SharedArray((2,),dtype=np.int64)
+        self.counters.np_arr[:] = 0
+
+    def __len__(self):
+        counters = self.counters.np_arr
+        return int(counters[0] - counters[1])
+
+    def can_store(self):
+        return len(self) < self.num_slots
+
+    def store(self, data):
+        assert len(data) == len(self.shared_data)
+        self._wait_free(1)
+        write_count = int(self.counters.np_arr[0])
+        slot = write_count % self.num_slots
+        for source, dest in zip(data, self.shared_data):
+            dest.np_arr[slot] = source
+        self.counters.np_arr[0] = write_count + 1
+
+    def put_many(self, batch):
+        '''
+        args:
+          batch: list of arrays, one per field, each stacked along a
+            leading batch dimension
+        '''
+        assert len(batch) == len(self.shared_data)
+        batch_size = len(batch[0])
+        start = 0
+        while start < batch_size:
+            num_put = min(batch_size - start, self.num_slots)
+            self._wait_free(num_put)
+            write_count = int(self.counters.np_arr[0])
+            slots = np.arange(write_count, write_count+num_put) % self.num_slots
+            for source, dest in zip(batch, self.shared_data):
+                dest.np_arr[slots] = source[start:start+num_put]
+            self.counters.np_arr[0] = write_count + num_put
+            start += num_put
+
+    def drain(self, max_items=None):
+        '''
+        returns all pending entries as a list of arrays, one per field,
+        stacked along a leading batch dimension, or None if empty
+        '''
+        counters = self.counters.np_arr
+        read_count = int(counters[1])
+        num_items = int(counters[0]) - read_count
+        if max_items is not None:
+            num_items = min(num_items, max_items)
+        if num_items == 0:
+            return None
+
+        slots = np.arange(read_count, read_count+num_items)
+        result = [np.take(src.np_arr, slots, axis=0, mode='wrap') for src in self.shared_data]
+        counters[1] = read_count + num_items
+        return result
+
+    def get(self):
+        entries = self.drain(1)
+        if entries is None:
+            return None
+        return [entry[0] for entry in entries]
+
+    def _wait_free(self, num_slots):
+        while self.num_slots - len(self) < num_slots:
+            time.sleep(0.0001)
@@ -6,6 +6,8 @@ import numpy as np
 import ctypes
 import gym
 from .vector_env import VectorAECWrapper
+from ..utils.control_block import ControlBlock
+from ..utils.shared_info import SharedInfoSchema
 import warnings
 import signal
 import traceback
@@ -158,7 +160,19 @@ def decompress_info(agents, num_envs, idx_starts, comp_infos):
     return all_info
 
 
-def env_worker(env_constructors, total_num_envs, idx_start, my_num_envs, agent_arrays, env_arrays, pipe):
+# commands sent through the control block, the seed is sent over the pipe
+RESET = 1
+OBSERVE = 2
+STEP = 3
+SEED = 4
+TERMINATE = 5
+
+def write_infos(infos, idx_start, info_schemas):
+    if info_schemas is None:
+        return infos
+    return {agent: info_schemas[agent].write(infs, idx_start) for agent, infs in infos.items()}
+
+def env_worker(env_constructors, total_num_envs, idx_start, my_num_envs, agent_arrays, env_arrays, worker, control, pipe, info_schemas):
     try:
         env = _SeperableAECWrapper(env_constructors, my_num_envs)
         shared_datas = {agent: AgentSharedData(total_num_envs,
@@ -171,23 +185,23 @@ def env_worker(env_constructors, total_num_envs, idx_start, my_num_envs, agent_a
 
 
         while True:
-            instruction, data = pipe.recv()
-            if instruction == "reset":
+            instruction, agent_idx = control.recv_command(worker)
+            comp_infos = {}
+            if instruction == RESET:
                 env.reset()
                 write_out_data(env.rewards,env._cumulative_rewards,env.dones,my_num_envs,idx_start,shared_datas)
                 env_dones = np.zeros(my_num_envs,dtype=np.uint8)
                 write_env_data(env_dones,env.get_agent_indexes(),my_num_envs, idx_start, env_datas)
 
-                pipe.send(compress_info(env.infos))
+                comp_infos = compress_info(write_infos(env.infos, idx_start, info_schemas))
 
-            elif instruction == "observe":
-                agent_observe = data
+            elif instruction == OBSERVE:
+                agent_observe = env.possible_agents[agent_idx]
                 obs = env.observe(agent_observe)
                 write_obs(obs, my_num_envs, idx_start, shared_datas[agent_observe])
 
-                pipe.send(True)
-            elif instruction == "step":
-                step_agent, do_observe = data
+            elif instruction == STEP:
+                step_agent = env.possible_agents[agent_idx]
 
                 actions = shared_datas[step_agent].act.nparr[idx_start:idx_start+my_num_envs]
 
@@ -195,20 +209,27 @@ def env_worker(env_constructors, total_num_envs, idx_start, my_num_envs, agent_a
                 write_out_data(env.rewards,env._cumulative_rewards,env.dones,my_num_envs,idx_start,shared_datas)
                 write_env_data(env_dones, env.get_agent_indexes(), my_num_envs, idx_start, env_datas)
 
-                pipe.send(compress_info(env.infos))
-            elif instruction == "seed":
-                env.seed(data)
-                pipe.send(True)
-            elif instruction == "terminate":
+                comp_infos = compress_info(write_infos(env.infos, idx_start, info_schemas))
+            elif instruction == SEED:
+                env.seed(pipe.recv())
+            elif instruction == TERMINATE:
                 return
             else:
                 assert False, "Bad instruction sent to ProcVectorEnv worker"
+
+            if comp_infos:
+                pipe.send(comp_infos)
+            control.finish(worker, has_info=bool(comp_infos))
     except Exception as e:
         tb = traceback.format_exc()
         pipe.send((e,tb))
+        control.finish(worker, has_info=True)
 
 class ProcVectorEnv(VectorAECWrapper):
-    def __init__(self, env_constructors, num_cpus=None, return_copy=True):
+    '''
+    info_schema is the info_example of a SharedInfoSchema, used for every agent
+    '''
+    def __init__(self, env_constructors, num_cpus=None, return_copy=True, info_schema=None):
         # set signaling so that crashing is handled gracefully
         init_parallel_env()
 
@@ -252,8 +273,10 @@ class ProcVectorEnv(VectorAECWrapper):
 
         self.env_datas = EnvSharedData(num_envs, env_arrays)
         self.return_copy = return_copy
+        self.info_schemas = None if info_schema is None else {agent: SharedInfoSchema(info_schema, num_envs) for agent in self.possible_agents}
 
         self.procs = []
+        self.control = ControlBlock(num_cpus)
         self.pipes = [mp.Pipe() for _ in range(num_cpus)]
         self.con_ins = [con_in for con_in,con_out in self.pipes]
         self.con_outs = [con_out for con_in,con_out in self.pipes]
@@ -263,7 +286,7 @@ class ProcVectorEnv(VectorAECWrapper):
             envs_left = num_envs - env_counter
             allocated_envs = min(envs_left,(num_envs+num_cpus-1)//num_cpus)
             proc_constructors = env_constructors[env_counter:env_counter+allocated_envs]
-            proc = mp.Process(target=env_worker,args=(proc_constructors, num_envs, env_counter, allocated_envs, all_arrays, env_arrays, self.con_outs[pidx]))
+            proc = mp.Process(target=env_worker,args=(proc_constructors, num_envs, env_counter, allocated_envs, all_arrays, env_arrays, pidx, self.control, self.con_outs[pidx], self.info_schemas))
             self.procs.append(proc)
             self.env_starts.append(env_counter)
 
@@ -276,10 +299,16 @@ class ProcVectorEnv(VectorAECWrapper):
             cur_selection = self._agent_selector.next()
         return cur_selection
 
+    def _send_all(self, instruction, agent=None):
+        agent_idx = 0 if agent is None else self.agent_indexes[agent]
+        for worker in range(len(self.con_ins)):
+            self.control.send(worker, instruction, agent_idx)
+
     def _receive_info(self):
         all_data = []
-        for cin in self.con_ins:
-            data = cin.recv()
+        for worker, cin in enumerate(self.con_ins):
+            has_info = self.control.wait_done(worker, self.procs[worker])
+            data = cin.recv() if has_info else {}
             if isinstance(data,tuple):
                 err,tb = data
                 print(tb)
@@ -297,6 +326,9 @@ class ProcVectorEnv(VectorAECWrapper):
         all_compressed_info = self._receive_info()
 
         all_info = decompress_info(self.possible_agents, self.num_envs, self.env_starts, all_compressed_info)
+        if self.info_schemas is not None:
+            for agent, info_schema in self.info_schemas.items():
+                info_schema.read(all_info[agent], 0)
 
         self.agent_selection = self._agent_selector.reset() if reset else self._agent_selector.next()
         self.agent_selection = self._find_active_agent()
@@ -323,8 +355,7 @@ class ProcVectorEnv(VectorAECWrapper):
         return obs, self._cumulative_rewards[last_agent], self.dones[last_agent], self.env_dones, self.passes, self.infos[last_agent]
 
     def reset(self, observe=True):
-        for cin in self.con_ins:
-            cin.send(("reset", observe))
+        self._send_all(RESET)
 
         self._load_next_data(True)
 
@@ -332,14 +363,12 @@ class ProcVectorEnv(VectorAECWrapper):
         step_agent = self.agent_selection
 
         self.shared_datas[self.agent_selection].act.nparr[:] = actions
-        for cin in self.con_ins:
-            cin.send(("step", (step_agent, observe)))
+        self._send_all(STEP, step_agent)
 
         self._load_next_data(False)
 
     def observe(self, agent):
-        for cin in self.con_ins:
-            cin.send(("observe", agent))
+        self._send_all(OBSERVE, agent)
 
         # wait until all are finished
         self._receive_info()
@@ -349,12 +378,12 @@ class ProcVectorEnv(VectorAECWrapper):
 
     def seed(self, seed):
         for cin in self.con_ins:
-            cin.send(("seed",seed))
+            cin.send(seed)
+        self._send_all(SEED)
 
         self._receive_info()
 
     def __del__(self):
-        for cin in self.con_ins:
-            cin.send(("terminate", None))
+        self._send_all(TERMINATE)
         for proc in self.procs:
             proc.join()
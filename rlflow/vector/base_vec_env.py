@@ -0,0 +1,32 @@
+class VectorBaseEnv:
+    '''
+    Interface of the markov vector environments (SingleVecEnv, ConcatVecEnv,
+    ProcConcatVec, MarkovVectorEnv), which step num_envs environments at
+    once and reset each of them automatically when its episode ends.
+
+    terminal_obs: (num_envs,)+observation_space.shape array of the
+        observations that ended an episode. Row i is only valid after a step
+        where env i is done, as the observation returned for it already starts
+        the next episode. It may be set to another buffer (e.g. shared memory),
+        which the environment then writes into.
+    '''
+    def reset(self):
+        '''
+        returns: the stacked observations of all environments
+        '''
+
+    def step_async(self, actions):
+        '''
+        starts stepping all environments with the stacked actions
+        '''
+
+    def step_wait(self):
+        '''
+        returns: the stacked observations, rewards, dones and the infos
+        of the step started by step_async
+        '''
+
+    def step(self, actions):
+        '''
+        step_async followed by step_wait
+        '''
@@ -1,9 +1,6 @@
 import numpy as np
 from .single_vec_env import SingleVecEnv
 
-def transpose(ll):
-    return [[ll[i][j] for i in range(len(ll))] for j in range(len(ll[0]))]
-
 class ConcatVecEnv:
     def __init__(self, vec_env_fns, obs_space=None, act_space=None):
         self.vec_envs = vec_envs = [vec_env_fn() for vec_env_fn in vec_env_fns]
@@ -15,13 +12,36 @@ class ConcatVecEnv:
         tot_num_envs = sum(env.num_envs for env in vec_envs)
         self.num_envs = tot_num_envs
         self.obs_buffer = np.empty((self.num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
+        self.terminal_obs = np.zeros((self.num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
+        # step results are written into these by slice, and reused on the next step
+        self.rew_buffer = np.zeros(self.num_envs, dtype=np.float32)
+        self.done_buffer = np.zeros(self.num_envs, dtype=np.uint8)
+        self.env_slices = []
+        idx = 0
+        for venv in vec_envs:
+            self.env_slices.append(slice(idx, idx + venv.num_envs))
+            idx += venv.num_envs
 
-    def concat_obs(self, obs_list):
+    @property
+    def terminal_obs(self):
+        '''
+        see VectorBaseEnv. The sub environments write straight into slices
+        of it, so setting it to another buffer (e.g. shared memory) redirects them.
+        '''
+        return self._terminal_obs
+
+    @terminal_obs.setter
+    def terminal_obs(self, buffer):
+        self._terminal_obs = buffer
         idx = 0
-        for venv,obs in zip(self.vec_envs,obs_list):
+        for venv in self.vec_envs:
             endidx = idx + venv.num_envs
-            self.obs_buffer[idx:endidx] = obs
+            venv.terminal_obs = buffer[idx:endidx]
             idx = endidx
+
+    def concat_obs(self, obs_list):
+        for env_slice,obs in zip(self.env_slices,obs_list):
+            self.obs_buffer[env_slice] = obs
         return self.obs_buffer
 
     def reset(self):
@@ -34,14 +54,16 @@ class ConcatVecEnv:
         return self.step(self._saved_actions)
 
     def step(self, actions):
-        data = []
-        idx = 0
-        for venv in self.vec_envs:
-            data.append(venv.step(actions[idx:idx+venv.num_envs]))
-            idx += venv.num_envs
-        observations, rewards, dones, infos = transpose(data)
-        observations = self.concat_obs(observations)
-        rewards = np.concatenate(rewards, axis=0)
-        dones = np.concatenate(dones, axis=0)
-        infos = sum(infos, [])
-        return observations, rewards, dones, infos
+        '''
+        the returned arrays are overwritten by the next step (like the shared
+        memory arrays of ProcConcatVec), so they have to be copied to be kept
+        for longer. The info list is new every step.
+        '''
+        all_infos = []
+        for venv, env_slice in zip(self.vec_envs, self.env_slices):
+            observations, rewards, dones, infos = venv.step(actions[env_slice])
+            self.obs_buffer[env_slice] = observations
+            self.rew_buffer[env_slice] = rewards
+            self.done_buffer[env_slice] = dones
+            all_infos.extend(infos)
+        return self.obs_buffer, self.rew_buffer, self.done_buffer, all_infos
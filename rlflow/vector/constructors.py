@@ -1,5 +1,7 @@
 from .concat_vec_env import ConcatVecEnv
 from .multiproc_vec import ProcConcatVec
+import numpy as np
+import time
 
 class call_wrap:
     def __init__(self, fn, data):
@@ -8,8 +10,66 @@ class call_wrap:
     def __call__(self, *args):
         return self.fn(self.data)
 
-def MakeCPUAsyncConstructor(max_num_cpus):
+def time_vec_env(vec_env, act_space, min_time):
+    '''
+    returns the env steps per second of stepping vec_env for min_time seconds
+    '''
+    vec_env.reset()
+    actions = np.stack([act_space.sample() for _ in range(vec_env.num_envs)])
+    vec_env.step(actions)
+    num_steps = 0
+    start = time.time()
+    while time.time() - start < min_time:
+        vec_env.step(actions)
+        num_steps += 1
+    return num_steps * vec_env.num_envs / (time.time() - start)
+
+def calibrate_num_cpus(env_fn_list, obs_space, act_space, max_num_cpus, num_groups=1, info_schema=None, trial_time=1.0):
+    '''
+    times stepping the actual environments in-process and with different
+    numbers of worker processes (and so envs per worker), up to
+    max_num_cpus. Returns the fastest number of cpus along with the
+    measurements, {num_cpus: {"envs_per_cpu", "steps_per_sec"}}, for the
+    caller to log.
+    '''
+    num_fns = len(env_fn_list)
+    max_num_cpus = min(max_num_cpus, num_fns)
+    candidates = {max_num_cpus} | {2**i for i in range(max_num_cpus.bit_length()) if 2**i <= max_num_cpus}
+    if num_groups == 1:
+        candidates.add(0)
+    stats = {}
+    for num_cpus in sorted(c for c in candidates if c == 0 or c >= num_groups):
+        vec_env = MakeCPUAsyncConstructor(num_cpus, num_groups, info_schema)(env_fn_list, obs_space, act_space)
+        stats[num_cpus] = {
+            "envs_per_cpu": num_fns if num_cpus == 0 else (num_fns+num_cpus-1)//num_cpus,
+            "steps_per_sec": time_vec_env(vec_env, act_space, trial_time),
+        }
+        del vec_env
+
+    best_num_cpus = max(stats, key=lambda num_cpus: stats[num_cpus]["steps_per_sec"])
+    return best_num_cpus, stats
+
+def MakeCPUAsyncConstructor(max_num_cpus, num_groups=1, info_schema=None, placement=None, calibrate=False):
+    '''
+    num_groups > 1 splits the worker processes into groups that can be
+    stepped while the policy acts on the others, info_schema declares info
+    keys sent through shared memory, placement pins the worker processes
+    to cores, see ProcConcatVec
+
+    with calibrate, the constructor first benchmarks the environments to
+    pick how many of the max_num_cpus to use, see calibrate_num_cpus. The
+    choice and the measurements are kept in the calibration attribute of
+    the returned vector env, as (num_cpus, stats).
+    '''
+    if calibrate:
+        def calibrated_constructor(env_fn_list, obs_space, act_space):
+            num_cpus, stats = calibrate_num_cpus(env_fn_list, obs_space, act_space, max_num_cpus, num_groups, info_schema)
+            vec_env = MakeCPUAsyncConstructor(num_cpus, num_groups, info_schema, placement)(env_fn_list, obs_space, act_space)
+            vec_env.calibration = (num_cpus, stats)
+            return vec_env
+        return calibrated_constructor
     if max_num_cpus == 0:
+        assert num_groups == 1, "split batch stepping needs worker processes"
         return ConcatVecEnv
     else:
         def constructor(env_fn_list, obs_space, act_space):
@@ -30,5 +90,5 @@ def MakeCPUAsyncConstructor(max_num_cpus):
             assert alloced_num_cpus == len(env_cpu_div)
 
             cat_env_fns = [call_wrap(ConcatVecEnv, env_fns) for env_fns in env_cpu_div]
-            return ProcConcatVec(cat_env_fns, obs_space, act_space, num_fns*envs_per_env)
+            return ProcConcatVec(cat_env_fns, obs_space, act_space, num_fns*envs_per_env, num_groups, info_schema, placement)
         return constructor
@@ -76,20 +76,30 @@ class RolloutBuilder:
         self.start_states = policy.start_state()
         self.states = self.start_states
 
-    def rollout(self, policy, n_steps, deterministic=False):
+    def rollout(self, policy, n_steps, deterministic=False, adders=()):
+        '''
+        if adders (see GymVectorBaseAdder) are given, every step is also
+        passed on to them, and policy.rollout_step has to return
+        (actions, states, actor_infos)
+        '''
         assert self.prev_observes is not None, "must call restart()  before rollout()"
         num_envs = self.vec_env.num_envs
         rews = np.empty((n_steps,self.num_envs),dtype=np.float32)
         dones = np.empty((n_steps,self.num_envs),dtype=np.uint8)
         infos = []
         for x in range(n_steps):
-            actions,states = policy.rollout_step(self.prev_observes, self.prev_infos, self.states)
+            if adders:
+                actions,states,actor_infos = policy.rollout_step(self.prev_observes, self.prev_infos, self.states)
+            else:
+                actions,states = policy.rollout_step(self.prev_observes, self.prev_infos, self.states)
 
             obs, rew, done, info = self.vec_env.step(actions)
+            for adder in adders:
+                adder.add(obs, actions, rew, done, info, actor_infos)
 
             if self.obs_buffer is None or len(self.obs_buffer) != n_steps:
                 # cache observation buffer between rollout so it doesn't have to always reallocate
-                self.obs_buffer = np.empty((n_steps,self.num_envs)+obs.shape,dtype=obs.dtype)
+                self.obs_buffer = np.empty((n_steps,)+obs.shape,dtype=obs.dtype)
 
             self.obs_buffer[x] = obs
             rews[x] = rew
@@ -97,9 +107,10 @@ class RolloutBuilder:
             infos.append(info)
 
             # clear states of done environments
-            for i in range(num_envs):
-                if done[i]:
-                    states[i] = self.start_states[i]
+            if states is not None:
+                for i in range(num_envs):
+                    if done[i]:
+                        states[i] = self.start_states[i]
 
             self.states = states
             self.prev_observes = obs
@@ -19,16 +19,19 @@ class MarkovVectorEnv:
         self.num_envs = len(par_env.possible_agents)
         self.black_death = black_death
         self.obs_buffer = np.empty((self.num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
+        self.terminal_obs = np.zeros((self.num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
 
     def seed(self, seed=None):
         self.par_env.seed(seed)
 
-    def concat_obs(self, obs_dict):
+    def concat_obs(self, obs_dict, out=None):
+        if out is None:
+            out = self.obs_buffer
         if self.black_death:
-            self.obs_buffer[:] = 0
+            out[:] = 0
         for i, agent in enumerate(self.par_env.possible_agents):
-            self.obs_buffer[i] = obs_dict[agent]
-        return self.obs_buffer
+            out[i] = obs_dict[agent]
+        return out
 
     def step_async(self, actions):
         self._saved_actions = actions
@@ -43,7 +46,8 @@ class MarkovVectorEnv:
         agent_set = set(self.par_env.agents)
         act_dict = {agent: actions[i] for i,agent in enumerate(self.par_env.possible_agents) if agent in agent_set}
         observations, rewards, dones, infos = self.par_env.step(act_dict)
-        if all(dones):
+        if all(dones.values()):
+            self.concat_obs(observations, self.terminal_obs)
             observations = self.reset()
         else:
             observations = self.concat_obs(observations)
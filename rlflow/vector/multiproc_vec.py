@@ -1,8 +1,16 @@
 from ..utils.shared_array import SharedArray
 from ..utils.space_wrapper import SpaceWrapper
+from ..utils.control_block import ControlBlock
+from ..utils.shared_info import SharedInfoSchema
 import multiprocessing as mp
 import numpy as np
 import traceback
+import time
+
+# commands sent through the control block
+RESET = 1
+STEP = 2
+TERMINATE = 3
 
 
 def compress_info(infos):
@@ -18,52 +26,88 @@ def decompress_info(num_envs, idx_starts, comp_infos):
     return all_info
 
 
-def async_loop(vec_env_constr, pipe, shared_obs, shared_actions, shared_rews, shared_dones):
+def async_loop(vec_env_constr, worker, control, pipe, shared_obs, shared_actions, shared_rews, shared_dones, shared_terminal_obs, info_schema, placement):
     try:
+        if placement is not None:
+            placement.pin_worker(worker)
         vec_env = vec_env_constr()
 
         pipe.send((vec_env.num_envs))
         env_start_idx = pipe.recv()
         env_end_idx = env_start_idx + vec_env.num_envs
+        if placement is not None:
+            placement.first_touch((shared_obs, shared_actions, shared_rews, shared_dones, shared_terminal_obs), slice(env_start_idx, env_end_idx))
+        # the env writes the terminal observations of done envs straight into shared memory
+        vec_env.terminal_obs = shared_terminal_obs.np_arr[env_start_idx:env_end_idx]
         while True:
-            instr = pipe.recv()
-            if instr == "reset":
+            instr, _ = control.recv_command(worker)
+            if instr == RESET:
                 obs = vec_env.reset()
                 shared_obs.np_arr[env_start_idx:env_end_idx] = obs
                 shared_dones.np_arr[env_start_idx:env_end_idx] = False
                 shared_rews.np_arr[env_start_idx:env_end_idx] = 0.
+                if info_schema is not None:
+                    info_schema.write([{}]*vec_env.num_envs, env_start_idx)
                 comp_infos = []
-            elif instr == "step":
+            elif instr == STEP:
                 actions = shared_actions.np_arr[env_start_idx:env_end_idx]
                 observations, rewards, dones, infos = vec_env.step(actions)
                 shared_obs.np_arr[env_start_idx:env_end_idx] = observations
                 shared_dones.np_arr[env_start_idx:env_end_idx] = dones
                 shared_rews.np_arr[env_start_idx:env_end_idx] = rewards
+                if info_schema is not None:
+                    infos = info_schema.write(infos, env_start_idx)
                 comp_infos = compress_info(infos)
-            elif instr == "terminate":
+            elif instr == TERMINATE:
                 return
-            pipe.send(comp_infos)
+            if comp_infos:
+                pipe.send(comp_infos)
+            control.finish(worker, has_info=bool(comp_infos))
     except BaseException as e:
         tb = traceback.format_exc()
         pipe.send((e,tb))
+        control.finish(worker, has_info=True)
 
 class ProcConcatVec:
-    def __init__(self, vec_env_constrs, observation_space, action_space, tot_num_envs):
+    '''
+    With num_groups > 1, the worker processes are split into groups which
+    can be stepped independently with step_group_async/step_group_wait,
+    so the actions of one group can be computed while the others step:
+
+        obs = vec_env.reset()
+        for group, group_slice in enumerate(vec_env.group_slices):
+            vec_env.step_group_async(group, policy(obs[group_slice]))
+        while True:
+            for group in range(vec_env.num_groups):
+                obs, rews, dones, infos = vec_env.step_group_wait(group)
+                vec_env.step_group_async(group, policy(obs))
+
+    info_schema is the info_example of a SharedInfoSchema for the envs.
+
+    With a placement (see CPUPlacement), each worker process is pinned to
+    its own core and allocates its part of the shared arrays.
+    '''
+    def __init__(self, vec_env_constrs, observation_space, action_space, tot_num_envs, num_groups=1, info_schema=None, placement=None):
         self.observation_space = observation_space
         self.action_space = action_space
         self.num_envs = num_envs = tot_num_envs
 
-        self.shared_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
+        first_touch = placement is not None
+        self.shared_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype, first_touch=first_touch)
         act_space_wrap = SpaceWrapper(self.action_space)
-        self.shared_act = SharedArray((num_envs,)+act_space_wrap.shape, dtype=act_space_wrap.dtype)
-        self.shared_rews = SharedArray((num_envs,), dtype=np.float32)
-        self.shared_dones = SharedArray((num_envs,), dtype=np.uint8)
+        self.shared_act = SharedArray((num_envs,)+act_space_wrap.shape, dtype=act_space_wrap.dtype, first_touch=first_touch)
+        self.shared_rews = SharedArray((num_envs,), dtype=np.float32, first_touch=first_touch)
+        self.shared_dones = SharedArray((num_envs,), dtype=np.uint8, first_touch=first_touch)
+        self.shared_terminal_obs = SharedArray((num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype, first_touch=first_touch)
+        self.terminal_obs = self.shared_terminal_obs.np_arr
+        self.info_schema = None if info_schema is None else SharedInfoSchema(info_schema, num_envs)
 
+        self.control = ControlBlock(len(vec_env_constrs))
         pipes = []
         procs = []
-        for constr in vec_env_constrs:
+        for worker, constr in enumerate(vec_env_constrs):
             inpt,outpt = mp.Pipe()
-            proc = mp.Process(target=async_loop, args=(constr, outpt, self.shared_obs, self.shared_act, self.shared_rews, self.shared_dones))
+            proc = mp.Process(target=async_loop, args=(constr, worker, self.control, outpt, self.shared_obs, self.shared_act, self.shared_rews, self.shared_dones, self.shared_terminal_obs, self.info_schema, placement))
             proc.start()
             pipes.append(inpt)
             procs.append(proc)
@@ -72,7 +116,7 @@ class ProcConcatVec:
         self.procs = procs
 
         num_envs = 0
-        env_nums = self._receive_info()
+        env_nums = [self._recv_pipe(pipe) for pipe in self.pipes]
         idx_starts = []
         for pipe,cnum_env in zip(self.pipes,env_nums):
             cur_env_idx = num_envs
@@ -83,9 +127,19 @@ class ProcConcatVec:
         assert num_envs == tot_num_envs
         self.idx_starts = idx_starts
 
+        num_workers = len(self.pipes)
+        assert 1 <= num_groups <= num_workers, "need at least one worker process per group"
+        self.num_groups = num_groups
+        self.group_workers = [list(range(g*num_workers//num_groups, (g+1)*num_workers//num_groups)) for g in range(num_groups)]
+        idx_ends = idx_starts[1:] + [num_envs]
+        self.worker_slices = [slice(start, end) for start, end in zip(idx_starts, idx_ends)]
+        self.group_slices = [slice(idx_starts[workers[0]], idx_ends[workers[-1]]) for workers in self.group_workers]
+        # workers stepped by step_async_subset that have not been received yet
+        self.pending_workers = set()
+
     def reset(self):
-        for pipe in self.pipes:
-            pipe.send("reset")
+        for worker in range(len(self.pipes)):
+            self.control.send(worker, RESET)
 
         self._receive_info()
 
@@ -94,23 +148,102 @@ class ProcConcatVec:
 
     def step_async(self, actions):
         self.shared_act.np_arr[:] = actions
-        for pipe in self.pipes:
-            pipe.send("step")
+        for worker in range(len(self.pipes)):
+            self.control.send(worker, STEP)
+
+    def step_group_async(self, group, actions):
+        '''
+        steps only the envs in group_slices[group], actions are for those envs
+        '''
+        self.shared_act.np_arr[self.group_slices[group]] = actions
+        for worker in self.group_workers[group]:
+            self.control.send(worker, STEP)
+
+    def step_group_wait(self, group):
+        '''
+        waits for the group to finish stepping, returns the results of its
+        envs. The arrays are views into shared memory, which are overwritten
+        when the group is stepped again.
+        '''
+        group_slice = self.group_slices[group]
+        workers = self.group_workers[group]
+        compressed_infos = self._receive_info(workers)
+        idx_starts = [self.idx_starts[worker] - group_slice.start for worker in workers]
+        infos = self._decompress_info(group_slice, idx_starts, compressed_infos)
+        observations = self.shared_obs.np_arr[group_slice]
+        rewards = self.shared_rews.np_arr[group_slice]
+        dones = self.shared_dones.np_arr[group_slice]
+        return observations, rewards, dones, infos
+
+    def step_async_subset(self, worker_ids, actions):
+        '''
+        steps only the given worker processes, actions are for their envs
+        (see worker_slices) concatenated in the order of worker_ids.
+        The results are collected with recv_ready
+        '''
+        idx = 0
+        for worker in worker_ids:
+            assert worker not in self.pending_workers, "worker is still stepping"
+            worker_slice = self.worker_slices[worker]
+            num_envs = worker_slice.stop - worker_slice.start
+            self.shared_act.np_arr[worker_slice] = actions[idx:idx+num_envs]
+            idx += num_envs
+        for worker in worker_ids:
+            self.control.send(worker, STEP)
+            self.pending_workers.add(worker)
+
+    def recv_ready(self, min_count=1, timeout=None):
+        '''
+        waits until at least min_count of the stepping workers are done, or
+        the timeout runs out, and returns the results of all finished workers
+        as a list of
+            (worker_id, env_slice, observations, rewards, dones, infos)
+        The arrays are views into shared memory, which are overwritten when
+        the worker is stepped again.
+        '''
+        assert min_count <= len(self.pending_workers), "fewer workers stepping than requested"
+        end_time = None if timeout is None else time.time() + timeout
+        results = []
+        while self.pending_workers:
+            remaining = None if end_time is None else max(0., end_time - time.time())
+            # once enough workers are done, only the ones that are already done are taken
+            ready = self.control.wait_any(sorted(self.pending_workers), timeout=0 if len(results) >= min_count else remaining)
+            if not ready:
+                break
+            for worker in ready:
+                self.pending_workers.remove(worker)
+                comp_infos, = self._receive_info([worker])
+                worker_slice = self.worker_slices[worker]
+                infos = self._decompress_info(worker_slice, [0], [comp_infos])
+                results.append((worker, worker_slice, self.shared_obs.np_arr[worker_slice], self.shared_rews.np_arr[worker_slice], self.shared_dones.np_arr[worker_slice], infos))
+        return results
+
+    def _decompress_info(self, env_slice, idx_starts, compressed_infos):
+        infos = decompress_info(env_slice.stop - env_slice.start, idx_starts, compressed_infos)
+        if self.info_schema is not None:
+            self.info_schema.read(infos, env_slice.start)
+        return infos
+
+    def _recv_pipe(self, pipe):
+        data = pipe.recv()
+        if isinstance(data, tuple):
+            e, tb = data
+            print(tb)
+            raise e
+        return data
 
-    def _receive_info(self):
+    def _receive_info(self, workers=None):
+        if workers is None:
+            workers = range(len(self.pipes))
         all_data = []
-        for cin in self.pipes:
-            data = cin.recv()
-            if isinstance(data, tuple):
-                e, tb = data
-                print(tb)
-                raise e
-            all_data.append(data)
+        for worker in workers:
+            has_info = self.control.wait_done(worker, self.procs[worker])
+            all_data.append(self._recv_pipe(self.pipes[worker]) if has_info else [])
         return all_data
 
     def step_wait(self):
         compressed_infos = self._receive_info()
-        infos = decompress_info(self.num_envs, self.idx_starts, compressed_infos)
+        infos = self._decompress_info(slice(0, self.num_envs), self.idx_starts, compressed_infos)
         observations = self.shared_obs.np_arr
         rewards = self.shared_rews.np_arr
         dones = self.shared_dones.np_arr
@@ -121,10 +254,7 @@ class ProcConcatVec:
         return self.step_wait()
 
     def __del__(self):
-        for pipe in self.pipes:
-            try:
-                pipe.send("terminate")
-            except BrokenPipeError:
-                pass
+        for worker in range(len(self.pipes)):
+            self.control.send(worker, TERMINATE)
         for proc in self.procs:
             proc.join()
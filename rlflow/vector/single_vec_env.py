@@ -7,6 +7,7 @@ class SingleVecEnv:
         self.observation_space = self.gym_env.observation_space
         self.action_space = self.gym_env.action_space
         self.num_envs = 1
+        self.terminal_obs = np.zeros((1,)+self.observation_space.shape, dtype=self.observation_space.dtype)
 
     def reset(self):
         return np.expand_dims(self.gym_env.reset(),0)
@@ -20,6 +21,7 @@ class SingleVecEnv:
     def step(self, actions):
         observations, reward, done, info = self.gym_env.step(actions[0])
         if done:
+            self.terminal_obs[0] = observations
             observations = self.gym_env.reset()
         observations =  np.expand_dims(observations,0)
         rewards = np.array([reward], dtype=np.float32)
@@ -0,0 +1,212 @@
+import numpy as np
+import gym
+from rlflow.adders import TransitionAdder, VectorTransitionAdder, LoggerAdder, VectorLoggerAdder, NStepTransitionAdder, VectorNStepTransitionAdder, OnPolicyAdder, per_env_vector_adder_fn, vector_adder_fn
+from rlflow.data_store.on_policy_store import OnPolicyDataStore
+
+OBS_SPACE = gym.spaces.Box(low=-1000, high=1000, shape=(2,), dtype=np.float32)
+ACT_SPACE = gym.spaces.Discrete(4)
+
+def reference_n_step(episode_rews, n_step, gamma):
+    # (start step, n step reward, discount) of every transition of an episode
+    results = []
+    for start in range(len(episode_rews)):
+        rews = episode_rews[start:start+n_step]
+        ended = start + n_step >= len(episode_rews)
+        n_step_rew = sum(rew * gamma**i for i, rew in enumerate(rews))
+        results.append((start, n_step_rew, 0. if ended else gamma**n_step))
+    return results
+
+def test_n_step_adder():
+    n_step = 3
+    gamma = 0.5
+    episode_lens = [5, 1, 2, 7]
+    transitions = []
+    adder = NStepTransitionAdder(OBS_SPACE, ACT_SPACE, n_step, gamma)
+    adder.set_generate_callback(transitions.append)
+    expected = []
+    step = 0
+    adder.add(np.zeros(2), 0, 0., False, {}, None)
+    for ep_len in episode_lens:
+        ep_start = step
+        for i in range(ep_len):
+            step += 1
+            # obs encodes the step, the reward and action the step before
+            adder.add(np.full(2, step), step % 4, float(step), i == ep_len-1, {}, None)
+        rews = [float(s) for s in range(ep_start+1, step+1)]
+        expected += [(ep_start + start, rew, disc) for start, rew, disc in reference_n_step(rews, n_step, gamma)]
+        # reset observation
+        adder.add(np.full(2, step), 0, 0., False, {}, None)
+
+    assert len(transitions) == len(expected)
+    for (obs, act, rew, discount, last_obs), (start, exp_rew, exp_disc) in zip(sorted(transitions, key=lambda t: t[4][0]), expected):
+        assert last_obs[0] == start and act == (start+1) % 4
+        assert np.isclose(rew, exp_rew) and np.isclose(discount, exp_disc)
+        if discount != 0:
+            assert obs[0] == start + n_step
+
+def test_vector_n_step_adder():
+    num_envs = 4
+    transitions = []
+    adder = VectorNStepTransitionAdder(num_envs, OBS_SPACE, ACT_SPACE, n_step=2, gamma=0.9)
+    adder.set_generate_callback(transitions.append)
+    rng = np.random.RandomState(0)
+    for step in range(50):
+        dones = rng.random_sample(num_envs) < 0.2
+        adder.add(rng.random_sample((num_envs,2)), rng.randint(4, size=num_envs), np.ones(num_envs), dones, [{}]*num_envs, None)
+    batch_rews = np.concatenate([batch[2] for batch in transitions])
+    batch_discounts = np.concatenate([batch[3] for batch in transitions])
+    # every transition either bootstraps after exactly 2 steps, or ended its episode
+    assert np.all(np.isclose(batch_rews[batch_discounts > 0], 1.9))
+    ended_rews = batch_rews[batch_discounts == 0]
+    assert np.all(np.isclose(ended_rews, 1.) | np.isclose(ended_rews, 1.9))
+
+def run_vector_adder(adder, num_envs, num_steps):
+    batches = []
+    adder.set_generate_callback(batches.append)
+    rng = np.random.RandomState(0)
+    for step in range(num_steps):
+        dones = rng.random_sample(num_envs) < 0.1
+        adder.add(rng.random_sample((num_envs,2)), rng.randint(4, size=num_envs), rng.random_sample(num_envs), dones, [{}]*num_envs, [None]*num_envs)
+    return batches
+
+def test_vector_adders_match_per_env():
+    num_envs = 5
+    vec_batches = run_vector_adder(VectorTransitionAdder(num_envs, OBS_SPACE, ACT_SPACE), num_envs, 40)
+    per_env_batches = run_vector_adder(per_env_vector_adder_fn(lambda: TransitionAdder(OBS_SPACE, ACT_SPACE))(num_envs), num_envs, 40)
+    for vec_field, per_env_field in zip(zip(*vec_batches), zip(*per_env_batches)):
+        assert np.allclose(np.concatenate(vec_field), np.concatenate(per_env_field))
+
+    vec_logs = run_vector_adder(VectorLoggerAdder(num_envs), num_envs, 120)
+    per_env_logs = run_vector_adder(per_env_vector_adder_fn(LoggerAdder)(num_envs), num_envs, 120)
+    per_env_logs = [tuple(field[0] for field in log) for log in per_env_logs]
+    assert len(vec_logs) == len(per_env_logs)
+    for vec_log, per_env_log in zip(sorted(vec_logs), sorted(per_env_logs)):
+        assert vec_log[:2] == per_env_log[:2] and np.isclose(vec_log[2], per_env_log[2])
+
+def test_vector_transition_terminal_obs():
+    num_envs = 2
+    terminal_obs = np.zeros((num_envs,2), dtype=np.float32)
+    adder = VectorTransitionAdder(num_envs, OBS_SPACE, ACT_SPACE, terminal_obs=terminal_obs)
+    batches = []
+    adder.set_generate_callback(batches.append)
+    acts = np.arange(num_envs)
+    adder.add(np.full((num_envs,2), 0.), acts, np.zeros(num_envs), np.zeros(num_envs), [{}]*num_envs, None)
+    # env 1 ends its episode, its observation is the first one of the next episode
+    terminal_obs[1] = 5.
+    adder.add(np.full((num_envs,2), 1.), acts, np.ones(num_envs), np.array([0,1]), [{}]*num_envs, None)
+    adder.add(np.full((num_envs,2), 2.), acts, np.ones(num_envs), np.zeros(num_envs), [{}]*num_envs, None)
+    obs_new, act, rew, done, last_obs = [np.concatenate(field) for field in zip(*batches)]
+    assert len(obs_new) == 4
+    assert np.all(obs_new[:,0] == [1., 5., 2., 2.])
+    assert np.all(last_obs[:,0] == [0., 0., 1., 1.])
+    assert np.all(done == [0, 1, 0, 0])
+
+    # the per env adders see the same transitions
+    terminal_obs[:] = 0.
+    per_env_adder = per_env_vector_adder_fn(lambda: TransitionAdder(OBS_SPACE, ACT_SPACE))(num_envs, terminal_obs)
+    per_env_batches = []
+    per_env_adder.set_generate_callback(per_env_batches.append)
+    per_env_adder.add(np.full((num_envs,2), 0.), acts, np.zeros(num_envs), np.zeros(num_envs), [{}]*num_envs, [None]*num_envs)
+    terminal_obs[1] = 5.
+    per_env_adder.add(np.full((num_envs,2), 1.), acts, np.ones(num_envs), np.array([0,1]), [{}]*num_envs, [None]*num_envs)
+    per_env_adder.add(np.full((num_envs,2), 2.), acts, np.ones(num_envs), np.zeros(num_envs), [{}]*num_envs, [None]*num_envs)
+    for field, per_env_field in zip((obs_new, act, rew, done, last_obs), zip(*per_env_batches)):
+        assert np.allclose(field, np.concatenate(per_env_field))
+
+def run_terminal_obs_adder(adder, num_envs, num_steps, terminal_obs):
+    batches = []
+    adder.set_generate_callback(batches.append)
+    rng = np.random.RandomState(1)
+    for step in range(num_steps):
+        dones = rng.random_sample(num_envs) < 0.2
+        terminal_obs[:] = rng.random_sample((num_envs,2))
+        adder.add(rng.random_sample((num_envs,2)), rng.randint(4, size=num_envs), rng.random_sample(num_envs), dones, [{}]*num_envs, [None]*num_envs)
+    return [np.concatenate(field) for field in zip(*batches)]
+
+def test_vector_adder_fn():
+    num_envs = 4
+    assert isinstance(vector_adder_fn(lambda: TransitionAdder(OBS_SPACE, ACT_SPACE))(num_envs), VectorTransitionAdder)
+    assert isinstance(vector_adder_fn(LoggerAdder)(num_envs), VectorLoggerAdder)
+    n_step_fn = lambda: NStepTransitionAdder(OBS_SPACE, ACT_SPACE, n_step=3, gamma=0.8)
+    terminal_obs = np.zeros((num_envs,2), dtype=np.float32)
+    vec_adder = vector_adder_fn(n_step_fn)(num_envs, terminal_obs)
+    assert isinstance(vec_adder, VectorNStepTransitionAdder)
+    vec_fields = run_terminal_obs_adder(vec_adder, num_envs, 60, terminal_obs)
+    per_env_fields = run_terminal_obs_adder(per_env_vector_adder_fn(n_step_fn)(num_envs, terminal_obs), num_envs, 60, terminal_obs)
+    assert len(vec_fields[0]) > 0
+    for vec_field, per_env_field in zip(vec_fields, per_env_fields):
+        assert np.allclose(vec_field, per_env_field)
+
+def test_generate_env_idxs():
+    num_envs = 3
+    adders = [
+        VectorTransitionAdder(num_envs, OBS_SPACE, ACT_SPACE),
+        VectorNStepTransitionAdder(num_envs, OBS_SPACE, ACT_SPACE, n_step=2),
+        VectorLoggerAdder(num_envs),
+        OnPolicyAdder(num_envs, 4, OBS_SPACE, ACT_SPACE),
+        per_env_vector_adder_fn(lambda: TransitionAdder(OBS_SPACE, ACT_SPACE))(num_envs),
+        per_env_vector_adder_fn(lambda: NStepTransitionAdder(OBS_SPACE, ACT_SPACE, n_step=2))(num_envs),
+        per_env_vector_adder_fn(LoggerAdder)(num_envs),
+    ]
+    for adder in adders:
+        env_idxs = []
+        adder.set_generate_callback(lambda batch, idxs: env_idxs.append(np.atleast_1d(idxs)), with_env_idxs=True)
+        if isinstance(adder, OnPolicyAdder):
+            actor_infos = {"values": np.zeros(num_envs), "log_probs": np.zeros(num_envs)}
+        else:
+            actor_infos = [None]*num_envs
+        for step in range(120):
+            dones = np.full(num_envs, step % 7 == 6)
+            adder.add(np.zeros((num_envs,2)), np.zeros(num_envs, dtype=np.int64), np.ones(num_envs), dones, [{}]*num_envs, actor_infos)
+        env_idxs = np.concatenate(env_idxs)
+        assert set(env_idxs.tolist()) == set(range(num_envs))
+
+def reference_gae(rews, dones, values, last_value, gamma, gae_lambda):
+    advantages = []
+    advantage = 0.
+    for t in reversed(range(len(rews))):
+        next_value = last_value if t == len(rews)-1 else values[t+1]
+        delta = rews[t] + gamma * next_value * (1-dones[t]) - values[t]
+        advantage = delta + gamma * gae_lambda * (1-dones[t]) * advantage
+        advantages.append(advantage)
+    return advantages[::-1]
+
+def test_on_policy_adder():
+    num_envs = 3
+    num_steps = 8
+    adder = OnPolicyAdder(num_envs, num_steps, OBS_SPACE, ACT_SPACE, gamma=0.9, gae_lambda=0.8)
+    store = OnPolicyDataStore(adder.get_example_output(), num_envs*num_steps)
+    adder.set_generate_callback(store.add_segment)
+    rng = np.random.RandomState(0)
+    history = []
+    for step in range(num_steps+2):
+        actor_infos = {"values": rng.random_sample(num_envs), "log_probs": -rng.random_sample(num_envs)}
+        rews = rng.random_sample(num_envs)
+        dones = rng.random_sample(num_envs) < 0.2
+        adder.add(rng.random_sample((num_envs,2)), rng.randint(4, size=num_envs), rews, dones, [{}]*num_envs, actor_infos)
+        history.append((rews, dones, actor_infos["values"]))
+    assert not store.can_add()
+
+    # the first step has no observation to start from, the last one bootstraps the segment
+    segment = history[1:num_steps+1]
+    last_values = history[num_steps+1][2]
+    for env in range(num_envs):
+        rews, dones, values = [[step[i][env] for step in segment] for i in range(3)]
+        expected = reference_gae(rews, dones, values, last_values[env], 0.9, 0.8)
+        assert np.allclose(adder.advantages[:,env], expected, atol=1e-5)
+        assert np.allclose(adder.returns[:,env], np.add(expected, values), atol=1e-5)
+
+    seen_returns = []
+    for obs, act, values, advantages, returns, log_probs in store.minibatches(4, num_epochs=2):
+        assert len(returns) == 4
+        seen_returns.append(returns)
+    assert np.allclose(np.sort(np.concatenate(seen_returns)), np.sort(np.tile(adder.returns.ravel(), 2)))
+    assert store.can_add()
+
+test_n_step_adder()
+test_vector_n_step_adder()
+test_vector_adders_match_per_env()
+test_vector_transition_terminal_obs()
+test_vector_adder_fn()
+test_generate_env_idxs()
+test_on_policy_adder()
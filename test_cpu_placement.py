@@ -0,0 +1,46 @@
+import numpy as np
+from rlflow.utils.cpu_placement import CPUPlacement
+from rlflow.utils.shared_array import SharedArray
+
+def worker_cpus(placement, num_workers):
+    return [placement.worker_cpu(i) for i in range(num_workers)]
+
+def test_actor_placements_disjoint():
+    num_cpus = 8
+    num_actors = 2
+    placement = CPUPlacement(num_reserved=2, cpus=range(10))
+    assert placement.reserved_cpus == [0, 1]
+    used = []
+    for actor_placement in placement.split(num_actors, num_cpus//num_actors):
+        cpus = worker_cpus(actor_placement, num_cpus//num_actors)
+        assert not set(cpus) & set(placement.reserved_cpus)
+        used.extend(cpus)
+    # every worker of every actor has a core of its own
+    assert sorted(used) == list(range(2, 10))
+
+def test_placement_of_cpu_subset():
+    # e.g. the cores of an affinity mask, which need not be consecutive
+    placement = CPUPlacement(num_reserved=1, cpus=[3, 5, 7, 9, 11])
+    actor_cpus = [worker_cpus(actor_placement, 2) for actor_placement in placement.split(2, 2)]
+    assert actor_cpus == [[5, 7], [9, 11]]
+
+def test_oversubscribed_placement():
+    # more workers than cores share the worker cores, but never the reserved ones
+    placement = CPUPlacement(num_reserved=2, cpus=range(5))
+    for actor_placement in placement.split(3, 2):
+        assert set(worker_cpus(actor_placement, 2)) <= {2, 3, 4}
+
+def test_first_touch_rows():
+    placement = CPUPlacement(num_reserved=1, cpus=range(3))
+    shared_arrays = [SharedArray((6,2), dtype=np.float32, first_touch=True), SharedArray((6,), dtype=np.uint8, first_touch=True)]
+    for shared in shared_arrays:
+        shared.np_arr[:] = 1
+    placement.first_touch(shared_arrays, slice(2, 4))
+    for shared in shared_arrays:
+        assert np.all(shared.np_arr[2:4] == 0)
+        assert np.all(shared.np_arr[:2] == 1) and np.all(shared.np_arr[4:] == 1)
+
+test_actor_placements_disjoint()
+test_placement_of_cpu_subset()
+test_oversubscribed_placement()
+test_first_touch_rows()
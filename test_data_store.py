@@ -0,0 +1,195 @@
+import numpy as np
+import tempfile
+import multiprocessing as mp
+from rlflow.data_store.data_store import DataManager, tag_ids, untag_ids
+from rlflow.data_store.frame_store import FrameDedupDataManager
+from rlflow.utils.shared_array import SharedArray
+from rlflow.utils.shared_ring_buffer import SharedRingBuffer
+from rlflow.selectors.priority_updater import PriorityUpdater, priority_pipe_example
+from rlflow.selectors import RingFifoScheme, UniformSampleScheme, DensitySampleScheme
+
+MAX_ENTRIES = 16
+
+def make_manager(storage_folder=None, sample_scheme=None):
+    transition_example = (np.zeros(3,dtype=np.float32), np.array(0,dtype=np.int64))
+    if sample_scheme is None:
+        sample_scheme = UniformSampleScheme(MAX_ENTRIES)
+    return DataManager([], transition_example, RingFifoScheme(MAX_ENTRIES), sample_scheme, MAX_ENTRIES, storage_folder)
+
+def make_batch(start, size):
+    vals = np.arange(start, start+size)
+    return [np.stack([vals]*3,axis=1).astype(np.float32), vals]
+
+def test_add_batch():
+    manager = make_manager()
+    manager.add_batch(make_batch(0, 10))
+    manager.add_batch(make_batch(10, 10))
+    assert manager.sample_scheme.num_idxs == MAX_ENTRIES
+    stored = np.sort(manager.data[1])
+    assert np.all(stored == np.arange(4, 20))
+    assert np.all(manager.data[0][:,0] == manager.data[1])
+
+    idxs, weights, batch = manager.sample_data(8)
+    assert np.all(batch[1] >= 4)
+
+def test_add_batch_matches_add_data():
+    batch_manager = make_manager()
+    single_manager = make_manager()
+    for start in range(0, 40, 8):
+        batch = make_batch(start, 8)
+        batch_manager.add_batch(batch)
+        for i in range(8):
+            single_manager.add_data([field[i] for field in batch])
+    assert np.all(np.sort(batch_manager.data[1]) == np.sort(single_manager.data[1]))
+
+def test_storage_folder_reopen():
+    with tempfile.TemporaryDirectory() as folder:
+        manager = make_manager(folder, DensitySampleScheme(MAX_ENTRIES, 0.6, lambda step: 0.4))
+        manager.add_batch(make_batch(0, 20))
+        manager.checkpoint()
+        del manager
+
+        reopened = make_manager(folder, DensitySampleScheme(MAX_ENTRIES, 0.6, lambda step: 0.4))
+        assert reopened.init_add_idx == MAX_ENTRIES
+        assert np.all(np.sort(reopened.data[1]) == np.arange(4, 20))
+        # fifo order survives the restart
+        reopened.add_batch(make_batch(20, 2))
+        assert np.all(np.sort(reopened.data[1]) == np.arange(6, 22))
+
+def test_frame_dedup_matches_data_manager():
+    frame_stack = 4
+    num_envs = 3
+    obs_example = np.zeros((frame_stack,3,3),dtype=np.uint8)
+    transition_example = (obs_example, np.array(0,dtype=np.int64), np.array(0,dtype=np.float32), np.array(0,dtype=np.uint8), obs_example)
+    dedup_manager = FrameDedupDataManager([None]*num_envs, transition_example, RingFifoScheme(MAX_ENTRIES), UniformSampleScheme(MAX_ENTRIES), MAX_ENTRIES, frame_stack=frame_stack)
+    batch_dedup_manager = FrameDedupDataManager([None]*num_envs, transition_example, RingFifoScheme(MAX_ENTRIES), UniformSampleScheme(MAX_ENTRIES), MAX_ENTRIES, frame_stack=frame_stack)
+    manager = DataManager([], transition_example, RingFifoScheme(MAX_ENTRIES), UniformSampleScheme(MAX_ENTRIES), MAX_ENTRIES)
+
+    np_random = np.random.RandomState(0)
+    last_obss = [None]*num_envs
+    transitions = []
+    env_idxs = []
+    for step in range(200):
+        env_idx = np_random.randint(num_envs)
+        frame = np_random.randint(255,size=(1,3,3)).astype(np.uint8)
+        if last_obss[env_idx] is None:
+            last_obss[env_idx] = np.concatenate([frame]*frame_stack)
+            continue
+        obs = np.concatenate([last_obss[env_idx][1:], frame])
+        done = np_random.random() < 0.1
+        transition = (obs, np.array(step), np.array(0,dtype=np.float32), np.array(done,dtype=np.uint8), last_obss[env_idx])
+        dedup_manager.add_data(transition, env_idx)
+        manager.add_data(transition)
+        transitions.append(transition)
+        env_idxs.append(env_idx)
+        last_obss[env_idx] = None if done else obs
+
+    # chunks with several transitions of the same env are chained in order
+    chunk_start = 0
+    while chunk_start < len(transitions):
+        chunk_end = chunk_start + np_random.randint(1, 12)
+        chunk = [np.stack(field) for field in zip(*transitions[chunk_start:chunk_end])]
+        batch_dedup_manager.add_batch(chunk, np.array(env_idxs[chunk_start:chunk_end]))
+        chunk_start = chunk_end
+
+    ids = np.arange(MAX_ENTRIES)
+    data = manager._get_data(ids)
+    order = np.argsort(data[1])
+    for dedup in (dedup_manager, batch_dedup_manager):
+        dedup_data = dedup._get_data(ids)
+        dedup_order = np.argsort(dedup_data[1])
+        for dedup_field, field in zip(dedup_data, data):
+            assert np.array_equal(dedup_field[dedup_order], field[order])
+        assert dedup.num_stored_frames() < MAX_ENTRIES * frame_stack
+    assert batch_dedup_manager.num_stored_frames() == dedup_manager.num_stored_frames()
+
+def gather_in_proc(gatherer, idxs, outs):
+    assert gatherer.gather(idxs, [out.np_arr for out in outs])
+
+def test_shared_memory_gather():
+    transition_example = (np.zeros(3,dtype=np.float32), np.array(0,dtype=np.int64))
+    manager = DataManager([], transition_example, RingFifoScheme(MAX_ENTRIES), UniformSampleScheme(MAX_ENTRIES), MAX_ENTRIES, shared_memory=True)
+    gatherer = manager.gatherer()
+    outs = [SharedArray((4,3),dtype=np.float32), SharedArray((4,),dtype=np.int64)]
+    manager.add_batch(make_batch(0, 8))
+    idxs = tag_ids(np.arange(4), manager.generations[:4])
+    proc = mp.Process(target=gather_in_proc, args=(gatherer, idxs, outs))
+    proc.start()
+    proc.join()
+    assert proc.exitcode == 0
+    assert np.all(outs[1].np_arr == manager.data[1][:4])
+    assert np.all(outs[0].np_arr[:,0] == outs[1].np_arr)
+
+LARGE_OBS_SIZE = 1 << 16
+
+def check_gathers(gatherer, sample_queue, result_queue):
+    outs = [np.empty((4,LARGE_OBS_SIZE),dtype=np.float32), np.empty(4,dtype=np.int64)]
+    num_intact = num_dropped = num_wrong = 0
+    while True:
+        sample = sample_queue.get()
+        if sample is None:
+            break
+        idxs, expected_vals = sample
+        if not gatherer.gather(idxs, outs):
+            num_dropped += 1
+        elif np.all(outs[0] == expected_vals[:,None].astype(np.float32)) and np.all(outs[1] == expected_vals):
+            num_intact += 1
+        else:
+            num_wrong += 1
+    result_queue.put((num_intact, num_dropped, num_wrong))
+
+def test_gather_while_adding():
+    # large observations, so that refills overlap the gathers of the other process
+    transition_example = (np.zeros(LARGE_OBS_SIZE,dtype=np.float32), np.array(0,dtype=np.int64))
+    manager = DataManager([], transition_example, RingFifoScheme(MAX_ENTRIES), UniformSampleScheme(MAX_ENTRIES), MAX_ENTRIES, shared_memory=True)
+    sample_queue = mp.Queue()
+    result_queue = mp.Queue()
+    proc = mp.Process(target=check_gathers, args=(manager.gatherer(), sample_queue, result_queue), daemon=True)
+    proc.start()
+
+    for start in range(0, 4000, 4):
+        vals = np.arange(start, start+4)
+        manager.add_batch([np.repeat(vals[:,None], LARGE_OBS_SIZE, axis=1).astype(np.float32), vals])
+        idxs, weights = manager.sample_idxs(4)
+        if sample_queue.qsize() < 4:
+            sample_queue.put((idxs, manager.data[1][untag_ids(idxs)[0]]))
+    sample_queue.put(None)
+
+    num_intact, num_dropped, num_wrong = result_queue.get(timeout=60)
+    proc.join()
+    # every batch that is not dropped holds the rows that were sampled
+    assert num_wrong == 0
+    assert num_intact > 0
+
+def test_priority_updates():
+    sample_scheme = DensitySampleScheme(MAX_ENTRIES, 1.0, lambda step: 0.4)
+    manager = make_manager(sample_scheme=sample_scheme)
+    manager.add_batch(make_batch(0, MAX_ENTRIES))
+    updater = PriorityUpdater()
+    updater.set_data_pipe(SharedRingBuffer(priority_pipe_example(4), 4))
+
+    idxs, weights, batch = manager.sample_data(4)
+    updater.update_td_error(idxs, np.full(4, 1., dtype=np.float32))
+    updater.update_td_error(idxs, np.full(4, 2., dtype=np.float32))
+    # the first transitions are refilled before the updates arrive
+    manager.add_batch(make_batch(MAX_ENTRIES, 2))
+    stale_ids = np.flatnonzero(manager.data[1] >= MAX_ENTRIES)
+
+    ids, td_errors = updater.fetch_densities()
+    assert len(ids) == 4 and np.all(td_errors == 2.)
+    assert updater.fetch_densities() is None
+    manager.update_priorities(ids, td_errors)
+    fresh_ids = np.setdiff1d(untag_ids(idxs)[0], stale_ids)
+    assert np.allclose(sample_scheme._it_sum[sample_scheme.sample_idxs[fresh_ids]], 2.)
+    # updates from an earlier sample of a refilled slot are dropped too
+    stale_update = tag_ids(stale_ids, manager.generations[stale_ids] - 1)
+    manager.update_priorities(stale_update, np.full(len(stale_ids), 5., dtype=np.float32))
+    assert np.all(sample_scheme._it_sum[sample_scheme.sample_idxs[stale_ids]] < 5.)
+
+test_add_batch()
+test_storage_folder_reopen()
+test_frame_dedup_matches_data_manager()
+test_add_batch_matches_add_data()
+test_shared_memory_gather()
+test_gather_while_adding()
+test_priority_updates()
@@ -0,0 +1,354 @@
+import numpy as np
+import os
+import time
+import gym
+import torch
+from rlflow.vector import SingleVecEnv
+from rlflow.adders.transition_adder import TransitionAdder, VectorTransitionAdder
+from rlflow.actors.single_agent_actor import StatelessActor
+from rlflow.selectors import UniformSampleScheme
+from rlflow.policy_delayer.no_update import NoUpdate
+from rlflow.policy_delayer.occasional_update import OccasionalUpdate
+from rlflow.data_store.frame_store import FrameDedupDataManager
+from rlflow.utils.shared_array import SharedArray
+from rlflow.env_loops import efficient_rollout_loop, single_threaded_env_loop, multi_threaded_loop, on_policy_loop
+from rlflow.env_loops.efficient_rollout_loop import AsyncMultiEnv, AsyncEnv
+
+EPISODE_LEN = 7
+NUM_ACTIONS = 8
+
+class EchoEnv(gym.Env):
+    '''
+    observes (env id, step in the episode, last action), stepping sleeps
+    longer for larger actions, so envs finish their steps out of order
+    '''
+    num_made = 0
+    def __init__(self, sleep_per_action=0.005):
+        EchoEnv.num_made += 1
+        self.env_id = os.getpid()*100 + EchoEnv.num_made
+        self.sleep_per_action = sleep_per_action
+        self.observation_space = gym.spaces.Box(low=-1, high=np.inf, shape=(3,), dtype=np.float64)
+        self.action_space = gym.spaces.Discrete(NUM_ACTIONS)
+
+    def reset(self):
+        self.steps = 0
+        return np.array([self.env_id, 0, -1], dtype=np.float64)
+
+    def step(self, action):
+        time.sleep(self.sleep_per_action*action)
+        self.steps += 1
+        return np.array([self.env_id, self.steps, action], dtype=np.float64), 1., self.steps == EPISODE_LEN, {}
+
+def echo_env_fn():
+    return SingleVecEnv([EchoEnv])
+
+def echo_policy_action(obss):
+    # the action depends on the observation it was chosen for
+    return (obss[:,0] + 3*obss[:,1]).astype(np.int64) % NUM_ACTIONS
+
+class EchoPolicy:
+    def calc_action(self, obss):
+        return echo_policy_action(obss)
+
+class NullLogger:
+    def record(self, *args):
+        pass
+
+    def record_type(self, *args):
+        pass
+
+    def record_sum(self, *args):
+        pass
+
+    def dump(self):
+        pass
+
+class NullSaver:
+    def checkpoint(self, policy):
+        pass
+
+class PairingChecker:
+    '''
+    learner which checks that the sampled transitions are made of an
+    observation, the action chosen for it and the observation that followed
+    '''
+    def __init__(self, policy):
+        self.policy = policy
+        self.num_checked = 0
+
+    def learn_step(self, idxs, batch, weights):
+        obs, act, rew, done, last_obs = batch
+        assert np.all(obs[:,0] == last_obs[:,0]), "transition mixes envs"
+        assert np.all(act == echo_policy_action(last_obs)), "action was chosen for another observation"
+        # transitions that end an episode have its terminal observation
+        assert np.all(obs[:,1] == last_obs[:,1]+1)
+        assert np.all(done == (obs[:,1] == EPISODE_LEN))
+        assert np.all(obs[:,2] == act), "observation came from another action"
+        self.num_checked += len(act)
+
+def test_async_env_wait_any():
+    multi_env = AsyncMultiEnv(lambda: SingleVecEnv([lambda: EchoEnv(0.05)]), 2, 2)
+    env = AsyncEnv(multi_env)
+    env.reset_all_async()
+    for idx in range(2):
+        env.collect_wait_id(idx)
+    # the second env steps much longer, so the first one is ready first
+    env.step_async(1, NUM_ACTIONS-1)
+    env.step_async(0, 0)
+    assert env.wait_any([0, 1]) == [0]
+    obs, rew, done = env.collect_wait_id(0)
+    assert obs[2] == 0
+    assert env.wait_any([1]) == [1]
+    obs, rew, done = env.collect_wait_id(1)
+    assert obs[2] == NUM_ACTIONS-1
+    # results collected without wait_any don't leave wakeups behind either
+    for idx in range(2):
+        env.step_async(idx, 0)
+    for idx in range(2):
+        env.collect_wait_id(idx)
+    assert not multi_env.control.any_done.acquire(False)
+
+def test_efficient_loop_pairing():
+    learners = []
+    def learner_fn():
+        learners.append(PairingChecker(None))
+        return learners[-1]
+
+    example_env = echo_env_fn()
+    efficient_rollout_loop.run_loop(
+        NullLogger(),
+        learner_fn,
+        NoUpdate(),
+        lambda: (lambda obss: torch.as_tensor(echo_policy_action(obss))),
+        echo_env_fn,
+        NullSaver(),
+        lambda: TransitionAdder(example_env.observation_space, example_env.action_space),
+        UniformSampleScheme(200),
+        200,
+        16,
+        act_steps_until_learn=50,
+        max_learn_steps=20,
+        log_frequency=1000,
+        num_env_ids=6,
+        num_cpus=2,
+    )
+    assert learners[0].num_checked == 20*16
+
+class FrameCountingDedup(FrameDedupDataManager):
+    '''
+    publishes the number of stored frames and transitions after receiving
+    new entries, so they can be checked from other processes
+    '''
+    def __init__(self, counts, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = counts
+
+    def receive_new_entries(self):
+        super().receive_new_entries()
+        self.counts.np_arr[:] = [self.num_stored_frames(), len(self.removal_scheme)]
+
+def echo_vec_adder_fn(num_envs, terminal_obs):
+    example_env = EchoEnv()
+    return VectorTransitionAdder(num_envs, example_env.observation_space, example_env.action_space, terminal_obs)
+
+def test_single_threaded_frame_dedup():
+    data_store_size = 40
+    managers = []
+    def data_manager_fn(*args):
+        managers.append(FrameDedupDataManager(*args))
+        return managers[-1]
+    learners = []
+    def learner_fn():
+        learners.append(PairingChecker(None))
+        return learners[-1]
+
+    single_threaded_env_loop.run_loop(
+        NullLogger(),
+        learner_fn,
+        NoUpdate(),
+        lambda: StatelessActor(EchoPolicy()),
+        lambda: EchoEnv(0.),
+        NullSaver(),
+        None,
+        UniformSampleScheme(data_store_size),
+        data_store_size,
+        16,
+        num_env_ids=16,
+        act_steps_until_learn=200,
+        max_learn_steps=20,
+        log_frequency=1000,
+        data_manager_fn=data_manager_fn,
+        vec_adder_fn=echo_vec_adder_fn,
+    )
+    assert learners[0].num_checked == 20*16
+    # each transition only adds its new observation (and one more at the start of an episode),
+    # and the frame pool grew for the 16 envs instead of evicting transitions early
+    manager = managers[0]
+    assert len(manager.removal_scheme) == data_store_size
+    assert manager.num_stored_frames() < 1.3 * data_store_size + 16
+
+def test_multi_threaded_frame_dedup():
+    data_store_size = 40
+    counts = SharedArray((2,), dtype=np.int64)
+    learners = []
+    def learner_fn():
+        learners.append(PairingChecker(None))
+        return learners[-1]
+
+    multi_threaded_loop.run_loop(
+        NullLogger(),
+        learner_fn,
+        NoUpdate(),
+        lambda: StatelessActor(EchoPolicy()),
+        lambda: EchoEnv(0.),
+        NullSaver(),
+        None,
+        UniformSampleScheme(data_store_size),
+        data_store_size,
+        16,
+        num_env_ids=16,
+        num_actors=2,
+        act_steps_until_learn=200,
+        max_learn_steps=20,
+        log_frequency=1000,
+        data_manager_fn=lambda *args, **kwargs: FrameCountingDedup(counts, *args, **kwargs),
+        vec_adder_fn=echo_vec_adder_fn,
+    )
+    assert learners[0].num_checked >= 20*16
+    num_frames, num_transitions = counts.np_arr
+    assert num_transitions == data_store_size
+    assert num_frames < 1.3 * data_store_size + 16
+
+def test_multi_threaded_sampler_procs():
+    # a small buffer, so slots are refilled while the sampler processes gather them
+    data_store_size = 40
+    learners = []
+    def learner_fn():
+        learners.append(PairingChecker(None))
+        return learners[-1]
+
+    multi_threaded_loop.run_loop(
+        NullLogger(),
+        learner_fn,
+        NoUpdate(),
+        lambda: StatelessActor(EchoPolicy()),
+        lambda: EchoEnv(0.),
+        NullSaver(),
+        None,
+        UniformSampleScheme(data_store_size),
+        data_store_size,
+        16,
+        num_env_ids=8,
+        act_steps_until_learn=200,
+        max_learn_steps=20,
+        log_frequency=1000,
+        num_sampler_procs=2,
+        vec_adder_fn=echo_vec_adder_fn,
+    )
+    assert learners[0].num_checked >= 20*16
+
+class TotalStepEnv(gym.Env):
+    '''
+    observes (env id, steps since the env was made, step in the episode)
+    '''
+    num_made = 0
+    def __init__(self):
+        TotalStepEnv.num_made += 1
+        self.env_id = TotalStepEnv.num_made
+        self.total_steps = 0
+        self.observation_space = gym.spaces.Box(low=0, high=np.inf, shape=(3,), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(2)
+
+    def reset(self):
+        self.steps = 0
+        return np.array([self.env_id, self.total_steps, 0], dtype=np.float32)
+
+    def step(self, action):
+        self.steps += 1
+        self.total_steps += 1
+        return np.array([self.env_id, self.total_steps, self.steps], dtype=np.float32), 1., self.steps == EPISODE_LEN, {}
+
+class TotalStepPolicy:
+    '''
+    acts, values and log probs depend on the observation, so the learner
+    can tell whether the fields of its minibatches belong together
+    '''
+    def __init__(self):
+        self.weights = np.zeros(1, dtype=np.float32)
+
+    def get_params(self):
+        return [self.weights]
+
+    def set_params(self, params):
+        self.weights[:] = params[0]
+
+    def start_state(self):
+        return None
+
+    def rollout_step(self, obss, infos, states=None):
+        actor_infos = {"values": obss[:,0]*1000 + obss[:,1], "log_probs": -obss[:,2]}
+        return obss[:,1].astype(np.int64) % 2, None, actor_infos
+
+class SegmentChecker:
+    '''
+    learner which puts the segments back together from their minibatches
+    (one epoch each), and checks that every env contributed its next n_steps steps
+    '''
+    def __init__(self, n_steps, num_envs, batch_size):
+        self.policy = TotalStepPolicy()
+        self.n_steps = n_steps
+        self.num_envs = num_envs
+        self.batches_per_segment = n_steps * num_envs // batch_size
+        self.minibatches = []
+        self.num_segments = 0
+
+    def learn_step(self, minibatch):
+        obs, action, values, advantages, returns, log_probs = minibatch
+        assert np.all(action == obs[:,1] % 2)
+        assert np.all(values == obs[:,0]*1000 + obs[:,1])
+        assert np.all(log_probs == -obs[:,2])
+        assert np.allclose(returns, advantages + values)
+        self.minibatches.append(obs)
+        if len(self.minibatches) == self.batches_per_segment:
+            segment_obs = np.concatenate(self.minibatches)
+            self.minibatches = []
+            env_ids = np.unique(segment_obs[:,0])
+            assert len(env_ids) == self.num_envs
+            # OnPolicyAdder starts from the observation after the first step
+            first_step = 1 + self.num_segments * self.n_steps
+            for env_id in env_ids:
+                env_steps = np.sort(segment_obs[segment_obs[:,0] == env_id, 1])
+                assert np.all(env_steps == np.arange(first_step, first_step + self.n_steps)), "segment skipped or repeated steps"
+            self.num_segments += 1
+
+def test_on_policy_loop_segments():
+    n_steps = 8
+    num_env_ids = 4
+    batch_size = 16
+    learners = []
+    def learner_fn():
+        learners.append(SegmentChecker(n_steps, num_env_ids, batch_size))
+        return learners[-1]
+
+    on_policy_loop.run_loop(
+        NullLogger(),
+        learner_fn,
+        OccasionalUpdate(1, TotalStepPolicy),
+        TotalStepPolicy,
+        TotalStepEnv,
+        NullSaver(),
+        n_steps,
+        batch_size,
+        num_epochs=1,
+        num_env_ids=num_env_ids,
+        max_learn_steps=3 * n_steps * num_env_ids // batch_size,
+        log_frequency=1000,
+    )
+    assert learners[0].num_segments == 3
+
+test_async_env_wait_any()
+test_efficient_loop_pairing()
+test_single_threaded_frame_dedup()
+test_multi_threaded_frame_dedup()
+test_multi_threaded_sampler_procs()
+test_on_policy_loop_segments()
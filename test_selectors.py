@@ -1,24 +1,113 @@
-from rlflow.selectors import FifoScheme, UniformSampleScheme, DensitySampleScheme
+import numpy as np
+from rlflow.selectors import FifoScheme, RingFifoScheme, UniformSampleScheme, DensitySampleScheme
 
 SCHEME_SIZE = 100
 
 def test_selector(selector):
     batch_size = 11
-    res = selector.sample(batch_size)
+    res, weights = selector.sample(batch_size)
     assert res is None
     for i in range(SCHEME_SIZE//2):
         selector.add(i)
 
-    res = selector.sample(batch_size)
+    res, weights = selector.sample(batch_size)
     assert len(res) == batch_size
 
     if hasattr(selector, "update_priorities"):
         selector.update_priorities(res, np.ones(batch_size, dtype=np.float32))
     selector.remove(res[0])
 
+def check_selector_many(selector):
+    selector.add_many(np.arange(SCHEME_SIZE))
+    selector.remove_many(np.arange(0, SCHEME_SIZE, 3))
+    remaining = set(range(SCHEME_SIZE)) - set(range(0, SCHEME_SIZE, 3))
+    assert selector.num_idxs == len(remaining)
+    assert set(selector.data_idxs[:selector.num_idxs].tolist()) == remaining
+    assert np.all(selector.data_idxs[selector.sample_idxs[list(remaining)]] == list(remaining))
+
+    res, weights = selector.sample(len(remaining)//2)
+    assert set(np.asarray(res).tolist()) <= remaining
+
+def test_ring_fifo():
+    fifo = RingFifoScheme(SCHEME_SIZE)
+    fifo.add_many(np.arange(SCHEME_SIZE))
+    fifo.remove_many(np.arange(0, SCHEME_SIZE, 2))
+    res, weights = fifo.sample(5)
+    assert list(res) == [1, 3, 5, 7, 9]
+    # reusing the evicted ids wraps around the ring and compacts tombstones
+    fifo.add_many(np.arange(0, SCHEME_SIZE, 2))
+    res, weights = fifo.sample(len(fifo))
+    assert list(res) == list(range(11, SCHEME_SIZE, 2)) + list(range(0, SCHEME_SIZE, 2))
+
+def test_growing_fifo():
+    fifo = FifoScheme(initial_size=4)
+    reference = []
+    rng = np.random.RandomState(0)
+    next_id = 0
+    for step in range(200):
+        new_ids = np.arange(next_id, next_id + rng.randint(5))
+        next_id += len(new_ids)
+        fifo.add_many(new_ids)
+        reference += new_ids.tolist()
+        removed = rng.choice(next_id, size=3, replace=False)
+        fifo.remove_many(removed)
+        reference = [id for id in reference if id not in set(removed.tolist())]
+        if step % 10 == 9:
+            res, weights = fifo.sample(len(reference)//2)
+            assert list(res) == reference[:len(reference)//2]
+            reference = reference[len(reference)//2:]
+    restored = FifoScheme()
+    restored.set_state(fifo.get_state())
+    assert list(restored.get_state()["ids"]) == reference
+    res, weights = restored.sample(len(reference))
+    assert list(res) == reference
+
+def test_stratified():
+    selector = DensitySampleScheme(SCHEME_SIZE,0.9,lambda step: 0.4,seed=0,stratified=True)
+    selector.add_many(np.arange(SCHEME_SIZE))
+    priorities = np.ones(SCHEME_SIZE, dtype=np.float32)
+    priorities[:3] = 1000.
+    selector.update_weights(np.arange(SCHEME_SIZE), priorities)
+    res, weights = selector.sample(20)
+    # the heavy entries cover most segments, but the batch is still unique
+    assert len(np.unique(res)) == 20
+    assert set(range(3)) <= set(res.tolist())
+
+def test_stratified_frequencies():
+    num_entries = 32
+    batch_size = 8
+    selector = DensitySampleScheme(num_entries,1.0,lambda step: 0.4,seed=0,stratified=True)
+    selector.add_many(np.arange(num_entries))
+    # the heavy entry covers about three segments
+    priorities = np.ones(num_entries, dtype=np.float32)
+    priorities[5] = 20.
+    selector.update_weights(np.arange(num_entries), priorities)
+
+    num_samples = 2000
+    counts = np.zeros(num_entries)
+    for _ in range(num_samples):
+        res, weights = selector.sample(batch_size)
+        counts[res] += 1
+        # sampling lowers the priorities of the sampled entries, restore them
+        selector.update_weights(res, priorities[res])
+    freqs = counts / num_samples
+    assert freqs[5] == 1.
+    # the rest of the batch is spread evenly over the light entries,
+    # including the neighbours of the heavy one
+    light_freqs = np.delete(freqs, 5)
+    expected = (batch_size - 1) / (num_entries - 1)
+    assert np.all(np.abs(light_freqs - expected) < 0.05), light_freqs
+
 def test_all():
     test_selector(FifoScheme())
+    test_selector(RingFifoScheme(SCHEME_SIZE))
     test_selector(UniformSampleScheme(SCHEME_SIZE))
-    test_selector(DensitySampleScheme(SCHEME_SIZE,0.9))
+    test_selector(DensitySampleScheme(SCHEME_SIZE,0.9,lambda step: 0.4))
+    check_selector_many(UniformSampleScheme(SCHEME_SIZE))
+    check_selector_many(DensitySampleScheme(SCHEME_SIZE,0.9,lambda step: 0.4))
+    test_ring_fifo()
+    test_growing_fifo()
+    test_stratified()
+    test_stratified_frequencies()
 
 test_all()
@@ -0,0 +1,151 @@
+import numpy as np
+import multiprocessing as mp
+from rlflow.utils.shared_ring_buffer import SharedRingBuffer
+from rlflow.utils.shared_batch_queue import SharedBatchQueue, lease_any
+from rlflow.utils.shared_info import SharedInfoSchema
+from rlflow.utils.control_block import ControlBlock
+
+EXAMPLE = (np.zeros(3,dtype=np.float32), np.array(0,dtype=np.int64))
+
+def make_item(i):
+    return (np.full(3,i,dtype=np.float32), np.array(i))
+
+def produce(ring, num_items):
+    for i in range(num_items):
+        ring.store(make_item(i))
+    ring.put_many([np.stack([make_item(i)[0] for i in range(num_items, num_items+20)]), np.arange(num_items, num_items+20)])
+
+def test_ring_buffer_wraps():
+    ring = SharedRingBuffer(EXAMPLE, 4)
+    assert ring.drain() is None
+    for i in range(3):
+        ring.store(make_item(i))
+    assert list(ring.drain(2)[1]) == [0, 1]
+    ring.put_many([np.zeros((3,3),dtype=np.float32), np.arange(3,6)])
+    assert not ring.can_store()
+    obs, vals = ring.drain()
+    assert list(vals) == [2, 3, 4, 5]
+    assert np.all(obs[0] == 2)
+
+def test_ring_buffer_processes():
+    ring = SharedRingBuffer(EXAMPLE, 8)
+    proc = mp.Process(target=produce, args=(ring, 500))
+    proc.start()
+    received = []
+    while len(received) < 520:
+        entries = ring.drain()
+        if entries is not None:
+            assert np.all(entries[0][:,0] == entries[1])
+            received.extend(entries[1].tolist())
+    proc.join()
+    assert received == list(range(520))
+
+def produce_batches(batch_queue, num_batches):
+    for i in range(num_batches):
+        while not batch_queue.can_store():
+            pass
+        batch_queue.store(make_item(i))
+
+def test_batch_queue():
+    batch_queue = SharedBatchQueue(EXAMPLE, 3)
+    assert batch_queue.get() is None
+    proc = mp.Process(target=produce_batches, args=(batch_queue, 50))
+    proc.start()
+    for i in range(50):
+        obs, val = batch_queue.get_wait(timeout=10)
+        assert val == i and np.all(obs == i)
+    proc.join()
+    assert batch_queue.get_wait(timeout=0.01) is None
+
+def test_batch_lease():
+    batch_queue = SharedBatchQueue(EXAMPLE, 2)
+    batch_queue.store(make_item(1))
+    batch_queue.store(make_item(2))
+    first = batch_queue.lease()
+    second = batch_queue.lease()
+    assert not batch_queue.can_store()
+    assert first.data[1] == 1 and second.data[1] == 2
+    assert not first.data[0].flags.writeable
+    with first as batch:
+        assert np.all(batch[0] == 1)
+    # only the released slot can be reused
+    batch_queue.store(make_item(3))
+    assert not batch_queue.can_store()
+    second.release()
+    with batch_queue.lease() as batch:
+        assert batch[1] == 3
+
+def test_lease_any():
+    any_filled = mp.Semaphore(0)
+    batch_queues = [SharedBatchQueue(EXAMPLE, 2, any_filled) for _ in range(3)]
+    assert lease_any(batch_queues, any_filled, timeout=0.01) is None
+    # only the last queue gets batches, the consumer must not wait on the others
+    proc = mp.Process(target=produce_batches, args=(batch_queues[2], 20))
+    proc.start()
+    for i in range(20):
+        lease = lease_any(batch_queues, any_filled, timeout=10, start=i)
+        assert lease.batch_queue is batch_queues[2]
+        with lease as batch:
+            assert batch[1] == i
+    proc.join()
+    batch_queues[0].store(make_item(7))
+    with lease_any(batch_queues, any_filled, start=1) as batch:
+        assert batch[1] == 7
+    assert not any_filled.acquire(False)
+
+def write_infos(info_schema, infos, start_idx, rest_queue):
+    rest_queue.put(info_schema.write(infos, start_idx))
+
+def test_info_schema():
+    info_schema = SharedInfoSchema({"lives": np.int32(0), "legal_moves": np.zeros(3, dtype=np.uint8)}, 4)
+    worker_infos = [{"lives": 3, "name": "a"}, {}, {"legal_moves": np.array([1,0,1])}]
+    rest_queue = mp.Queue()
+    proc = mp.Process(target=write_infos, args=(info_schema, worker_infos, 1, rest_queue))
+    proc.start()
+    rest = rest_queue.get()
+    proc.join()
+    assert rest == [{"name": "a"}, {}, {}]
+
+    empty = {}
+    infos = [empty] + rest
+    info_schema.read(infos, 0)
+    assert infos[0] is empty and not empty
+    assert infos[1] == {"name": "a", "lives": 3}
+    assert infos[2] == {}
+    assert list(infos[3]) == ["legal_moves"] and np.all(infos[3]["legal_moves"] == [1,0,1])
+
+def echo_commands(control, worker):
+    while True:
+        cmd, arg = control.recv_command(worker)
+        if cmd == 0:
+            break
+        control.finish(worker, has_info=arg % 2)
+
+def test_control_block():
+    num_workers = 2
+    control = ControlBlock(num_workers)
+    procs = [mp.Process(target=echo_commands, args=(control, worker), daemon=True) for worker in range(num_workers)]
+    for proc in procs:
+        proc.start()
+    for i in range(200):
+        for worker in range(num_workers):
+            control.send(worker, 1, i)
+        if i % 4 == 0:
+            assert control.wait_any(range(num_workers))
+        for worker in range(num_workers):
+            assert control.wait_done(worker, procs[worker]) == i % 2
+            assert control.is_done(worker)
+    # every finish was collected, so no wakeups are left over in any_done
+    assert not control.any_done.acquire(False)
+    for worker in range(num_workers):
+        control.send(worker, 0)
+    for proc in procs:
+        proc.join()
+
+test_ring_buffer_wraps()
+test_ring_buffer_processes()
+test_batch_queue()
+test_batch_lease()
+test_lease_any()
+test_info_schema()
+test_control_block()
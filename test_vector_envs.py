@@ -0,0 +1,143 @@
+import numpy as np
+import gym
+import time
+from rlflow.vector import SingleVecEnv, ConcatVecEnv, MakeCPUAsyncConstructor
+from rlflow.vector.gym_rollout import RolloutBuilder
+from rlflow.vector.constructors import calibrate_num_cpus
+
+class CountEnv(gym.Env):
+    '''
+    observes and reports in its info the number of steps since the last
+    reset, rewards the action, and sleeps longer for larger actions
+    '''
+    def __init__(self, episode_len=100, sleep_per_action=0.):
+        self.episode_len = episode_len
+        self.sleep_per_action = sleep_per_action
+        self.observation_space = gym.spaces.Box(low=0, high=np.inf, shape=(1,), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(3)
+
+    def reset(self):
+        self.steps = 0
+        return np.zeros(1, dtype=np.float32)
+
+    def step(self, action):
+        time.sleep(self.sleep_per_action*action)
+        self.steps += 1
+        return np.full(1, self.steps, dtype=np.float32), float(action), self.steps == self.episode_len, {"step": self.steps}
+
+def count_vec_env_fn():
+    return SingleVecEnv([CountEnv])
+
+class ZeroPolicy:
+    def start_state(self):
+        return None
+
+    def rollout_step(self, obs, infos, state=None, deterministic=False):
+        return np.zeros(len(obs), dtype=np.int64), None
+
+def test_concat_step_results_kept():
+    num_envs = 3
+    vec_env = ConcatVecEnv([count_vec_env_fn]*num_envs)
+    vec_env.reset()
+    actions = np.zeros(num_envs, dtype=np.int64)
+    obs1, rews1, dones1, infos1 = vec_env.step(actions)
+    kept_obs1 = obs1.copy()
+    obs2, rews2, dones2, infos2 = vec_env.step(actions)
+    assert infos1 is not infos2
+    assert [info["step"] for info in infos1] == [1]*num_envs
+    assert [info["step"] for info in infos2] == [2]*num_envs
+    assert np.all(kept_obs1 == 1) and np.all(obs2 == 2)
+
+    builder = RolloutBuilder(vec_env)
+    builder.restart(ZeroPolicy())
+    obss, rews, dones, infos = builder.rollout(ZeroPolicy(), 4)
+    for step in range(4):
+        assert np.all(obss[step] == step+1)
+        assert [info["step"] for info in infos[step]] == [step+1]*num_envs
+
+def short_count_env():
+    return CountEnv(episode_len=5)
+
+def slow_count_env():
+    return CountEnv(sleep_per_action=0.1)
+
+def step_actions(step, num_envs):
+    # differ between envs, so actions sent to the wrong env show up in the rewards
+    return (step + np.arange(num_envs)) % 3
+
+def test_group_stepping_matches_concat():
+    num_envs = 6
+    example_env = CountEnv()
+    env_fns = [short_count_env]*num_envs
+    sync_env = ConcatVecEnv(env_fns)
+    vec_env = MakeCPUAsyncConstructor(3, num_groups=2)(env_fns, example_env.observation_space, example_env.action_space)
+    assert vec_env.num_groups == 2
+    assert np.all(vec_env.reset() == sync_env.reset())
+
+    for group, group_slice in enumerate(vec_env.group_slices):
+        vec_env.step_group_async(group, step_actions(0, num_envs)[group_slice])
+    for step in range(12):
+        obs, rews, dones, infos = sync_env.step(step_actions(step, num_envs))
+        # the groups are stepped alternately, one is waited on while the other steps
+        for group, group_slice in enumerate(vec_env.group_slices):
+            group_obs, group_rews, group_dones, group_infos = vec_env.step_group_wait(group)
+            assert np.all(group_obs == obs[group_slice])
+            assert np.all(group_rews == rews[group_slice])
+            assert np.all(group_dones == dones[group_slice])
+            assert group_infos == infos[group_slice]
+            vec_env.step_group_async(group, step_actions(step+1, num_envs)[group_slice])
+    for group in range(vec_env.num_groups):
+        vec_env.step_group_wait(group)
+
+def test_subset_stepping():
+    example_env = CountEnv()
+    vec_env = MakeCPUAsyncConstructor(2)([slow_count_env]*4, example_env.observation_space, example_env.action_space)
+    vec_env.reset()
+    assert vec_env.worker_slices == [slice(0, 2), slice(2, 4)]
+
+    # only the second worker steps
+    for step in range(2):
+        vec_env.step_async_subset([1], np.zeros(2, dtype=np.int64))
+        (worker, env_slice, obs, rews, dones, infos), = vec_env.recv_ready()
+        assert worker == 1 and env_slice == slice(2, 4)
+        assert np.all(obs == step+1)
+
+    # the first worker is much slower, so its results come back last
+    vec_env.step_async_subset([0, 1], np.array([2, 2, 0, 1]))
+    (worker, env_slice, obs, rews, dones, infos), = vec_env.recv_ready(min_count=1)
+    assert worker == 1
+    assert np.all(obs == 3) and np.all(rews == [0, 1])
+    assert [info["step"] for info in infos] == [3, 3]
+    (worker, env_slice, obs, rews, dones, infos), = vec_env.recv_ready(min_count=1)
+    assert worker == 0
+    # the first worker's envs were not stepped along with the second's
+    assert np.all(obs == 1) and np.all(rews == [2, 2])
+    assert not vec_env.pending_workers
+
+    # a timeout returns nothing while the worker is still stepping
+    vec_env.step_async_subset([0], np.array([2, 2]))
+    assert vec_env.recv_ready(timeout=0.01) == []
+    (worker, env_slice, obs, rews, dones, infos), = vec_env.recv_ready()
+    assert worker == 0 and np.all(obs == 2)
+
+def test_calibrate_num_cpus():
+    example_env = CountEnv()
+    env_fns = [CountEnv]*6
+    num_cpus, stats = calibrate_num_cpus(env_fns, example_env.observation_space, example_env.action_space, 4, trial_time=0.05)
+    assert sorted(stats) == [0, 1, 2, 4]
+    assert [stats[c]["envs_per_cpu"] for c in sorted(stats)] == [6, 6, 3, 2]
+    assert all(stat["steps_per_sec"] > 0 for stat in stats.values())
+    assert all(stats[num_cpus]["steps_per_sec"] >= stat["steps_per_sec"] for stat in stats.values())
+
+    # with groups, the envs have to be stepped by at least one worker per group
+    num_cpus, stats = calibrate_num_cpus(env_fns, example_env.observation_space, example_env.action_space, 4, num_groups=2, trial_time=0.05)
+    assert sorted(stats) == [2, 4]
+
+    vec_env = MakeCPUAsyncConstructor(2, calibrate=True)(env_fns, example_env.observation_space, example_env.action_space)
+    num_cpus, stats = vec_env.calibration
+    assert vec_env.num_envs == 6 and num_cpus in stats
+
+test_concat_step_results_kept()
+test_group_stepping_matches_concat()
+test_subset_stepping()
+test_calibrate_num_cpus()